@@ -0,0 +1,445 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from create import House, Agent, Office, COMMISSION_RATES, TOP_COMMISSION_RATE, DATABASE_URL, PRICE_PLACES, COMMISSION_PLACES, \
+    make_engine, to_money
+from partitions import max_sale_id, sales_between
+from query import OfficeSales, AgentSales, DaysOnMarket, MonthlyReport, average_money, month_window, months_in_range
+from sqlalchemy import Float, String, func, select, type_coerce
+from sqlalchemy.orm import sessionmaker
+
+# An optional in-memory backend for the reports of query.py, for interactive slicing without a round trip to the database
+# for every report.
+#
+# The columns of the sales that the reports read (plus the date of listing of each sale's house) are kept in a snapshot
+# directory, one file of raw values per column, and memory-mapped, so opening a snapshot only reads the dates of sale (to sort
+# the sales by date) until a report touches the other columns. A report takes the sales of its months with a binary search
+# over the sales sorted by date, and groups them with np.unique and np.bincount.
+#
+# The sales are read from the sale table and from the archived years (see partitions.py), whose ids are unique across them.
+# The snapshot is refreshed with a high-water mark on the sale id, like the rollup: the sales inserted since the last refresh
+# are appended to the files. Archiving a year doesn't change the ids of its sales, so it doesn't need a rebuild. Sales updated or deleted, and houses whose listing date changed, are not tracked; call rebuild
+# after doing that.
+#
+# The reports return the same objects as the ones of query.py, with the same values. The sums of money are added up as integers
+# (the prices in cents and the commissions in units of 10 ** -COMMISSION_PLACES, like in the database), so they are exact and
+# don't depend on the order of the sales.
+
+SNAPSHOT_DIRECTORY = 'analytics_snapshot'
+
+# the type of each column of the snapshot. a missing id is -1, a missing price is nan, and a missing date is NaT
+COLUMNS = {'sale_id': 'int64', 'date_of_sale': 'datetime64[D]', 'sale_price': 'float64', 'agent_id': 'int64', 'office_id': 'int64',
+           'house_id': 'int64', 'date_of_listing': 'datetime64[D]'}
+
+COMMISSION_LIMITS = np.array([float(limit) for limit, _ in COMMISSION_RATES])
+# the rates in units of 10 ** (PRICE_PLACES - COMMISSION_PLACES), so a price in cents times its rate is a commission in units
+COMMISSION_RATE_UNITS = np.array([int(rate.scaleb(COMMISSION_PLACES - PRICE_PLACES)) for _, rate in COMMISSION_RATES] +
+                                 [int(TOP_COMMISSION_RATE.scaleb(COMMISSION_PLACES - PRICE_PLACES))], dtype=np.int64)
+
+
+def snapshot_statement(sales, last_sale_id, max_sale_id):
+    """
+    Get the query of the sales with an id in (last_sale_id, max_sale_id], with the columns of the snapshot, in the order of COLUMNS.
+    The dates and prices are read as the raw values of the database, which NumPy parses faster than date and Decimal objects.
+
+    params sales: the sales of every partition, from partitions.sales_between
+    """
+    return select(sales.c.id, type_coerce(sales.c.date_of_sale, String), type_coerce(sales.c.sale_price, Float),
+                  func.coalesce(sales.c.agent_id, -1), func.coalesce(sales.c.office_id, -1), func.coalesce(sales.c.house_id, -1),
+                  type_coerce(House.date_of_listing, String)).outerjoin(House, House.id == sales.c.house_id).where(
+        sales.c.id > last_sale_id, sales.c.id <= max_sale_id).order_by(sales.c.id)
+
+
+def price_units(prices):
+    """
+    Get the prices in cents, rounded half away from zero like create.money_units is in SQLite, and 0 for a missing price (nan).
+    """
+    cents = np.nan_to_num(prices) * 10 ** PRICE_PLACES
+    return np.trunc(cents + np.copysign(0.5, cents)).astype(np.int64)
+
+
+def sum_by(groups, values, num_groups):
+    """
+    Add up integer values by group, exactly (np.bincount adds up floats).
+    """
+    sums = np.zeros(num_groups, dtype=np.int64)
+    np.add.at(sums, groups, values)
+    return sums
+
+
+def period_of(month_number):
+    """
+    Turn a number of months since January 1970 into a (month, year) tuple like ('01', '2023').
+    """
+    year, month = divmod(int(month_number), 12)
+    return f"{month + 1:02d}", str(year + 1970)
+
+
+class SaleAnalytics:
+    """
+    The reports of query.py, answered from a memory-mapped snapshot of the sales.
+    """
+
+    def __init__(self, directory=SNAPSHOT_DIRECTORY):
+        """
+        Open the snapshot in directory, creating an empty one if there is none. Call refresh to load the sales into it.
+
+        params directory: the directory of the snapshot: str
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.open()
+
+    def path_of(self, name):
+        return os.path.join(self.directory, f"{name}.bin")
+
+    def read_metadata(self):
+        """
+        Get the metadata of the snapshot: the number of sales it holds and the id of the last one.
+        """
+        try:
+            with open(os.path.join(self.directory, 'metadata.json')) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'num_sales': 0, 'last_sale_id': 0, 'refreshed_at': None}
+
+    def write_metadata(self, metadata):
+        # the metadata is replaced in one step, so a snapshot is never read with a count that its files don't hold
+        path = os.path.join(self.directory, 'metadata.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(metadata, file)
+        os.replace(path + '.tmp', path)
+
+    def open(self):
+        """
+        Memory-map the columns of the snapshot, and sort the sales by date.
+        Only the first num_sales rows of each file are mapped, so the rows of a refresh that didn't finish are ignored.
+        """
+        self.metadata = self.read_metadata()
+        num_sales = self.metadata['num_sales']
+        self.columns = {name: np.memmap(self.path_of(name), dtype=dtype, mode='r', shape=(num_sales,)) if num_sales
+                        else np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+        # the sales in order of date, so the sales of a range of months are a slice found with a binary search. NaT sorts last
+        self.order = np.argsort(self.columns['date_of_sale'], kind='stable')
+        self.sorted_dates = self.columns['date_of_sale'][self.order]
+
+    def refresh(self, session, chunk_size=100000):
+        """
+        Append the sales inserted since the last refresh to the snapshot. If the database has no sale with an id as large as
+        the last one of the snapshot (e.g. it was recreated), the snapshot is rebuilt.
+
+        params session: the database session
+               chunk_size: the number of sales read from the database at a time: int
+        return: the number of sales appended: int
+        """
+        last_sale_id = self.metadata['last_sale_id']
+        newest_sale_id = max_sale_id(session)
+        if newest_sale_id < last_sale_id:
+            return self.rebuild(session, chunk_size)
+        if newest_sale_id == last_sale_id:
+            return 0
+
+        # drop what a refresh that didn't finish left at the end of the files
+        num_sales = self.metadata['num_sales']
+        for name, dtype in COLUMNS.items():
+            with open(self.path_of(name), 'ab') as file:
+                file.truncate(num_sales * np.dtype(dtype).itemsize)
+
+        result = session.execute(snapshot_statement(sales_between(session), last_sale_id, newest_sale_id),
+                                 execution_options={'yield_per': chunk_size})
+        files = {name: open(self.path_of(name), 'ab') for name in COLUMNS}
+        try:
+            for rows in result.partitions():
+                for (name, dtype), values in zip(COLUMNS.items(), zip(*rows)):
+                    np.array(values, dtype=dtype).tofile(files[name])
+                num_sales += len(rows)
+        finally:
+            for file in files.values():
+                file.close()
+
+        num_appended = num_sales - self.metadata['num_sales']
+        self.write_metadata({'num_sales': num_sales, 'last_sale_id': newest_sale_id, 'refreshed_at': time.time()})
+        self.open()
+        return num_appended
+
+    def rebuild(self, session, chunk_size=100000):
+        """
+        Load every sale into an empty snapshot.
+
+        params session: the database session
+               chunk_size: the number of sales read from the database at a time: int
+        return: the number of sales loaded: int
+        """
+        self.columns = {}
+        for name in COLUMNS:
+            if os.path.exists(self.path_of(name)):
+                os.remove(self.path_of(name))
+        self.write_metadata({'num_sales': 0, 'last_sale_id': 0, 'refreshed_at': None})
+        self.open()
+        return self.refresh(session, chunk_size)
+
+    def sales_in_range(self, start, end):
+        """
+        Get the positions of the sales made from the start month to the end month, both included.
+
+        params start: The first month: (str, str)
+               end: The last month: (str, str)
+        return: an array of positions in the columns
+        """
+        first, last = np.datetime64(month_window(*start)[0]), np.datetime64(month_window(*end)[1])
+        low, high = np.searchsorted(self.sorted_dates, [first, last])
+        return self.order[low:high]
+
+    def group(self, sales, column):
+        """
+        Group sales by month and by column (office_id or agent_id), and add up their numbers of sales, revenue, and commission.
+        The groups are ordered by month and then by id, and a missing id (-1) comes first like a NULL in SQLite.
+
+        params sales: the positions of the sales
+               column: 'office_id' or 'agent_id'
+        return: a dictionary of arrays with one value per group: month (the number of months since January 1970), id, num_sales,
+                num_priced (the number of sales with a price), total_revenue in cents, and total_commission in units of
+                10 ** -COMMISSION_PLACES
+        """
+        months = self.columns['date_of_sale'][sales].astype('datetime64[M]').astype(np.int64)
+        ids = self.columns[column][sales]
+        keys, groups = np.unique(months << 32 | (ids + 1), return_inverse=True)
+
+        prices = self.columns['sale_price'][sales]
+        cents = price_units(prices)
+        rates = COMMISSION_RATE_UNITS[np.searchsorted(COMMISSION_LIMITS, np.nan_to_num(prices), side='right')]
+
+        return {'month': keys >> 32, 'id': (keys & 0xFFFFFFFF) - 1, 'num_sales': np.bincount(groups, minlength=len(keys)),
+                'num_priced': np.bincount(groups, weights=~np.isnan(prices), minlength=len(keys)).astype(np.int64),
+                'total_revenue': sum_by(groups, cents, len(keys)), 'total_commission': sum_by(groups, cents * rates, len(keys))}
+
+    def top_by_month(self, session, column, start, end, n):
+        """
+        Get the n groups of column with the most sales in every month of the range, ties ordered by id, joined with their
+        office or agent. Like the SQL reports, the groups are ranked before they are joined, so a group whose office or agent
+        doesn't exist takes a rank but is left out.
+
+        return: a dictionary of (month, year) -> list of (group, details row)
+        """
+        grouped = self.group(self.sales_in_range(start, end), column)
+        order = np.lexsort((grouped['id'], -grouped['num_sales'], grouped['month']))
+        months = grouped['month'][order]
+        first_of_month = np.searchsorted(months, months)
+        top = order[np.arange(len(order)) - first_of_month < n]
+
+        model, fields = (Office, (Office.email, Office.address)) if column == 'office_id' else (Agent, (Agent.name, Agent.email))
+        ids = [int(group_id) for group_id in grouped['id'][top]]
+        details = {row.id: row for row in session.query(model.id, *fields).filter(model.id.in_(ids))}
+
+        tops = {period: [] for period in months_in_range(start, end)}
+        for position in top:
+            group_id = int(grouped['id'][position])
+            if group_id in details:
+                group = {key: values[position] for key, values in grouped.items()}
+                tops[period_of(group['month'])].append((group, details[group_id]))
+        return tops
+
+    def compute_top_five_offices(self, session, month, year):
+        """
+        Compute the top five offices with the most sales for the month, like query.compute_top_five_offices.
+
+        params session: the database session, for the email and address of the offices
+               month: The month number to get the top five offices for: str
+               year: The year to get the top five offices for: str
+        return: a list of OfficeSales objects
+        """
+        return self.get_top_offices_by_month(session, (month, year), (month, year))[(month, year)]
+
+    def compute_top_five_agents(self, session, month, year):
+        """
+        Compute the top five agents with the most sales for the month, like query.compute_top_five_agents.
+
+        params session: the database session, for the name and email of the agents
+               month: The month number to get the top five agents for: str
+               year: The year to get the top five agents for: str
+        return: a list of AgentSales objects
+        """
+        return self.get_top_agents_by_month(session, (month, year), (month, year))[(month, year)]
+
+    def compute_commissions(self, month, year):
+        """
+        Compute the total commission of each agent for the month, like query.compute_commissions.
+
+        params month: The month number to compute the commissions for: str
+               year: The year to compute the commissions for: str
+        return: a dictionary of agent_id -> total commission
+        """
+        return self.commissions_by_month((month, year), (month, year))[(month, year)]
+
+    def compute_days_on_market(self, month, year, percentiles=()):
+        """
+        Compute the days on the market for all houses that were sold that month, like query.compute_days_on_market.
+        A percentile p is the nearest rank: the smallest number of days that at least p of the sales don't exceed.
+
+        params month: The month number to get the days on the market for: str
+               year: The year to get the days on the market for: str
+               percentiles: The percentiles of days on the market to compute as well, e.g. (0.5, 0.9): tuple of float
+        return: a DaysOnMarket object
+        """
+        sales = self.sales_in_range((month, year), (month, year))
+        listed = self.columns['date_of_listing'][sales]
+        days = (self.columns['date_of_sale'][sales][~np.isnat(listed)] - listed[~np.isnat(listed)]).astype(np.int64)
+        if not len(days):
+            return DaysOnMarket(average=None, num_sales=0, percentiles={percentile: None for percentile in percentiles})
+
+        days.sort()
+        ranks = [max(int(np.ceil(percentile * len(days))), 1) for percentile in percentiles]
+        return DaysOnMarket(average=float(days.sum() / len(days)), num_sales=len(days),
+                            percentiles={percentile: float(days[min(rank, len(days)) - 1]) for percentile, rank in zip(percentiles, ranks)})
+
+    def compute_average_selling_price(self, month, year):
+        """
+        Compute the average selling price for all houses that were sold that month, like query.compute_average_selling_price.
+
+        params month: The month number to get the average selling price for: str
+               year: The year to get the average selling price for: str
+        return: the average selling price, or None if no houses were sold
+        """
+        return self.average_selling_price_by_month((month, year), (month, year))[(month, year)]
+
+    def get_top_offices_by_month(self, session, start, end, n=5):
+        """
+        Get the top n offices with the most sales for every month from start to end, like query.get_top_offices_by_month.
+
+        params session: the database session, for the email and address of the offices
+               start: The first month: (str, str)
+               end: The last month: (str, str)
+               n: The number of offices per month: int
+        return: a dictionary of (month, year) -> list of OfficeSales objects
+        """
+        return {period: [OfficeSales(office_id=int(group['id']), email=office.email, address=office.address, num_sales=int(group['num_sales']),
+                                     total_revenue=self.money(group['total_revenue'], group['num_priced'])) for group, office in offices]
+                for period, offices in self.top_by_month(session, 'office_id', start, end, n).items()}
+
+    def get_top_agents_by_month(self, session, start, end, n=5):
+        """
+        Get the top n agents with the most sales for every month from start to end, like query.get_top_agents_by_month.
+
+        params session: the database session, for the name and email of the agents
+               start: The first month: (str, str)
+               end: The last month: (str, str)
+               n: The number of agents per month: int
+        return: a dictionary of (month, year) -> list of AgentSales objects
+        """
+        return {period: [AgentSales(agent_id=int(group['id']), name=agent.name, email=agent.email, num_sales=int(group['num_sales']),
+                                    total_revenue=self.money(group['total_revenue'], group['num_priced'])) for group, agent in agents]
+                for period, agents in self.top_by_month(session, 'agent_id', start, end, n).items()}
+
+    def average_selling_price_by_month(self, start, end):
+        """
+        Get the average selling price of every month from start to end, like query.average_selling_price_by_month.
+        A sale without a price counts in the number of sales, as in the rollup.
+
+        return: a dictionary of (month, year) -> average selling price, or None if no houses were sold
+        """
+        sales = self.sales_in_range(start, end)
+        months = self.columns['date_of_sale'][sales].astype('datetime64[M]').astype(np.int64)
+        prices = self.columns['sale_price'][sales]
+        first = months.min() if len(months) else 0
+        num_sales = np.bincount(months - first)
+        revenue = sum_by(months - first, price_units(prices), len(num_sales))
+        num_priced = np.bincount(months - first, weights=~np.isnan(prices))
+
+        averages = {period: None for period in months_in_range(start, end)}
+        for offset in np.flatnonzero(num_sales):
+            averages[period_of(first + offset)] = average_money(revenue[offset] if num_priced[offset] else None, int(num_sales[offset]))
+        return averages
+
+    def average_number_of_days_by_month(self, start, end):
+        """
+        Get the average number of days on the market of the houses sold in every month from start to end,
+        like query.average_number_of_days_by_month.
+
+        return: a dictionary of (month, year) -> average number of days, or None if no houses were sold
+        """
+        sales = self.sales_in_range(start, end)
+        listed = self.columns['date_of_listing'][sales]
+        sales = sales[~np.isnat(listed)]
+        sold = self.columns['date_of_sale'][sales]
+        months = sold.astype('datetime64[M]').astype(np.int64)
+        first = months.min() if len(months) else 0
+        num_sales = np.bincount(months - first)
+        total_days = np.bincount(months - first, weights=(sold - listed[~np.isnat(listed)]).astype(np.int64))
+
+        averages = {period: None for period in months_in_range(start, end)}
+        for offset in np.flatnonzero(num_sales):
+            averages[period_of(first + offset)] = float(total_days[offset] / num_sales[offset])
+        return averages
+
+    def commissions_by_month(self, start, end):
+        """
+        Get the total commission of each agent for every month from start to end, like query.commissions_by_month.
+        Sales without an agent are under None.
+
+        return: a dictionary of (month, year) -> dictionary of agent_id -> total commission
+        """
+        grouped = self.group(self.sales_in_range(start, end), 'agent_id')
+        commissions = {period: {} for period in months_in_range(start, end)}
+        for month, agent_id, total_commission, num_priced in zip(grouped['month'].tolist(), grouped['id'].tolist(),
+                                                                 grouped['total_commission'].tolist(), grouped['num_priced'].tolist()):
+            commissions[period_of(month)][None if agent_id < 0 else agent_id] = self.money(total_commission, num_priced, COMMISSION_PLACES)
+        return commissions
+
+    def get_monthly_reports(self, session, start, end, n=5):
+        """
+        Get every report for every month from start to end, like query.get_monthly_reports.
+
+        params session: the database session, for the details of the offices and agents
+               start: The first month: (str, str)
+               end: The last month: (str, str)
+               n: The number of top offices and agents per month: int
+        return: a list of MonthlyReport objects, one per month in order
+        """
+        top_offices = self.get_top_offices_by_month(session, start, end, n)
+        top_agents = self.get_top_agents_by_month(session, start, end, n)
+        average_prices = self.average_selling_price_by_month(start, end)
+        average_days = self.average_number_of_days_by_month(start, end)
+        commissions = self.commissions_by_month(start, end)
+
+        return [MonthlyReport(month=month, year=year, top_offices=top_offices[(month, year)], top_agents=top_agents[(month, year)],
+                              average_price=average_prices[(month, year)], average_days_on_market=average_days[(month, year)],
+                              commissions=commissions[(month, year)]) for month, year in months_in_range(start, end)]
+
+    @staticmethod
+    def money(units, num_priced, places=PRICE_PLACES):
+        """
+        Turn a sum of money in units of 10 ** -places into a Decimal, or None if no sale of the sum has a price, like a SUM in SQLite.
+        """
+        return to_money(units, places) if num_priced else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the analytics snapshot of the sales and print the reports of a month from it.')
+    parser.add_argument('--month', required=True, help='the month number, e.g. 01')
+    parser.add_argument('--year', required=True, help='the year, e.g. 2023')
+    parser.add_argument('--snapshot', default=SNAPSHOT_DIRECTORY, help='the directory of the snapshot')
+    parser.add_argument('--rebuild', action='store_true', help='load every sale again instead of only the new ones')
+    parser.add_argument('--database', default=DATABASE_URL)
+    args = parser.parse_args()
+
+    session = sessionmaker(bind=make_engine(args.database))()
+    analytics = SaleAnalytics(args.snapshot)
+    started = time.perf_counter()
+    num_sales = analytics.rebuild(session) if args.rebuild else analytics.refresh(session)
+    print(f"Loaded {num_sales} new sale(s) into the snapshot in {time.perf_counter() - started:.2f}s "
+          f"({analytics.metadata['num_sales']} in total).\n")
+
+    started = time.perf_counter()
+    for office in analytics.compute_top_five_offices(session, args.month, args.year):
+        print(f"Office {office.office_id}: {office.num_sales} houses sold, ${round(office.total_revenue, 2)} in revenue.")
+    for agent in analytics.compute_top_five_agents(session, args.month, args.year):
+        print(f"{agent.name} ({agent.email}): {agent.num_sales} houses sold, ${round(agent.total_revenue, 2)} in revenue.")
+    days_on_market = analytics.compute_days_on_market(args.month, args.year, percentiles=(0.5, 0.9))
+    print(f"Average number of days on the market: {days_on_market.average}, percentiles: {days_on_market.percentiles}")
+    print(f"Average selling price: {analytics.compute_average_selling_price(args.month, args.year)}")
+    print(f"Commissions of {len(analytics.compute_commissions(args.month, args.year))} agents.")
+    print(f"\nThe reports took {(time.perf_counter() - started) * 1000:.1f} ms.")
+    session.close()
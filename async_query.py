@@ -0,0 +1,138 @@
+import asyncio
+from create import DATABASE_URL, SALE_PARTITIONS, attach_sale_partitions, set_sqlite_pragmas
+from query import MonthlyReport, compute_top_five_offices, compute_top_five_agents, compute_commissions, compute_days_on_market, \
+    compute_average_selling_price, get_monthly_reports as get_monthly_reports_sync
+from rollup import refresh_rollup
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+# The reports of query.py for asyncio, so a service can run several of them at the same time without a thread per request.
+# Each report runs the same code as its query.py counterpart through AsyncSession.run_sync, so the results, the monthly
+# rollup, and the report cache are shared. Every report call gets its own AsyncSession unless one is passed in,
+# because an AsyncSession can't be used by two tasks at the same time.
+
+
+def make_async_engine(url=DATABASE_URL, partitions=SALE_PARTITIONS):
+    """
+    Create an AsyncEngine for the database, with the aiosqlite driver for SQLite and the same SQLITE_PRAGMAS and archived
+    years as create.make_engine.
+
+    params url: the database URL; a plain sqlite:// URL is switched to the aiosqlite driver: str
+           partitions: the directory of the archived years of sales to attach, or None: str
+    return: the AsyncEngine
+    """
+    url = make_url(url)
+    if url.drivername in ('sqlite', 'sqlite+pysqlite'):
+        url = url.set(drivername='sqlite+aiosqlite')
+
+    engine = create_async_engine(url)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine.sync_engine, 'connect', set_sqlite_pragmas)
+        if partitions:
+            event.listen(engine.sync_engine, 'connect', attach_sale_partitions(partitions))
+    return engine
+
+
+async_engine = make_async_engine()
+Session = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+
+async def run_report(report, *args, session=None, session_factory=Session):
+    """
+    Run a synchronous report function of query.py, which takes the session as its first argument, on an AsyncSession.
+
+    params report: the report function
+           args: the other arguments of the report
+           session: the AsyncSession to use; a new one is opened and closed when it is None
+           session_factory: the async_sessionmaker the new session comes from
+    return: the result of the report
+    """
+    if session is not None:
+        return await session.run_sync(report, *args)
+    async with session_factory() as session:
+        return await session.run_sync(report, *args)
+
+
+async def get_top_five_offices(month, year, session=None, session_factory=Session):
+    """
+    Get the top five offices with the most sales for the month, like query.get_top_five_offices but without printing.
+
+    return: a list of OfficeSales objects
+    """
+    return await run_report(compute_top_five_offices, month, year, session=session, session_factory=session_factory)
+
+
+async def get_top_five_agents(month, year, session=None, session_factory=Session):
+    """
+    Get the top five agents with the most sales for the month, like query.get_top_five_agents but without printing.
+
+    return: a list of AgentSales objects
+    """
+    return await run_report(compute_top_five_agents, month, year, session=session, session_factory=session_factory)
+
+
+async def get_commissions(month, year, session=None, session_factory=Session):
+    """
+    Get the total commission of each agent for the month, without storing it in the MonthlyCommission table.
+
+    return: a dictionary of agent_id -> total commission
+    """
+    return await run_report(compute_commissions, month, year, session=session, session_factory=session_factory)
+
+
+async def average_number_of_days(month, year, percentiles=(), session=None, session_factory=Session):
+    """
+    Get the days on the market for the houses sold in the month, like query.average_number_of_days but without printing.
+
+    return: a DaysOnMarket object
+    """
+    return await run_report(compute_days_on_market, month, year, tuple(percentiles), session=session, session_factory=session_factory)
+
+
+async def average_selling_price(month, year, session=None, session_factory=Session):
+    """
+    Get the average selling price for the month, like query.average_selling_price but without printing.
+
+    return: the average selling price, or None if no houses were sold
+    """
+    return await run_report(compute_average_selling_price, month, year, session=session, session_factory=session_factory)
+
+
+async def get_monthly_reports(start, end, n=5, session=None, session_factory=Session):
+    """
+    Get every report for every month from start to end, like query.get_monthly_reports.
+
+    return: a list of MonthlyReport objects
+    """
+    return await run_report(lambda sync_session: get_monthly_reports_sync(start, end, n, session=sync_session),
+                            session=session, session_factory=session_factory)
+
+
+async def get_all_reports(month, year, session_factory=Session):
+    """
+    Run the five monthly reports for a month concurrently, each on its own session.
+    The rollup is brought up to date first, so the reports don't all try to refresh it at the same time.
+
+    params month: The month number: str
+           year: The year: str
+           session_factory: the async_sessionmaker the sessions come from
+    return: a MonthlyReport object
+    """
+    async with session_factory() as session:
+        await session.run_sync(refresh_rollup)
+        await session.commit()
+
+    top_offices, top_agents, commissions, days_on_market, average_price = await asyncio.gather(
+        get_top_five_offices(month, year, session_factory=session_factory),
+        get_top_five_agents(month, year, session_factory=session_factory),
+        get_commissions(month, year, session_factory=session_factory),
+        average_number_of_days(month, year, session_factory=session_factory),
+        average_selling_price(month, year, session_factory=session_factory))
+
+    return MonthlyReport(month=month, year=year, top_offices=top_offices, top_agents=top_agents, average_price=average_price,
+                         average_days_on_market=days_on_market.average, commissions=commissions)
+
+
+if __name__ == '__main__':
+    print(asyncio.run(get_all_reports('01', '2023')))
@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from create import Base, House, Sale, MonthlySalesRollup, make_engine
+from index_advisor import REPORTS
+from insert import generate_agents, generate_offices, generate_buyers, generate_sellers, generate_houses, generate_sales, bulk_insert_data
+from rollup import rebuild_rollup
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+
+def benchmark_generators(sizes):
+    """
+    Time generate_houses and generate_sales for each number of houses, on a fresh in-memory database every time.
+    If the generators scale linearly, the time per house stays about the same as the number of houses grows.
+
+    params:
+        sizes: the numbers of houses to generate: list of int
+    yields:
+        result: a dictionary with the timings of each size, as soon as it is measured
+    """
+    for num_houses in sizes:
+        engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+
+        session.add_all(generate_agents() + generate_offices() + generate_buyers() + generate_sellers())
+        session.flush()
+
+        started = time.perf_counter()
+        session.add_all(generate_houses(session, num_houses))
+        session.flush()
+        houses_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        session.add_all(generate_sales(session, int(num_houses * 0.8)))
+        session.flush()
+        sales_time = time.perf_counter() - started
+
+        session.close()
+        engine.dispose()
+        yield {'houses': num_houses, 'houses_seconds': houses_time, 'sales_seconds': sales_time}
+
+
+def scale_counts(num_sales):
+    """
+    Get the number of rows of every table for a database with num_sales sales, in the proportions of insert.py.
+
+    params:
+        num_sales: the number of sales: int
+    returns:
+        counts: the keyword arguments of bulk_insert_data
+    """
+    return {'num_houses': int(num_sales / 0.8), 'num_sales': num_sales, 'num_buyers': max(num_sales // 8, 10),
+            'num_sellers': max(num_sales // 16, 10), 'num_agents': min(max(num_sales // 400, 10), 2000),
+            'num_offices': min(max(num_sales // 8000, 5), 100)}
+
+
+def secondary_indexes():
+    """
+    Get the indexes of the sale and house tables, which the benchmark can leave out to measure what they bring.
+    """
+    return [index for table in (Sale.__table__, House.__table__) for index in table.indexes]
+
+
+def time_call(function, repeat):
+    """
+    Get the fastest of repeat runs of a function, in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def benchmark_database(num_sales, indexes=True, repeat=3, seed=0):
+    """
+    Build a database with num_sales sales in bulk and time the insertion, the rollup build, and every report.
+    The database is a temporary file, and the reports run without the report cache.
+
+    params:
+        num_sales: the number of sales: int
+        indexes: whether the sale and house tables have their indexes: bool
+        repeat: the number of runs of each report, of which the fastest is kept: int
+        seed: the seed of the random generator: int
+    returns:
+        result: a dictionary with the timings of the database
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        engine = make_engine(f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+        Base.metadata.create_all(engine)
+        if not indexes:
+            for index in secondary_indexes():
+                index.drop(engine)
+
+        started = time.perf_counter()
+        counts = bulk_insert_data(engine, seed=seed, **scale_counts(num_sales))
+        insert_time = time.perf_counter() - started
+
+        session = sessionmaker(bind=engine)()
+        rollup_time = time_call(lambda: rebuild_rollup(session), 1)
+
+        # the reports run for the month with the most sales
+        year, month = session.query(MonthlySalesRollup.year, MonthlySalesRollup.month).group_by(
+            MonthlySalesRollup.year, MonthlySalesRollup.month).order_by(func.sum(MonthlySalesRollup.num_sales).desc()).first()
+        month, year = f"{month:02d}", str(year)
+
+        reports = {}
+        for name, report in REPORTS.items():
+            def run():
+                report(session, month, year)
+                session.rollback()
+            reports[name] = time_call(run, repeat)
+
+        session.close()
+        engine.dispose()
+
+    num_rows = sum(counts.values())
+    return {'sales': num_sales, 'indexes': indexes, 'rows': num_rows, 'insert_seconds': insert_time,
+            'rows_per_second': num_rows / insert_time, 'rollup_build_seconds': rollup_time, 'month': month, 'year': year,
+            'report_seconds': reports}
+
+
+def environment():
+    """
+    Get what the results depend on besides the code: the commit, and the versions of Python and SQLite.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+
+
+def compare(old, new, threshold=0.25, min_seconds=0.01):
+    """
+    Find the timings that got slower from one run of the benchmark to another.
+    Timings of less than min_seconds in both runs are left out, since they are mostly noise.
+
+    params:
+        old: the results of the earlier run, as written to JSON
+        new: the results of the later run
+        threshold: the relative slowdown that counts as a regression, e.g. 0.25 for 25%: float
+        min_seconds: the smallest timing that is compared: float
+    returns:
+        regressions: a list of (name, old seconds, new seconds) tuples
+    """
+    def timings(results):
+        found = {}
+        for result in results.get('generators', []):
+            for key in ('houses_seconds', 'sales_seconds'):
+                found[f"generators {result['houses']} houses: {key}"] = result[key]
+        for result in results.get('databases', []):
+            prefix = f"{result['sales']} sales {'with' if result['indexes'] else 'without'} indexes"
+            found[f"{prefix}: insert"] = result['insert_seconds']
+            found[f"{prefix}: rollup build"] = result['rollup_build_seconds']
+            for name, seconds in result['report_seconds'].items():
+                found[f"{prefix}: {name}"] = seconds
+        return found
+
+    old_timings, new_timings = timings(old), timings(new)
+    return [(name, old_timings[name], seconds) for name, seconds in new_timings.items()
+            if name in old_timings and max(old_timings[name], seconds) >= min_seconds and seconds > old_timings[name] * (1 + threshold)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data generators, the bulk insertion, and the reports.')
+    parser.add_argument('--sizes', type=int, nargs='*',
+                        help='the numbers of houses to run the generators for, e.g. 1000 10000 100000 (default 1000 10000)')
+    parser.add_argument('--scales', type=int, nargs='*',
+                        help='the numbers of sales of the databases to time the reports on, e.g. 1000 100000 1000000 10000000 (default 1000 100000)')
+    parser.add_argument('--no-indexes', action='store_true', help='also time every database without the sale and house indexes')
+    parser.add_argument('--repeat', type=int, default=3, help='the number of runs of each report, of which the fastest is kept')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='compare the results with the ones in this file, and exit with 1 if anything got slower')
+    parser.add_argument('--threshold', type=float, default=0.25, help='the relative slowdown that counts as a regression')
+    args = parser.parse_args()
+
+    if args.sizes is None and args.scales is None:
+        args.sizes, args.scales = [1000, 10000], [1000, 100000]
+    results = {'environment': environment(), 'generators': [], 'databases': []}
+
+    if args.sizes:
+        print(f"{'houses':>10} {'houses (s)':>12} {'sales (s)':>12} {'us/house':>10}")
+        for result in benchmark_generators(args.sizes):
+            results['generators'].append(result)
+            per_house = (result['houses_seconds'] + result['sales_seconds']) / result['houses'] * 1e6
+            print(f"{result['houses']:>10} {result['houses_seconds']:>12.2f} {result['sales_seconds']:>12.2f} {per_house:>10.1f}", flush=True)
+        print()
+
+    for num_sales in args.scales or []:
+        for indexes in [True, False] if args.no_indexes else [True]:
+            result = benchmark_database(num_sales, indexes=indexes, repeat=args.repeat)
+            results['databases'].append(result)
+            print(f"{num_sales} sales {'with' if indexes else 'without'} indexes: inserted {result['rows']} rows in "
+                  f"{result['insert_seconds']:.2f}s ({result['rows_per_second']:.0f} rows/s), built the rollup in "
+                  f"{result['rollup_build_seconds']:.2f}s, reports for {result['month']}/{result['year']}:")
+            for name, seconds in result['report_seconds'].items():
+                print(f"  {name:<32} {seconds * 1000:>10.2f} ms")
+            print(flush=True)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, threshold=args.threshold)
+        for name, old_seconds, new_seconds in regressions:
+            print(f"slower: {name}: {old_seconds * 1000:.2f} ms -> {new_seconds * 1000:.2f} ms")
+        print(f"{len(regressions)} timing(s) are more than {args.threshold:.0%} slower than in {args.compare}.")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,268 @@
+import contextlib
+import copy
+import functools
+import inspect
+import os
+import shelve
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from partitions import archived_years
+from rollup import changed_sale_months
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# A cache for the report functions in query.py, so the same (report, month, year) isn't computed again every time it is asked for.
+#
+# Entries live in an in-process LRU with a time to live, and optionally in a shelve file on disk that survives restarts.
+# Every entry knows the months it covers. When a sale of one of those months is
+# inserted, updated, or deleted through the ORM, the entry is dropped once the session commits.
+# Changes made without the ORM (e.g. bulk inserts) are not seen, so they show up when the entries expire.
+# A report gets a copy of the cached value, so changing it doesn't change what the next caller gets.
+#
+# The processes that share a REPORT_CACHE_PATH take turns on the file with a lock (fcntl.flock, so on Windows, where there
+# is no fcntl, the disk tier must only be used by a single process).
+#
+# It is configured with environment variables:
+#   REPORT_CACHE_SIZE: the number of entries kept in memory, 0 turns the cache off (default 256)
+#   REPORT_CACHE_TTL: the number of seconds an entry is kept (default 300)
+#   REPORT_CACHE_PATH: the path of the on-disk tier, which is off when it isn't set
+
+
+class ReportCache:
+    """
+    An LRU cache of report results with a time to live and an optional on-disk tier.
+    The hits, disk_hits, misses, evictions, and invalidations counters help size it.
+    """
+
+    def __init__(self, max_entries=256, ttl=300, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()  # key -> (expires_at, months, value), the least recently used first
+        self.keys_by_month = {}  # (month, year) -> keys of the entries that cover it
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Set all the counters back to 0.
+        """
+        self.hits = self.disk_hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self):
+        """
+        Get the counters and the number of entries in memory.
+        return: a dictionary
+        """
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'entries': len(self.entries)}
+
+    def get(self, key):
+        """
+        Get the value cached for a key.
+
+        params key: str
+        return: (True, value) on a hit, (False, None) on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None and self.path:
+                entry = self._get_from_disk(key)
+                if entry is not None:
+                    self._add(key, entry)
+                    self.disk_hits += 1
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[2]
+
+    def set(self, key, months, value):
+        """
+        Cache the value of a key, which is dropped when one of its months changes.
+
+        params key: str
+               months: the (month, year) tuples the value covers
+               value: the value to cache
+        return: None
+        """
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            entry = (time.monotonic() + self.ttl, tuple(months), value)
+            self._add(key, entry)
+            if self.path:
+                with self._open_disk() as disk:
+                    # the disk tier outlives this process, so it keeps the wall clock time of expiry
+                    disk[key] = (time.time() + self.ttl, entry[1], value)
+
+    def invalidate(self, months):
+        """
+        Drop every entry that covers one of the months.
+
+        params months: (month, year) tuples
+        return: None
+        """
+        months = set(months)
+        with self.lock:
+            for month in months:
+                for key in list(self.keys_by_month.get(month, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+            if self.path:
+                with self._open_disk() as disk:
+                    for key in list(disk):
+                        if months.intersection(disk[key][1]):
+                            del disk[key]
+
+    def clear(self):
+        """
+        Drop every entry, in memory and on disk.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_month.clear()
+            if self.path:
+                with self._open_disk() as disk:
+                    disk.clear()
+
+    def _add(self, key, entry):
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = entry
+        for month in entry[1]:
+            self.keys_by_month.setdefault(month, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, months, _ = self.entries.pop(key)
+        for month in months:
+            keys = self.keys_by_month.get(month)
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_month[month]
+
+    @contextlib.contextmanager
+    def _open_disk(self):
+        # the lock is taken on a file of its own, since the files of a shelve depend on the dbm module it uses
+        with open(self.path + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            with shelve.open(self.path) as disk:
+                yield disk
+
+    def _get_from_disk(self, key):
+        with self._open_disk() as disk:
+            entry = disk.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return (time.monotonic() + entry[0] - time.time(), entry[1], entry[2])
+
+
+engine_tokens = weakref.WeakKeyDictionary()  # engine of a database that isn't a file -> the token of its cache keys
+
+
+def database_token(session):
+    """
+    Get what identifies the database of a session in the cache keys.
+    A database in a file is identified by its path and the archived years attached to it, so the engines on it share their
+    entries (and the disk tier finds them after a restart). Any other database, e.g. one in memory, only exists for its
+    engine, so it is identified by the engine.
+
+    params session: the database session
+    return: str
+    """
+    engine = session.get_bind()
+    if engine.url.database not in (None, '', ':memory:'):
+        return f"{os.path.abspath(engine.url.database)}{sorted(archived_years(session))}"
+    if engine not in engine_tokens:
+        engine_tokens[engine] = uuid.uuid4().hex
+    return engine_tokens[engine]
+
+
+report_cache = ReportCache(max_entries=int(os.environ.get('REPORT_CACHE_SIZE', 256)), ttl=float(os.environ.get('REPORT_CACHE_TTL', 300)),
+                           path=os.environ.get('REPORT_CACHE_PATH'))
+
+
+def cached_report(months_of):
+    """
+    Cache the results of a report function in report_cache. The function must take a session argument.
+    The key is the name of the function, the database (see database_token), and the other arguments.
+
+    params months_of: a function that takes the arguments of the report (a dictionary of name -> value)
+                      and returns the (month, year) tuples the report covers
+    return: the decorator
+    """
+    def decorator(report):
+        signature = inspect.signature(report)
+
+        @functools.wraps(report)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            arguments = dict(arguments.arguments)
+            session = arguments.pop('session')
+
+            key = f"{report.__name__}:{database_token(session)}:{sorted(arguments.items())!r}"
+            hit, value = report_cache.get(key)
+            if hit:
+                return copy.deepcopy(value)
+
+            value = report(*args, **kwargs)
+            report_cache.set(key, months_of(arguments), copy.deepcopy(value))
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def uncached(report):
+    """
+    Get a report function without the report cache (or any other decorator), so that it always runs its queries.
+    """
+    return inspect.unwrap(report)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_changed_months(session, flush_context):
+    """
+    Remember the months of the sales changed in this flush, to drop their cached reports when the session commits.
+    """
+    months = changed_sale_months(session)
+    if months:
+        session.info.setdefault('cache_months', set()).update(months)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_changed_months(session):
+    """
+    Drop the cached reports of the months whose sales were committed.
+    """
+    months = session.info.pop('cache_months', None)
+    if months:
+        report_cache.invalidate((f"{month:02d}", str(year)) for year, month in months)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changed_months(session):
+    """
+    Forget the months of changes that were rolled back.
+    """
+    session.info.pop('cache_months', None)
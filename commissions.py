@@ -0,0 +1,135 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from create import DATABASE_URL, COMMISSION_PLACES, commission_units_expression, make_engine, to_money
+from partitions import sales_between
+from query import month_window, months_in_range, store_commissions_by_month
+from sqlalchemy import event, func
+from sqlalchemy.orm import sessionmaker
+
+# The month-end batch recomputes the commissions of a range of months straight from the sale table, so that a change of
+# COMMISSION_RATES is applied to every sale (the rollup keeps the commissions computed with the rates it was refreshed with;
+# call rollup.rebuild_rollup after a rate change for the reports).
+#
+# The range is split into contiguous chunks of months, and each chunk is computed by a worker of a process (or thread) pool
+# on its own read-only connection. The results are then written to MonthlyCommission in a single transaction, so a failed
+# batch leaves the table as it was.
+#
+# The speedup of the pool hasn't been measured on a machine with several cores. On a single core, 58 months of an 800k-sale
+# database took 6.1s serially (4.4s computing, 1.7s writing) and 7.4s with 4 workers; only the computing part can be divided
+# across the workers.
+
+
+def set_query_only(dbapi_connection, connection_record):
+    """
+    Make a new SQLite connection read-only. It is registered as a 'connect' event listener on the engines of the workers.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only = ON")
+    cursor.close()
+
+
+def compute_commissions_from_sales(session, months):
+    """
+    Compute the total commission of each agent for each of the given months in a single grouped query over the sale table.
+    The commissions are added up exactly, like in the rollup, so they are the ones of query.compute_commissions.
+
+    params session: the database session
+           months: contiguous (month, year) tuples, e.g. [('01', '2023'), ('02', '2023')]: list of (str, str)
+    return: a dictionary of (month, year) -> a dictionary of agent_id -> total commission, with every month of months
+    """
+    start_date, _ = month_window(*months[0])
+    _, end_date = month_window(*months[-1])
+    # the sales of the range, from the sale table and from the archived years the range overlaps
+    sales = sales_between(session, start_date, end_date)
+    year, month = func.strftime('%Y', sales.c.date_of_sale), func.strftime('%m', sales.c.date_of_sale)
+
+    result = session.query(year.label('year'), month.label('month'), sales.c.agent_id,
+                           func.sum(commission_units_expression(sales.c.sale_price)).label('total_commission')).group_by(
+        year, month, sales.c.agent_id).order_by(year, month, sales.c.agent_id).all()
+
+    commissions_by_month = {period: {} for period in months}
+    for res in result:
+        commissions_by_month[(res.month, res.year)][res.agent_id] = to_money(res.total_commission, COMMISSION_PLACES)
+    return commissions_by_month
+
+
+def compute_chunk(url, months):
+    """
+    Compute the commissions of a chunk of months on a read-only connection of its own. This is what a worker of the pool runs.
+
+    params url: the database URL: str
+           months: contiguous (month, year) tuples: list of (str, str)
+    return: a dictionary of (month, year) -> a dictionary of agent_id -> total commission
+    """
+    engine = make_engine(url, pool_size=1, max_overflow=0)
+    event.listen(engine, 'connect', set_query_only)
+    try:
+        with sessionmaker(bind=engine)() as session:
+            return compute_commissions_from_sales(session, months)
+    finally:
+        engine.dispose()
+
+
+def split_months(months, num_chunks):
+    """
+    Split a list of months into at most num_chunks contiguous chunks of about the same size.
+
+    params months: the months to split: list
+           num_chunks: the number of chunks: int
+    return: a list of lists of months
+    """
+    num_chunks = max(1, min(num_chunks, len(months)))
+    return [months[len(months) * i // num_chunks:len(months) * (i + 1) // num_chunks] for i in range(num_chunks)]
+
+
+def recompute_commissions(start, end, workers=4, url=DATABASE_URL, use_threads=False):
+    """
+    Recompute the commission of every agent for every month from start to end, and store them in MonthlyCommission.
+    With a single worker, the months are computed in this process, one chunk for the whole range.
+    The database must be a file, since every worker opens its own connection to it.
+
+    params start: The first month: (str, str)
+           end: The last month: (str, str)
+           workers: the number of workers computing the months: int
+           url: the database URL: str
+           use_threads: use a thread pool instead of a process pool: bool
+    return: a dictionary of (month, year) -> a dictionary of agent_id -> total commission
+    """
+    chunks = split_months(months_in_range(start, end), workers)
+
+    commissions_by_month = {}
+    if len(chunks) == 1:
+        commissions_by_month.update(compute_chunk(url, chunks[0]))
+    else:
+        executor = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+        with executor(max_workers=len(chunks)) as pool:
+            for result in pool.map(compute_chunk, [url] * len(chunks), chunks):
+                commissions_by_month.update(result)
+
+    # a single writer merges the results of every worker
+    engine = make_engine(url)
+    try:
+        with sessionmaker(bind=engine)() as session:
+            store_commissions_by_month(session, commissions_by_month)
+    finally:
+        engine.dispose()
+
+    return commissions_by_month
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute the monthly commissions of every agent for a range of months.')
+    parser.add_argument('--start', nargs=2, required=True, metavar=('MONTH', 'YEAR'), help='the first month, e.g. 01 2023')
+    parser.add_argument('--end', nargs=2, required=True, metavar=('MONTH', 'YEAR'), help='the last month, e.g. 12 2023')
+    parser.add_argument('--workers', type=int, default=4, help='the number of workers, 1 computes everything in this process')
+    parser.add_argument('--threads', action='store_true', help='use a thread pool instead of a process pool')
+    parser.add_argument('--database', default=DATABASE_URL)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    commissions_by_month = recompute_commissions(tuple(args.start), tuple(args.end), workers=args.workers, url=args.database,
+                                                 use_threads=args.threads)
+    elapsed = time.perf_counter() - started
+    num_rows = sum(len(commissions) for commissions in commissions_by_month.values())
+    print(f"Stored {num_rows} commissions for {len(commissions_by_month)} months in {elapsed:.2f}s with {args.workers} worker(s).")
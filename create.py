@@ -1,14 +1,139 @@
-from sqlalchemy import Table, create_engine, Column, Integer, String, Float, Numeric, Date, ForeignKey, Enum, Index
+import os
+import re
+from decimal import Decimal
+from sqlalchemy import MetaData, Table, create_engine, event, inspect, Column, Integer, String, Float, Numeric, Date, ForeignKey, Enum, Index, case, cast, func, type_coerce
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import EmailType
 
-engine = create_engine('sqlite:///real_estate.db')
-engine.connect() 
+DATABASE_URL = 'sqlite:///real_estate.db'
+
+# The settings every SQLite connection gets. WAL lets readers keep reading while a writer (e.g. a bulk load) is committing,
+# synchronous=NORMAL is safe with WAL and only syncs at checkpoints, and busy_timeout makes a connection wait for a lock
+# instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # in KiB when negative, so about 64 MB of page cache per connection
+    'mmap_size': 268435456,  # 256 MB of the database file read through memory mapping
+    'busy_timeout': 10000,  # in milliseconds
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Apply SQLITE_PRAGMAS to a new SQLite connection. It is registered as a 'connect' event listener on the engines.
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+# The directory of the databases of the archived years of sales (see partitions.py), which are attached to every connection.
+# Archiving is off when it isn't set.
+SALE_PARTITIONS = os.environ.get('SALE_PARTITIONS')
+
+
+def attach_sale_partitions(directory, read_only=False):
+    """
+    Get a 'connect' event listener that attaches the database of every archived year in directory (sale_2021.db, ...)
+    to a new SQLite connection, as archive_2021, ... The years are kept in the info of the connection, as archived_years.
+    With read_only, the years are attached as read-only URIs, which needs a connection opened with uri=true.
+    """
+    def attach(dbapi_connection, connection_record):
+        years = set()
+        cursor = dbapi_connection.cursor()
+        for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+            match = re.fullmatch(r'sale_(\d{4})\.db', name)
+            if match:
+                path = os.path.join(directory, name)
+                cursor.execute(f"ATTACH DATABASE ? AS archive_{match[1]}", (f"file:{os.path.abspath(path)}?mode=ro" if read_only else path,))
+                years.add(int(match[1]))
+        cursor.close()
+        connection_record.info['archived_years'] = years
+
+    return attach
+
+
+def make_engine(url=DATABASE_URL, pool_size=5, max_overflow=10, partitions=SALE_PARTITIONS):
+    """
+    Create the engine that create.py, insert.py, and query.py share.
+    Every new SQLite connection is set up with SQLITE_PRAGMAS, and connections are pooled so they are reused.
+
+    params:
+        url: the database URL: str
+        pool_size: the number of connections kept open: int
+        max_overflow: the number of extra connections allowed when all of them are in use: int
+        partitions: the directory of the archived years of sales to attach, or None: str
+    returns:
+        engine: the database engine
+    """
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # an in-memory database only exists on its own connection, so it keeps SQLAlchemy's default pool
+        engine = create_engine(url)
+    else:
+        engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow)
+
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        if partitions:
+            event.listen(engine, 'connect', attach_sale_partitions(partitions))
+
+    return engine
+
+
+engine = make_engine()
 
 
 Base = declarative_base()
 
+# The commission rate schedule for agents: a sale priced below the limit gets that rate.
+# Sales at or above the last limit get TOP_COMMISSION_RATE.
+COMMISSION_RATES = [(100000, Decimal('0.1')), (200000, Decimal('0.075')), (500000, Decimal('0.06')), (1000000, Decimal('0.05'))]
+TOP_COMMISSION_RATE = Decimal('0.04')
+
+
+# The sums of money of the reports are computed exactly, as integers: the prices in cents and the commissions in units of
+# 10 ** -COMMISSION_PLACES (a price has 2 decimals and a rate 3), so they don't depend on the order floats are added up in.
+PRICE_PLACES = 2
+COMMISSION_PLACES = 5
+
+
+def commission_expression(sale_price):
+    """
+    Get the agent's commission of a sale price column as a SQL expression, e.g. for the sales of an archived year.
+    """
+    rate = case(*[(sale_price < limit, float(rate)) for limit, rate in COMMISSION_RATES], else_=float(TOP_COMMISSION_RATE))
+    return type_coerce(rate * sale_price, Numeric())
+
+
+def money_units(value, places):
+    """
+    Get a column of money as a SQL expression of the integer number of units of 10 ** -places it holds.
+    """
+    return cast(func.round(value * 10 ** places), Integer)
+
+
+def commission_units_expression(sale_price):
+    """
+    Get the agent's commission of a sale price column as a SQL expression of the integer number of units of
+    10 ** -COMMISSION_PLACES it holds: the price in cents times the rate in thousandths.
+    """
+    rate = case(*[(sale_price < limit, int(rate.scaleb(COMMISSION_PLACES - PRICE_PLACES))) for limit, rate in COMMISSION_RATES],
+                else_=int(TOP_COMMISSION_RATE.scaleb(COMMISSION_PLACES - PRICE_PLACES)))
+    return money_units(sale_price, PRICE_PLACES) * rate
+
+
+def to_money(units, places):
+    """
+    Turn an integer number of units of 10 ** -places into a Decimal, or None for None (e.g. a sum of no prices).
+    """
+    return None if units is None else Decimal(int(units)).scaleb(-places)
+
 
 # Define the classes for the tables
 
@@ -29,13 +154,20 @@ class House(Base):
     agent_id = Column(Integer, ForeignKey('agent.id'))
     office_id = Column(Integer, ForeignKey('office.id'))
 
+    # index the foreign keys, so the houses of a seller, buyer, agent, or office are found without scanning the table
+    __table_args__ = (Index('house_seller_index', seller_id), Index('house_buyer_index', buyer_id), Index('house_agent_index', agent_id),
+                      Index('house_office_index', office_id))
+
     def __repr__(self):
         return f"House('{self.id}', '{self.listing_price}', '{self.status}')"
     
-# Define the association table for the many-to-many relationship between agents and offices
+# Define the association table for the many-to-many relationship between agents and offices.
+# (agent_id, office_id) is its primary key, so an agent can't be connected to the same office twice and the offices of an
+# agent are found with the primary key index. The index on office_id finds the agents of an office.
 agent_office_association = Table('agent_office_association', Base.metadata, 
-                          Column('agent_id', Integer, ForeignKey('agent.id')), 
-                          Column('office_id', Integer, ForeignKey('office.id')))
+                          Column('agent_id', Integer, ForeignKey('agent.id'), primary_key=True), 
+                          Column('office_id', Integer, ForeignKey('office.id'), primary_key=True),
+                          Index('agent_office_association_office_index', 'office_id', 'agent_id'))
 
     
 class Agent(Base):
@@ -118,27 +250,33 @@ class Sale(Base):
     date_of_sale = Column(Date)
     sale_price = Column(Numeric)
 
-    # create an index on the date_of_sale column and the sale_price column
-    __table_args__ = (Index('date_of_sale_index', date_of_sale), Index('sale_price_index', sale_price))
+    # sale_report_index holds every column that the rollup refresh, the commission batch, and the percentiles of the days on
+    # the market read from a month of sales, so they are answered from the index without looking up each sale in the table.
+    # It starts with date_of_sale, so it is also the index of every search on a range of dates.
+    __table_args__ = (Index('sale_report_index', date_of_sale, office_id, agent_id, sale_price, house_id),
+                      Index('sale_house_index', house_id))
 
     
 
-    @property
+    @hybrid_property
     def agent_commission(self):
         """
         Returns the agent's commision based on the sale price
-        Using the @property decorator allows us to call this method like an attribute and generate the commission dynamically
+        Using the @hybrid_property decorator allows us to call this method like an attribute and generate the commission dynamically,
+        and also to use it in queries (e.g. func.sum(Sale.agent_commission)) so the database can compute it.
         """
-        if self.sale_price < 100000:
-            return 0.1 * float(self.sale_price)
-        elif self.sale_price < 200000:
-            return 0.075 * float(self.sale_price)
-        elif self.sale_price < 500000:
-            return 0.06 * float(self.sale_price)
-        elif self.sale_price < 1000000:
-            return 0.05 * float(self.sale_price)
-        else:
-            return 0.04 * float(self.sale_price)
+        sale_price = Decimal(str(self.sale_price))
+        for limit, rate in COMMISSION_RATES:
+            if sale_price < limit:
+                return rate * sale_price
+        return TOP_COMMISSION_RATE * sale_price
+
+    @agent_commission.expression
+    def agent_commission(cls):
+        """
+        Returns the agent's commission as a SQL expression, using the same rate schedule as the Python side.
+        """
+        return commission_expression(cls.sale_price)
         
 
     def __repr__(self):
@@ -154,9 +292,93 @@ class MonthlyCommission(Base):
     agent_id = Column(Integer, ForeignKey('agent.id'))
     total_commission = Column(Numeric)
 
+    # an agent has a single commission per month, so running the commission query again updates it instead of adding a row
+    __table_args__ = (Index('monthly_commission_index', agent_id, year, month, unique=True),)
+
     def __repr__(self):
         return f"MonthlyCommission('{self.month}', '{self.agent_id}', '{self.total_commission}')"
     
 
+class MonthlySalesRollup(Base):
+    """
+    The sales of each month aggregated per office and agent, so the monthly reports don't have to go over the sale table.
+    It is kept up to date by the rollup module.
+    """
+    __tablename__ = 'monthly_sales_rollup'
+    id = Column(Integer, primary_key=True)
+    year = Column(Integer)
+    month = Column(Integer)
+    office_id = Column(Integer, ForeignKey('office.id'))
+    agent_id = Column(Integer, ForeignKey('agent.id'))
+    num_sales = Column(Integer)
+    total_revenue = Column(Numeric)
+    total_commission = Column(Numeric)
+    total_days_on_market = Column(Float)
+    num_sales_with_listing = Column(Integer)  # the number of sales whose house is known, which total_days_on_market is over
+
+    # the reports read the rows of one month at a time
+    __table_args__ = (Index('monthly_sales_rollup_index', year, month, office_id, agent_id, unique=True),)
+
+    def __repr__(self):
+        return f"MonthlySalesRollup('{self.year}', '{self.month}', '{self.office_id}', '{self.agent_id}', '{self.num_sales}')"
+
+
+class RollupState(Base):
+    """
+    The id of the last sale that the rollup has seen, so sales inserted without the ORM (e.g. in bulk) can be picked up.
+    """
+    __tablename__ = 'rollup_state'
+    id = Column(Integer, primary_key=True)
+    last_sale_id = Column(Integer)
+
+    def __repr__(self):
+        return f"RollupState('{self.last_sale_id}')"
+
+
+# The indexes of older versions of the models that are no longer used: date_of_sale_index is the start of sale_report_index,
+# and no query searches on sale_price alone, so they only slow the inserts down.
+OBSOLETE_INDEXES = {'sale': ['date_of_sale_index', 'sale_price_index']}
+
+
+def create_indexes(engine):
+    """
+    Create the indexes that a database created by an older version of the models is missing.
+    create_all only creates the indexes of the tables it creates.
+
+    params:
+        engine: the database engine
+    returns:
+        created: the names of the indexes that were created: list of str
+    """
+    created = []
+    for table in Base.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if not inspect(engine).has_index(table.name, index.name):
+                index.create(engine)
+                created.append(index.name)
+    return created
+
+
+def drop_obsolete_indexes(engine):
+    """
+    Drop the OBSOLETE_INDEXES that a database created by an older version of the models still has.
+
+    params:
+        engine: the database engine
+    returns:
+        dropped: the names of the indexes that were dropped: list of str
+    """
+    dropped = []
+    for table_name, names in OBSOLETE_INDEXES.items():
+        if not inspect(engine).has_table(table_name):
+            continue
+        for index in sorted(Table(table_name, MetaData(), autoload_with=engine).indexes, key=lambda index: index.name):
+            if index.name in names:
+                index.drop(engine)
+                dropped.append(index.name)
+    return dropped
+
+
 if __name__ == '__main__':
-    Base.metadata.create_all(engine)  # this creates the tables in the database
\ No newline at end of file
+    Base.metadata.create_all(engine)  # this creates the tables in the database
+    create_indexes(engine)
\ No newline at end of file
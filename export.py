@@ -0,0 +1,247 @@
+import argparse
+import csv
+import datetime
+import json
+import time
+from create import Sale, House, MonthlyCommission, MonthlySalesRollup, DATABASE_URL, commission_expression, make_engine
+from partitions import sales_between
+from query import month_window
+from rollup import refresh_rollup
+from sqlalchemy import Date, Float, Integer, Numeric, func, select, tuple_, cast, type_coerce
+from sqlalchemy.orm import sessionmaker
+
+# The exports stream the rows of a query to a file in chunks of chunk_size rows, so the memory they use depends on the
+# chunk size and not on the number of rows: a chunk is fetched from the cursor (yield_per), written, and dropped
+# before the next one is fetched.
+#
+# The exports are:
+#   - sales: every sale joined with its house, with the commission and the days on the market, including the sales of the
+#     archived years (see partitions.py);
+#   - monthly: the totals of each month, from the monthly rollup;
+#   - rollup: the rows of the monthly rollup, per month, office, and agent;
+#   - commissions: the MonthlyCommission table.
+# They can be written as CSV, JSON Lines, or Parquet (which needs pyarrow).
+# The money columns are exported as floats: turning every value into a Decimal costs more than the rest of the export.
+
+
+def as_float(column, name):
+    """
+    Get a numeric column of a query as a float, without the conversion to Decimal. The cast is done by the database,
+    since SQLite stores whole prices as integers.
+    """
+    return cast(column, Float).label(name)
+
+
+def sales_statement(start=None, end=None, sales=None):
+    """
+    Get the query of the sales export: every sale joined with its house, ordered by date of sale when a range is given
+    (which sale_report_index returns in order) and by id otherwise.
+
+    params start: The first month, or None for no limit: (str, str)
+           end: The last month, or None for no limit: (str, str)
+           sales: the sales of every partition, from partitions.sales_between, or None for the sale table only
+    return: a SQLAlchemy select statement
+    """
+    sales = Sale.__table__ if sales is None else sales
+    days = type_coerce(func.julianday(sales.c.date_of_sale) - func.julianday(House.date_of_listing), Float).label('days_on_market')
+    statement = select(sales.c.id.label('sale_id'), sales.c.date_of_sale, as_float(sales.c.sale_price, 'sale_price'),
+                       as_float(commission_expression(sales.c.sale_price), 'agent_commission'), sales.c.agent_id, sales.c.office_id,
+                       sales.c.buyer_id, sales.c.seller_id, sales.c.house_id, as_float(House.listing_price, 'listing_price'),
+                       House.date_of_listing, House.zip_code, House.num_bedrooms, House.num_bathrooms, days).outerjoin(
+        House, House.id == sales.c.house_id)
+
+    if start is None and end is None:
+        return statement.order_by(sales.c.id)
+    if start is not None:
+        statement = statement.where(sales.c.date_of_sale >= month_window(*start)[0])
+    if end is not None:
+        statement = statement.where(sales.c.date_of_sale < month_window(*end)[1])
+    return statement.order_by(sales.c.date_of_sale, sales.c.id)
+
+
+def in_range(year, month, start=None, end=None):
+    """
+    Get the filter that keeps only the rows from the start month to the end month, for tables with year and month columns.
+    """
+    period = tuple_(year, month)
+    conditions = []
+    if start is not None:
+        conditions.append(period >= (int(start[1]), int(start[0])))
+    if end is not None:
+        conditions.append(period <= (int(end[1]), int(end[0])))
+    return conditions
+
+
+def monthly_statement(start=None, end=None):
+    """
+    Get the query of the monthly export: the number of sales, the revenue, the commissions, and the averages of each month.
+    """
+    num_sales = func.sum(MonthlySalesRollup.num_sales)
+    return select(MonthlySalesRollup.year, MonthlySalesRollup.month, num_sales.label('num_sales'),
+                  as_float(func.sum(MonthlySalesRollup.total_revenue), 'total_revenue'),
+                  as_float(func.sum(MonthlySalesRollup.total_revenue) / num_sales, 'average_price'),
+                  as_float(func.sum(MonthlySalesRollup.total_commission), 'total_commission'),
+                  (func.sum(MonthlySalesRollup.total_days_on_market) / func.nullif(func.sum(MonthlySalesRollup.num_sales_with_listing), 0)).label(
+                      'average_days_on_market')).where(
+        *in_range(MonthlySalesRollup.year, MonthlySalesRollup.month, start, end)).group_by(
+        MonthlySalesRollup.year, MonthlySalesRollup.month).order_by(MonthlySalesRollup.year, MonthlySalesRollup.month)
+
+
+def rollup_statement(start=None, end=None):
+    """
+    Get the query of the rollup export: the rows of the monthly rollup.
+    """
+    columns = [as_float(column, column.name) if isinstance(column.type, Numeric) else column
+               for column in MonthlySalesRollup.__table__.columns if column.name != 'id']
+    return select(*columns).where(
+        *in_range(MonthlySalesRollup.year, MonthlySalesRollup.month, start, end)).order_by(
+        MonthlySalesRollup.year, MonthlySalesRollup.month, MonthlySalesRollup.office_id, MonthlySalesRollup.agent_id)
+
+
+def commissions_statement(start=None, end=None):
+    """
+    Get the query of the commissions export: the MonthlyCommission table.
+    """
+    return select(MonthlyCommission.year, MonthlyCommission.month, MonthlyCommission.agent_id,
+                  as_float(MonthlyCommission.total_commission, 'total_commission')).where(
+        *in_range(MonthlyCommission.year, MonthlyCommission.month, start, end)).order_by(
+        MonthlyCommission.year, MonthlyCommission.month, MonthlyCommission.agent_id)
+
+
+EXPORTS = {'sales': sales_statement, 'monthly': monthly_statement, 'rollup': rollup_statement, 'commissions': commissions_statement}
+
+
+def stream_rows(session, statement, chunk_size=10000):
+    """
+    Run a query and get its rows in chunks, without loading all of them into memory.
+
+    params session: the database session
+           statement: the query: a SQLAlchemy select statement
+           chunk_size: the number of rows fetched from the cursor at a time: int
+    yields: lists of at most chunk_size rows
+    """
+    result = session.execute(statement, execution_options={'yield_per': chunk_size})
+    yield from result.partitions()
+
+
+def json_value(value):
+    """
+    Turn a value of a row into one that JSON can represent.
+    """
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def write_csv(path, columns, chunks):
+    """
+    Write chunks of rows to a CSV file with a header.
+
+    params path: the path of the file: str
+           columns: the columns of the rows: list of SQLAlchemy columns
+           chunks: the rows: iterable of lists of rows
+    return: the number of rows written: int
+    """
+    num_rows = 0
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow([column.name for column in columns])
+        for chunk in chunks:
+            writer.writerows(chunk)
+            num_rows += len(chunk)
+    return num_rows
+
+
+def write_jsonl(path, columns, chunks):
+    """
+    Write chunks of rows to a JSON Lines file, one object per row.
+    """
+    names = [column.name for column in columns]
+    num_rows = 0
+    with open(path, 'w') as file:
+        for chunk in chunks:
+            file.writelines(json.dumps(dict(zip(names, map(json_value, row)))) + '\n' for row in chunk)
+            num_rows += len(chunk)
+    return num_rows
+
+
+def write_parquet(path, columns, chunks):
+    """
+    Write chunks of rows to a Parquet file, one row group per chunk. This needs pyarrow.
+    The schema comes from the types of the columns, so it is the same for every chunk.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Exporting to Parquet needs pyarrow: pip install pyarrow") from None
+
+    def arrow_type(column):
+        if isinstance(column.type, Integer):
+            return pa.int64()
+        if isinstance(column.type, (Numeric, Float)):
+            return pa.float64()
+        if isinstance(column.type, Date):
+            return pa.date32()
+        return pa.string()
+
+    schema = pa.schema([(column.name, arrow_type(column)) for column in columns])
+    num_rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            num_rows += len(chunk)
+    return num_rows
+
+
+FORMATS = {'csv': write_csv, 'jsonl': write_jsonl, 'parquet': write_parquet}
+
+
+def export(session, name, path, format='csv', start=None, end=None, chunk_size=10000):
+    """
+    Stream one of the exports to a file.
+
+    params session: the database session
+           name: the export, one of EXPORTS: str
+           path: the path of the file: str
+           format: the format of the file, one of FORMATS: str
+           start: The first month, or None for no limit: (str, str)
+           end: The last month, or None for no limit: (str, str)
+           chunk_size: the number of rows held in memory at a time: int
+    return: the number of rows written: int
+    """
+    if name not in EXPORTS:
+        raise ValueError(f"The export must be one of {', '.join(EXPORTS)}.")
+    if format not in FORMATS:
+        raise ValueError(f"The format must be one of {', '.join(FORMATS)}.")
+
+    if name in ('monthly', 'rollup'):
+        refresh_rollup(session)
+
+    if name == 'sales':
+        # the sales of the archived years are read from their partitions, which only sales_between knows
+        statement = sales_statement(start, end, sales_between(session, start and month_window(*start)[0], end and month_window(*end)[1]))
+    else:
+        statement = EXPORTS[name](start, end)
+    return FORMATS[format](path, list(statement.selected_columns), stream_rows(session, statement, chunk_size))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export sales and reports to a file.')
+    parser.add_argument('name', choices=list(EXPORTS))
+    parser.add_argument('output', help='the path of the file to write')
+    parser.add_argument('--format', choices=list(FORMATS), help='defaults to the extension of the output file')
+    parser.add_argument('--start', nargs=2, metavar=('MONTH', 'YEAR'), help='the first month, e.g. 01 2023')
+    parser.add_argument('--end', nargs=2, metavar=('MONTH', 'YEAR'), help='the last month, e.g. 12 2023')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='the number of rows held in memory at a time')
+    parser.add_argument('--database', default=DATABASE_URL)
+    args = parser.parse_args()
+
+    format = args.format or args.output.rsplit('.', 1)[-1]
+    session = sessionmaker(bind=make_engine(args.database))()
+    started = time.perf_counter()
+    num_rows = export(session, args.name, args.output, format=format, start=args.start and tuple(args.start),
+                      end=args.end and tuple(args.end), chunk_size=args.chunk_size)
+    session.close()
+    print(f"Exported {num_rows} rows to {args.output} in {time.perf_counter() - started:.2f}s.")
@@ -0,0 +1,147 @@
+import argparse
+import re
+from create import Sale, DATABASE_URL, make_engine, create_indexes, drop_obsolete_indexes
+from cache import uncached
+from commissions import compute_commissions_from_sales
+from export import sales_statement
+from query import compute_top_five_offices, compute_top_five_agents, compute_days_on_market, compute_average_selling_price, \
+    compute_commissions, get_top_offices_by_month, get_top_agents_by_month, average_selling_price_by_month, \
+    average_number_of_days_by_month, commissions_by_month, months_in_range
+from rollup import refresh_months, refresh_rollup
+from sqlalchemy import event, func
+from sqlalchemy.orm import sessionmaker
+
+# The index advisor runs every report of query.py (and the other readers of the sale table) against a database, records the
+# statements they send, and prints the plan SQLite picks for each of them with EXPLAIN QUERY PLAN.
+# A step of a plan is flagged when SQLite scans a whole table, or searches an index that doesn't hold every column the
+# query needs, so each row it finds is looked up in the table as well.
+
+
+def year_range(month, year):
+    """
+    Get the range of the twelve months that ends with the given month, for the reports over a range of months.
+    """
+    start_year, start_month = divmod(int(year) * 12 + int(month) - 12, 12)
+    return (f"{start_month + 1:02d}", str(start_year)), (month, year)
+
+
+# each report is a function of the session, the month, and the year
+REPORTS = {
+    'rollup refresh': lambda session, month, year: refresh_months(session, {(int(year), int(month))}),
+    'top five offices': lambda session, month, year: uncached(compute_top_five_offices)(session, month, year),
+    'top five agents': lambda session, month, year: uncached(compute_top_five_agents)(session, month, year),
+    'days on the market': lambda session, month, year: uncached(compute_days_on_market)(session, month, year, percentiles=(0.5, 0.9)),
+    'average selling price': lambda session, month, year: uncached(compute_average_selling_price)(session, month, year),
+    'commissions': lambda session, month, year: compute_commissions(session, month, year),
+    'top offices by month': lambda session, month, year: uncached(get_top_offices_by_month)(*year_range(month, year), session=session),
+    'top agents by month': lambda session, month, year: uncached(get_top_agents_by_month)(*year_range(month, year), session=session),
+    'average selling price by month': lambda session, month, year: uncached(average_selling_price_by_month)(
+        *year_range(month, year), session=session),
+    'days on the market by month': lambda session, month, year: uncached(average_number_of_days_by_month)(
+        *year_range(month, year), session=session),
+    'commissions by month': lambda session, month, year: uncached(commissions_by_month)(*year_range(month, year), session=session),
+    'commission batch': lambda session, month, year: compute_commissions_from_sales(session, months_in_range(*year_range(month, year))),
+    'sales export': lambda session, month, year: session.execute(sales_statement((month, year), (month, year))).all(),
+}
+
+
+def capture_statements(session, report, *args):
+    """
+    Run a report and record the statements it sends to the database. Anything the report writes is rolled back.
+
+    params session: the database session
+           report: the report function, called with the session and args
+    return: a list of (statement, parameters) tuples, without repeats
+    """
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')) and \
+                (statement, parameters) not in statements:
+            statements.append((statement, parameters[0] if executemany else parameters))
+
+    bind = session.get_bind()
+    event.listen(bind, 'before_cursor_execute', record)
+    try:
+        report(session, *args)
+    finally:
+        event.remove(bind, 'before_cursor_execute', record)
+        session.rollback()
+    return statements
+
+
+def explain(session, statement, parameters=()):
+    """
+    Get the plan SQLite picks for a statement, one line per step.
+    """
+    return [row[-1] for row in session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()]
+
+
+def plan_warnings(plan):
+    """
+    Find the steps of a plan that read more than an index: scans of a whole table, and searches of an index that isn't covering.
+
+    params plan: the steps of a plan from explain
+    return: a list of (step, warning) tuples
+    """
+    warnings = []
+    for step in plan:
+        if re.match(r'SCAN \w+$', step) and not re.match(r'SCAN (anon_\d+|\w*subquery)', step):
+            warnings.append((step, 'scans the whole table'))
+        elif re.search(r'USING INDEX', step) and 'COVERING' not in step:
+            warnings.append((step, 'looks up every row it finds in the table'))
+    return warnings
+
+
+def advise(session, month, year):
+    """
+    Print the plan of every statement of every report, with its warnings. A statement that several reports send
+    (e.g. the check of refresh_rollup) is printed once.
+
+    params session: the database session
+           month: The month number to run the reports for: str
+           year: The year to run the reports for: str
+    return: the number of statements with warnings: int
+    """
+    refresh_rollup(session)
+
+    num_warnings = 0
+    printed = set()
+    for name, report in REPORTS.items():
+        print(f"{name}:")
+        for statement, parameters in capture_statements(session, report, month, year):
+            if statement in printed:
+                continue
+            printed.add(statement)
+            plan = explain(session, statement, parameters)
+            warnings = dict(plan_warnings(plan))
+            num_warnings += bool(warnings)
+            print(f"  {' '.join(statement.split())[:100]}...")
+            for step in plan:
+                print(f"    {step}" + (f"  <- {warnings[step]}" if step in warnings else ''))
+        print()
+    return num_warnings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the query plans of the reports, and flag the steps that are not covered by an index.')
+    parser.add_argument('--month', help='defaults to the month of the last sale')
+    parser.add_argument('--year', help='defaults to the year of the last sale')
+    parser.add_argument('--create-indexes', action='store_true', help='create the indexes that the database is missing, and drop the obsolete ones, first')
+    parser.add_argument('--database', default=DATABASE_URL)
+    args = parser.parse_args()
+
+    engine = make_engine(args.database)
+    if args.create_indexes:
+        print(f"Created the indexes: {', '.join(create_indexes(engine)) or 'none were missing'}")
+        print(f"Dropped the indexes: {', '.join(drop_obsolete_indexes(engine)) or 'none were obsolete'}\n")
+
+    session = sessionmaker(bind=engine)()
+    month, year = args.month, args.year
+    if month is None or year is None:
+        last_sale = session.query(func.max(Sale.date_of_sale)).scalar()
+        month, year = month or f"{last_sale.month:02d}", year or str(last_sale.year)
+
+    num_warnings = advise(session, month, year)
+    print(f"{num_warnings} statement(s) are not fully covered by an index.")
+    session.close()
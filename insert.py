@@ -1,8 +1,16 @@
+import argparse
 import random
+import time
+import numpy as np
 from faker import Faker
 from faker.providers import address
-from create import Base, Agent, Office, Buyer, Seller, House, Sale
-from sqlalchemy import create_engine
+from cache import report_cache
+from partitions import archived_years, max_sale_id, partition_table
+from rollup import refresh_months
+from create import Agent, Office, Buyer, Seller, House, Sale, agent_office_association, make_engine, DATABASE_URL, \
+    engine as shared_engine
+from sqlalchemy import bindparam, func, insert, inspect, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
 import datetime
 
@@ -88,21 +96,36 @@ def generate_offices():
     return offices
 
 # Populate the agent_office_association table
-def populate_agent_office_association(session):
+def populate_agent_office_association(session, seed=None):
     """
     Populates the association table between agents and offices.
 
-    This function takes all agents and all offices from the database and randomly creates connections between them.
+    This function takes all agents and all offices from the database and randomly creates connections between them,
+    making sure every agent works in at least one office. The pairs are generated in memory and inserted with a single
+    executemany, instead of appending to agent.offices one office at a time. Pairs that already exist are skipped.
 
     params:
         session: the database session
+        seed: the seed of the random generator: int
     returns:
         None
     """
-    for agent in session.query(Agent).all():
-        for office in session.query(Office).all():
-            if fake.pybool():
-                agent.offices.append(office)
+    session.flush()
+    agent_ids = session.scalars(select(Agent.id).order_by(Agent.id)).all()
+    office_ids = session.scalars(select(Office.id).order_by(Office.id)).all()
+    pairs = generate_agent_office_pairs(np.random.default_rng(seed), agent_ids, office_ids)
+    if not pairs['agent_id']:
+        return
+
+    session.execute(sqlite_insert(agent_office_association).on_conflict_do_nothing(),
+                    [{'agent_id': agent_id, 'office_id': office_id} for agent_id, office_id in zip(pairs['agent_id'], pairs['office_id'])])
+
+    # the offices and agents collections that are already loaded don't know about the new rows
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Agent):
+            session.expire(obj, ['offices'])
+        elif isinstance(obj, Office):
+            session.expire(obj, ['agents'])
 
 # Generate fake data for buyers
 def generate_buyers():
@@ -139,26 +162,27 @@ def generate_sellers():
     return sellers
 
 # Generate fake data for houses
-def generate_houses(session):
+def generate_houses(session, num_houses=num_of_houses):
     """
     Generate fake data for houses.
     The seller, agent, and office need to exist in the database so that the data is consistent.
     params:
         session: the database session
+        num_houses: the number of houses to generate: int
     returns:
         houses: a list of House objects
     """
     houses = []
-    
-    for _ in range(num_of_houses):
-        # generate random seller_id, agent_id, and office_id that exist in the database
-        seller_ids = [seller.id for seller in session.query(Seller).all()]
+
+    # get the seller_ids, agent_ids, and office_ids that exist in the database once, instead of for every house
+    seller_ids = [seller_id for seller_id, in session.query(Seller.id)]
+    agent_ids = [agent_id for agent_id, in session.query(Agent.id)]
+    office_ids = [office_id for office_id, in session.query(Office.id)]
+
+    for _ in range(num_houses):
+        # pick a random seller_id, agent_id, and office_id
         seller_id = random.choice(seller_ids)
-        
-        agent_ids = [agent.id for agent in session.query(Agent).all()]
         agent_id = random.choice(agent_ids)
-
-        office_ids = [office.id for office in session.query(Office).all()]
         office_id = random.choice(office_ids)
 
         house = House(num_bedrooms=fake.pyint(min_value=1, max_value=5), num_bathrooms=fake.pyint(min_value=1, max_value=5), 
@@ -170,67 +194,67 @@ def generate_houses(session):
     return houses
 
 # Generate fake data for sales
-def generate_sales(session):
+def generate_sales(session, num_sales=num_of_sales):
     """
     Generate fake data for sales.
     A house can't be sold more than once, so we have to take that into account when generating the data.
-    Also, when a house is sold, we need to update the status of the house to 'Sold'.
-    And when a seller sales a house, we need to add that to his/her list of sold houses.
-    And when a buyer buys a house, we need to add that to his/her list of purchases.
+    Also, when a house is sold, we need to update the status of the house to 'Sold' and set its buyer.
+    The seller of the house is already set, and the buyer is set through its foreign key, so a sale takes no query:
+    the only queries are the one of the unsold houses and the one of the buyer ids.
 
     params:
         session: the database session
+        num_sales: the number of sales to generate. If there are fewer unsold houses, all of them are sold: int
     returns:
         sales: a list of Sale objects
     """
     sales = []
 
-    sold_houses = []
-    for _ in range(num_of_sales):
-        # generate a random house_id that hasn't been sold yet and exists in the database
-        house_ids = [house.id for house in session.query(House).all()]
-        house_id = random.choice(house_ids)
+    # shuffle the houses that haven't been sold yet and sell the first ones, so a house is never picked twice
+    unsold_houses = session.query(House).filter(House.status == 'Not Sold').all()
+    random.shuffle(unsold_houses)
 
-        while house_id in sold_houses:  # make sure the house hasn't been sold already
-            house_id = random.choice(house_ids)
-        sold_houses.append(house_id)
+    # get the buyer_ids that exist in the database once, instead of for every sale
+    buyer_ids = [buyer_id for buyer_id, in session.query(Buyer.id)]
 
-        # generate a random buyer_id and agent_id that exist in the database
-        buyer_ids = [buyer.id for buyer in session.query(Buyer).all()]
-        buyer_id = random.choice(buyer_ids)
+    # the session doesn't need to be flushed before each lookup below. Autoflushing goes over every object in the
+    # session, so doing it once per sale would make generating the sales quadratic in the number of houses.
+    with session.no_autoflush:
+        for house in unsold_houses[:num_sales]:
+            # generate a random buyer_id that exists in the database
+            buyer_id = random.choice(buyer_ids)
 
-        # we can get the agent_id and the seller_id from the house object
-        house = session.query(House).filter_by(id=house_id).first()  # get the house object that was sold from the database
-        agent_id = house.agent_id
-        seller_id = house.seller_id
-        office_id = house.office_id
+            # we can get the agent_id and the seller_id from the house object
+            agent_id = house.agent_id
+            seller_id = house.seller_id
+            office_id = house.office_id
 
 
-        # sale price could be less than the listing price by a random amount. this is always less than 20%.
-        negotiated_discount_percentage = random.randint(0, 20)
-        sale_price = (1-negotiated_discount_percentage/100) * house.listing_price
+            # sale price could be less than the listing price by a random amount. this is always less than 20%.
+            negotiated_discount_percentage = random.randint(0, 20)
+            sale_price = (1-negotiated_discount_percentage/100) * float(house.listing_price)
 
-        sale = Sale(house_id=house_id, buyer_id=buyer_id, seller_id=seller_id, agent_id=agent_id, office_id=office_id, date_of_sale=generate_date(house.date_of_listing), 
-                    sale_price=sale_price)
+            sale = Sale(house_id=house.id, buyer_id=buyer_id, seller_id=seller_id, agent_id=agent_id, office_id=office_id, date_of_sale=generate_date(house.date_of_listing), 
+                        sale_price=sale_price)
         
-        house.status = 'Sold'  # update the status of the house to 'Sold'
+            house.status = 'Sold'  # update the status of the house to 'Sold'
 
-        # updates the houses of the buyer
-        buyer = session.query(Buyer).filter_by(id=buyer_id).first()
-        buyer.houses.append(house)
+            # the house joins the houses of the buyer through its foreign key. Appending it to buyer.houses would query the
+            # buyer and load every house they already have, for every sale. A buyer.houses collection that is already
+            # loaded in the session sees the house once it is expired, e.g. by the commit.
+            house.buyer_id = buyer_id
 
-        # updates the sold houses of the seller
-        seller = session.query(Seller).filter_by(id=house.seller_id).first()
-        seller.houses.append(house)
-        
-        sales.append(sale)
+            sales.append(sale)
     return sales
 
 # Insert fake data into the database
-def insert_data(engine = create_engine('sqlite:///real_estate.db')):
+def insert_data(engine=None):
     """
     Inserts fake data into the database.
+    params:
+        engine: the database engine, the shared one from create.py by default
     """
+    engine = engine or shared_engine
     agents = generate_agents()
     offices = generate_offices()
     buyers = generate_buyers()
@@ -259,5 +283,387 @@ def insert_data(engine = create_engine('sqlite:///real_estate.db')):
     session.commit()
 
 
+# Bulk generation
+# The functions below generate the same kind of data as the ones above, but as columnar batches sampled with NumPy
+# and inserted with Core executemany, so we can create millions of rows for load tests.
+
+def generate_name_pools(size=1000):
+    """
+    Pre-generate pools of first names, last names, and addresses with Faker, which the bulk generator samples from.
+    Calling Faker for every row is what makes the ORM generators slow.
+    params:
+        size: the number of entries in each pool: int
+    returns:
+        first_names, last_names, addresses: lists of str
+    """
+    first_names = [fake.first_name() for _ in range(size)]
+    last_names = [fake.last_name() for _ in range(size)]
+    addresses = [fake.address() for _ in range(size)]
+
+    return first_names, last_names, addresses
+
+def generate_phones(rng, count):
+    """
+    Generate random phone numbers formatted like '###-###-####'.
+    params:
+        rng: a NumPy random generator
+        count: the number of phone numbers: int
+    returns:
+        phones: a list of str
+    """
+    digits = rng.integers(0, [1000, 1000, 10000], size=(count, 3)).tolist()
+
+    return [f"{a:03d}-{b:03d}-{c:04d}" for a, b, c in digits]
+
+def generate_dates(rng, start_dates, end_date=None):
+    """
+    Generate a random date between each start date and the end date (today by default). The vectorised version of generate_date.
+    params:
+        rng: a NumPy random generator
+        start_dates: an array of datetime64[D]
+        end_date: date object
+    returns:
+        dates: an array of datetime64[D]
+    """
+    end_date = np.datetime64(end_date or datetime.date.today(), 'D')
+    days = (end_date - start_dates).astype(np.int64)
+
+    return start_dates + np.floor(rng.random(len(start_dates)) * (days + 1)).astype(np.int64)
+
+def generate_people_batch(rng, pools, first_id, count):
+    """
+    Generate a batch of agent, buyer, or seller rows, which all have the same columns.
+    params:
+        rng: a NumPy random generator
+        pools: the pools returned by generate_name_pools
+        first_id: the id of the first row: int
+        count: the number of rows: int
+    returns:
+        batch: a dictionary of column name -> list of values
+    """
+    first_names, last_names, _ = pools
+    first = [first_names[i] for i in rng.integers(0, len(first_names), count).tolist()]
+    last = [last_names[i] for i in rng.integers(0, len(last_names), count).tolist()]
+
+    return {'id': list(range(first_id, first_id + count)), 'name': list(map(generate_name, first, last)),
+            'phone': generate_phones(rng, count), 'email': list(map(generate_email, first, last))}
+
+def generate_offices_batch(rng, pools, first_id, count):
+    """
+    Generate a batch of office rows.
+    params:
+        rng: a NumPy random generator
+        pools: the pools returned by generate_name_pools
+        first_id: the id of the first row: int
+        count: the number of rows: int
+    returns:
+        batch: a dictionary of column name -> list of values
+    """
+    addresses = [pools[2][i] for i in rng.integers(0, len(pools[2]), count).tolist()]
+
+    return {'id': list(range(first_id, first_id + count)), 'phone': generate_phones(rng, count),
+            'email': [f"{address.split(' ')[1].lower()}@company.com" for address in addresses], 'address': addresses}
+
+def generate_agent_office_pairs(rng, agent_ids, office_ids):
+    """
+    Randomly connect agents and offices, making sure every agent works in at least one office.
+    params:
+        rng: a NumPy random generator
+        agent_ids: a list of agent ids
+        office_ids: a list of office ids
+    returns:
+        batch: a dictionary of column name -> list of values
+    """
+    agent_ids = np.asarray(agent_ids)
+    office_ids = np.asarray(office_ids)
+    if not len(agent_ids) or not len(office_ids):
+        return {'agent_id': [], 'office_id': []}
+
+    connected = rng.random((len(agent_ids), len(office_ids))) < 0.5
+    connected[np.arange(len(agent_ids)), rng.integers(0, len(office_ids), len(agent_ids))] = True
+    agents, offices = np.nonzero(connected)
+
+    return {'agent_id': agent_ids[agents].tolist(), 'office_id': office_ids[offices].tolist()}
+
+def generate_houses_and_sales_batch(rng, first_house_id, num_houses, first_sale_id, num_sales, seller_ids, buyer_ids, agent_ids, office_ids):
+    """
+    Generate a batch of houses and the sales of num_sales of them. The sold houses are drawn without replacement,
+    so a house is never sold twice, and each sale takes its seller, agent, and office from its house.
+    params:
+        rng: a NumPy random generator
+        first_house_id: the id of the first house: int
+        num_houses: the number of houses: int
+        first_sale_id: the id of the first sale: int
+        num_sales: the number of sales, at most num_houses: int
+        seller_ids, buyer_ids, agent_ids, office_ids: arrays of the ids that exist in the database
+    returns:
+        houses, sales: dictionaries of column name -> list of values
+    """
+    house_ids = np.arange(first_house_id, first_house_id + num_houses)
+    seller = rng.choice(seller_ids, num_houses)
+    agent = rng.choice(agent_ids, num_houses)
+    office = rng.choice(office_ids, num_houses)
+    listing_price = rng.integers(30000, 2000001, num_houses)
+    date_of_listing = generate_dates(rng, np.full(num_houses, np.datetime64('2022-01-01', 'D')))
+
+    # pick the houses that are sold and who bought them
+    sold = rng.permutation(num_houses)[:num_sales]
+    sold.sort()
+    buyer = np.full(num_houses, None, dtype=object)
+    buyer[sold] = rng.choice(buyer_ids, num_sales)
+    status = np.full(num_houses, 'Not Sold', dtype=object)
+    status[sold] = 'Sold'
+
+    # sale price could be less than the listing price by a random amount. this is always less than 20%.
+    sale_price = np.round((1 - rng.integers(0, 21, num_sales) / 100) * listing_price[sold], 2)
+    date_of_sale = generate_dates(rng, date_of_listing[sold])
+
+    # dates are stored as 'YYYY-MM-DD' strings in SQLite, which is what datetime64[D] converts to
+    houses = {'id': house_ids.tolist(), 'num_bedrooms': rng.integers(1, 6, num_houses).tolist(),
+              'num_bathrooms': rng.integers(1, 6, num_houses).tolist(), 'listing_price': listing_price.tolist(),
+              'zip_code': np.char.zfill(rng.integers(501, 100000, num_houses).astype(str), 5).tolist(),
+              'date_of_listing': date_of_listing.astype(str).tolist(), 'status': status.tolist(), 'seller_id': seller.tolist(),
+              'buyer_id': buyer.tolist(), 'agent_id': agent.tolist(), 'office_id': office.tolist()}
+
+    sales = {'id': list(range(first_sale_id, first_sale_id + num_sales)), 'house_id': house_ids[sold].tolist(),
+             'seller_id': seller[sold].tolist(), 'buyer_id': buyer[sold].tolist(), 'agent_id': agent[sold].tolist(),
+             'office_id': office[sold].tolist(), 'date_of_sale': date_of_sale.astype(str).tolist(), 'sale_price': sale_price.tolist()}
+
+    return houses, sales
+
+def next_id(connection, model):
+    """
+    Get the id that the next row of a table should get.
+    """
+    return (connection.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+def insert_batch(connection, table, batch):
+    """
+    Insert a columnar batch into a table with a single executemany.
+    The values go straight to the database driver, skipping SQLAlchemy's per-row parameter processing,
+    so they must already be stored types (e.g. dates as 'YYYY-MM-DD' strings).
+    params:
+        connection: the database connection
+        table: the Table to insert into
+        batch: a dictionary of column name -> list of values
+    returns:
+        None
+    """
+    statement = insert(table).compile(dialect=connection.dialect, column_keys=list(batch))
+    rows = list(zip(*[batch[name] for name in statement.positiontup]))
+    if rows:
+        connection.exec_driver_sql(str(statement), rows)
+
+def insert_sales(connection, sales):
+    """
+    Insert a columnar batch of sales with insert_batch, each one into the partition of its year: the sale table, or the
+    table of its year if the year is archived (see partitions.py). The rollup only follows the sale table, so the months
+    of the archived years that got sales are refreshed in the same transaction.
+    params:
+        connection: the database connection
+        sales: a dictionary of column name -> list of values, with the dates as 'YYYY-MM-DD' strings
+    returns:
+        None
+    """
+    years = archived_years(connection)
+    partitions = [int(date[:4]) if date and int(date[:4]) in years else None for date in sales['date_of_sale']]
+    if not any(partitions):
+        insert_batch(connection, Sale.__table__, sales)
+        return
+
+    for year in set(partitions):
+        rows = [i for i, partition in enumerate(partitions) if partition == year]
+        insert_batch(connection, Sale.__table__ if year is None else partition_table(year),
+                     {name: [values[i] for i in rows] for name, values in sales.items()})
+    refresh_months(connection, {(year, int(date[5:7])) for year, date in zip(partitions, sales['date_of_sale']) if year is not None})
+
+def bulk_insert_data(engine, num_houses=num_of_houses, num_sales=num_of_sales, num_buyers=num_of_buyers, num_sellers=num_of_sellers,
+                     num_agents=num_of_agents, num_offices=num_of_offices, chunk_size=50000, seed=None, defer_indexes=None):
+    """
+    Inserts fake data into the database in bulk. The rows are generated in columnar batches of chunk_size rows
+    and every batch is inserted with one executemany in its own transaction, so memory stays bounded.
+    The new rows are added after the ones that are already in the database.
+    The indexes of the house and sale tables can be dropped while the houses and sales are loaded and created again after,
+    since building an index once is much faster than updating it for every row. The reports are slow until they are back.
+    params:
+        engine: the database engine
+        num_houses, num_sales, num_buyers, num_sellers, num_agents, num_offices: the number of rows to create: int
+        chunk_size: the number of rows per transaction: int
+        seed: the seed of the random generator: int
+        defer_indexes: whether to drop the indexes during the load, or None to drop them when there are at least as many
+                       new houses as houses already in the database: bool
+    returns:
+        counts: a dictionary of table name -> number of rows inserted
+    """
+    if num_sales > num_houses:
+        raise ValueError("There can't be more sales than houses because a house can't be sold more than once.")
+
+    rng = np.random.default_rng(seed)
+    pools = generate_name_pools()
+
+    with engine.connect() as connection:
+        first_ids = {model: next_id(connection, model) for model in [Agent, Office, Buyer, Seller, House]}
+        # the ids of the sales come after the ones of every partition
+        first_ids[Sale] = max_sale_id(connection) + 1
+
+    def insert_batches(model, count, generate_batch):
+        first_id = first_ids[model]
+        for start in range(0, count, chunk_size):
+            batch = generate_batch(rng, pools, first_id + start, min(chunk_size, count - start))
+            with engine.begin() as connection:
+                insert_batch(connection, model.__table__, batch)
+        return np.arange(first_id, first_id + count)
+
+    agent_ids = insert_batches(Agent, num_agents, generate_people_batch)
+    office_ids = insert_batches(Office, num_offices, generate_offices_batch)
+    buyer_ids = insert_batches(Buyer, num_buyers, generate_people_batch)
+    seller_ids = insert_batches(Seller, num_sellers, generate_people_batch)
+
+    pairs = generate_agent_office_pairs(rng, agent_ids, office_ids)
+    with engine.begin() as connection:
+        insert_batch(connection, agent_office_association, pairs)
+
+    if defer_indexes is None:
+        defer_indexes = num_houses >= first_ids[House] - 1
+    deferred = []
+    if defer_indexes:
+        with engine.begin() as connection:
+            deferred = [index for table in (House.__table__, Sale.__table__) for index in table.indexes
+                        if inspect(connection).has_index(table.name, index.name)]
+            for index in deferred:
+                index.drop(connection)
+
+    try:
+        # spread the sales over the house batches so that the total is exactly num_sales
+        for start in range(0, num_houses, chunk_size):
+            end = min(start + chunk_size, num_houses)
+            first_sale = num_sales * start // num_houses
+            batch_sales = num_sales * end // num_houses - first_sale
+            houses, sales = generate_houses_and_sales_batch(rng, first_ids[House] + start, end - start, first_ids[Sale] + first_sale,
+                                                            batch_sales, seller_ids, buyer_ids, agent_ids, office_ids)
+            with engine.begin() as connection:
+                insert_batch(connection, House.__table__, houses)
+                insert_sales(connection, sales)
+    finally:
+        # the indexes are created again even if the load failed
+        with engine.begin() as connection:
+            for index in deferred:
+                index.create(connection)
+
+    return {'agent': num_agents, 'office': num_offices, 'buyer': num_buyers, 'seller': num_sellers,
+            'agent_office_association': len(pairs['agent_id']), 'house': num_houses, 'sale': num_sales}
+
+def append_activity(engine, num_houses=num_of_houses, num_sales=num_of_sales, day=None, batch_size=1000, seed=None, progress=None):
+    """
+    Appends one day of activity to an existing database: new listings, and sales of houses that are on the market.
+    The agents, offices, buyers, and sellers are the ones already in the database. Every batch of batch_size rows is
+    committed on its own, so memory and the write-ahead log don't grow with the number of rows.
+    The sales are inserted without the ORM, so the rollup picks them up with its high-water mark, and the cached reports
+    of their month are dropped.
+    params:
+        engine: the database engine
+        num_houses: the number of new listings: int
+        num_sales: the number of sales, of houses listed on or before the day: int
+        day: the date of the listings and the sales, today by default: date object
+        batch_size: the number of rows per transaction: int
+        seed: the seed of the random generator: int
+        progress: a function called with (table name, rows done, rows to do) after every batch
+    returns:
+        counts: a dictionary of table name -> number of rows inserted. There are fewer sales than num_sales when there
+                aren't enough houses on the market.
+    """
+    day = day or datetime.date.today()
+    rng = np.random.default_rng(seed)
+
+    with engine.connect() as connection:
+        ids = {model: np.array(connection.execute(select(model.id)).scalars().all()) for model in [Agent, Office, Buyer, Seller]}
+    if not all(len(model_ids) for model_ids in ids.values()):
+        raise ValueError("Appending needs at least one agent, office, buyer, and seller in the database.")
+
+    for start in range(0, num_houses, batch_size):
+        count = min(batch_size, num_houses - start)
+        houses = {'num_bedrooms': rng.integers(1, 6, count).tolist(), 'num_bathrooms': rng.integers(1, 6, count).tolist(),
+                  'listing_price': rng.integers(30000, 2000001, count).tolist(),
+                  'zip_code': np.char.zfill(rng.integers(501, 100000, count).astype(str), 5).tolist(),
+                  'date_of_listing': [day.isoformat()] * count, 'status': ['Not Sold'] * count,
+                  'seller_id': rng.choice(ids[Seller], count).tolist(), 'agent_id': rng.choice(ids[Agent], count).tolist(),
+                  'office_id': rng.choice(ids[Office], count).tolist()}
+        with engine.begin() as connection:
+            insert_batch(connection, House.__table__, houses)
+        if progress:
+            progress('house', start + count, num_houses)
+
+    # the houses to sell are drawn once from the ones on the market, so the cost of a batch doesn't grow with the market
+    with engine.connect() as connection:
+        on_the_market = np.array(connection.execute(select(House.id).where(House.status == 'Not Sold', House.date_of_listing <= day)).scalars().all(),
+                                 dtype=np.int64)
+    to_sell = rng.choice(on_the_market, min(num_sales, len(on_the_market)), replace=False)
+
+    # the buyer and the status of a sold house, with one executemany per batch
+    sell_house = update(House.__table__).where(House.id == bindparam('sold_house_id')).values(status='Sold', buyer_id=bindparam('new_buyer_id'))
+
+    sold = 0
+    for start in range(0, len(to_sell), batch_size):
+        with engine.begin() as connection:
+            # a house sold since it was drawn, e.g. by another writer, is left out
+            houses = connection.execute(select(House.id, House.seller_id, House.agent_id, House.office_id, House.listing_price).where(
+                House.id.in_(to_sell[start:start + batch_size].tolist()), House.status == 'Not Sold')).all()
+            if not houses:
+                continue
+            count = len(houses)
+            house_id, seller_id, agent_id, office_id, listing_price = map(list, zip(*houses))
+            buyer_id = rng.choice(ids[Buyer], count).tolist()
+
+            # sale price could be less than the listing price by a random amount. this is always less than 20%.
+            sale_price = np.round((1 - rng.integers(0, 21, count) / 100) * np.array(listing_price, dtype=float), 2).tolist()
+            # the ids come after the ones of every partition, like in bulk_insert_data
+            first_id = max_sale_id(connection) + 1
+            insert_sales(connection, {'id': list(range(first_id, first_id + count)), 'house_id': house_id, 'seller_id': seller_id,
+                                      'buyer_id': buyer_id, 'agent_id': agent_id, 'office_id': office_id,
+                                      'date_of_sale': [day.isoformat()] * count, 'sale_price': sale_price})
+            connection.execute(sell_house, [{'sold_house_id': sold_id, 'new_buyer_id': new_buyer_id}
+                                            for sold_id, new_buyer_id in zip(house_id, buyer_id)])
+        sold += count
+        if progress:
+            progress('sale', sold, num_sales)
+
+    if sold:
+        report_cache.invalidate([(f"{day.month:02d}", str(day.year))])
+
+    return {'house': num_houses, 'sale': sold}
+
 if __name__ == '__main__':
-    insert_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Insert fake data into the real estate database.')
+    parser.add_argument('--bulk', action='store_true', help='generate the data in vectorised batches, for millions of rows')
+    parser.add_argument('--append', action='store_true',
+                        help='append one day of activity (--houses new listings and --sales sales) to the existing rows')
+    parser.add_argument('--day', type=datetime.date.fromisoformat, help='the day of the activity in append mode, e.g. 2024-05-01 (default today)')
+    parser.add_argument('--batch-size', type=int, default=1000, help='the number of rows per transaction in append mode')
+    parser.add_argument('--houses', type=int, default=num_of_houses)
+    parser.add_argument('--sales', type=int, help='defaults to 80%% of the houses')
+    parser.add_argument('--buyers', type=int, default=num_of_buyers)
+    parser.add_argument('--sellers', type=int, default=num_of_sellers)
+    parser.add_argument('--agents', type=int, default=num_of_agents)
+    parser.add_argument('--offices', type=int, default=num_of_offices)
+    parser.add_argument('--chunk-size', type=int, default=50000, help='the number of rows per transaction in bulk mode')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--database', default=DATABASE_URL)
+    args = parser.parse_args()
+
+    engine = make_engine(args.database)
+    if args.bulk:
+        num_sales = args.sales if args.sales is not None else int(args.houses * 0.8)
+        started = time.perf_counter()
+        counts = bulk_insert_data(engine, num_houses=args.houses, num_sales=num_sales, num_buyers=args.buyers, num_sellers=args.sellers,
+                                  num_agents=args.agents, num_offices=args.offices, chunk_size=args.chunk_size, seed=args.seed)
+        elapsed = time.perf_counter() - started
+        total = sum(counts.values())
+        print(f"Inserted {total} rows in {elapsed:.2f}s ({total / elapsed:.0f} rows/s): {counts}")
+    elif args.append:
+        num_sales = args.sales if args.sales is not None else int(args.houses * 0.8)
+        started = time.perf_counter()
+        counts = append_activity(engine, num_houses=args.houses, num_sales=num_sales, day=args.day, batch_size=args.batch_size,
+                                 seed=args.seed, progress=lambda table, done, total: print(f"{table}: {done}/{total}", flush=True))
+        print(f"Appended {counts} in {time.perf_counter() - started:.2f}s")
+    else:
+        insert_data(engine)
\ No newline at end of file
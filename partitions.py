@@ -0,0 +1,190 @@
+import argparse
+import datetime
+import os
+import sqlite3
+from create import Sale, DATABASE_URL, SALE_PARTITIONS, make_engine
+from sqlalchemy import Column, Index, MetaData, Table, case, delete, event, func, insert, select, union_all
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+# The sales of past years can be archived: they are moved out of the sale table into a database file of their own per year
+# (sale_2021.db, ...) in the partitions directory, which make_engine attaches to every connection as archive_2021, ... when
+# SALE_PARTITIONS is set. An archived year holds a sale table with the columns and indexes of the sale table, so it can be
+# copied, compacted (VACUUM), or moved to slower storage on its own, and the sale table that takes the writes stays small.
+#
+# The readers of a range of dates take their sales from sales_between, which reads the sale table and only the archived
+# years the range overlaps: the rollup (so every report of query.py), the percentiles of the days on the market, and the
+# commission batch. export.py and analytics.py read every partition with it as well.
+#
+# The sales of an archived year are written into its partition: insert.py does it for the sales it inserts in bulk, and
+# move_archived_sales for the sales added to a session (e.g. by insert.generate_sales), when it is flushed. Sales updated
+# or deleted through the ORM are only looked for in the sale table.
+#
+# The ids of the sales stay unique across the partitions: the sales inserted by insert.py, and the new sales of a session
+# without an id, take their ids after the largest one of every partition (SQLite would give the next sale of the sale
+# table the id after the largest one of the sale table only), and a year can't be archived while it holds the sale with
+# the largest id. A sale inserted with Core must be given an id the same way (see max_sale_id).
+#
+# SQLite attaches at most 10 databases to a connection, so at most 10 years can be archived. An engine attaches the
+# archived years when it opens a connection, so after archiving a year, the engines that are already running must be
+# disposed (or restarted) to read it.
+
+PARTITION_DIRECTORY = 'partitions'
+
+partition_tables = {}  # year -> the Table of the sales of an archived year
+
+
+def partition_path(directory, year):
+    """
+    Get the path of the database of an archived year.
+    """
+    return os.path.join(directory, f"sale_{year}.db")
+
+
+def partition_table(year):
+    """
+    Get the sale table of an archived year, which has the columns and indexes of the sale table (but no foreign keys, since
+    SQLite doesn't enforce them across databases).
+    """
+    if year not in partition_tables:
+        table = Table('sale', MetaData(), *[Column(column.name, column.type, primary_key=column.primary_key) for column in Sale.__table__.columns],
+                      schema=f"archive_{year}")
+        for index in Sale.__table__.indexes:
+            Index(index.name, *[table.c[column.name] for column in index.columns])
+        partition_tables[year] = table
+    return partition_tables[year]
+
+
+def archived_years(connection):
+    """
+    Get the archived years that are attached to a connection. They are recorded when the connection is made, so this
+    doesn't send a statement.
+
+    params connection: a connection or session
+    return: a set of int
+    """
+    if not isinstance(connection, Connection):
+        connection = connection.connection()
+    return connection.info.get('archived_years', set())
+
+
+def sales_between(connection, start_date=None, end_date=None):
+    """
+    Get the sales from start_date (included) to end_date (excluded), from the sale table and from the archived years that
+    the range overlaps. The date range is applied to every partition, so each one is searched with its sale_report_index.
+
+    params connection: a connection or session
+           start_date: the first date, or None for no limit: date object
+           end_date: the date after the last one, or None for no limit: date object
+    return: a subquery with the columns of the sale table
+    """
+    years = sorted(year for year in archived_years(connection) if (start_date is None or start_date.year <= year) and
+                   (end_date is None or datetime.date(year, 1, 1) < end_date))
+    statements = []
+    for table in [Sale.__table__] + [partition_table(year) for year in years]:
+        statement = select(table)
+        if start_date is not None:
+            statement = statement.where(table.c.date_of_sale >= start_date)
+        if end_date is not None:
+            statement = statement.where(table.c.date_of_sale < end_date)
+        statements.append(statement)
+    return (statements[0] if len(statements) == 1 else union_all(*statements)).subquery('sales')
+
+
+def max_sale_id(connection):
+    """
+    Get the largest id of a sale in any partition, or 0 if there is no sale.
+    """
+    tables = [Sale.__table__] + [partition_table(year) for year in archived_years(connection)]
+    return max(connection.execute(select(func.max(table.c.id))).scalar() or 0 for table in tables)
+
+
+@event.listens_for(Session, 'before_flush')
+def place_new_sales(session, flush_context, instances):
+    """
+    When years are archived, give the new sales of a flush that have no id the ids after the largest one of every partition,
+    and remember the ones of an archived year, for move_archived_sales to move into their partition once they are flushed.
+    """
+    # what a flush that failed left behind
+    session.info.pop('archived_sales', None)
+    new_sales = [obj for obj in session.new if isinstance(obj, Sale)]
+    years = archived_years(session) if new_sales else set()
+    if not years:
+        return
+
+    next_id = max([max_sale_id(session)] + [sale.id for sale in new_sales if sale.id is not None]) + 1
+    for sale in new_sales:
+        if sale.id is None:
+            sale.id, next_id = next_id, next_id + 1
+
+    archived = [sale for sale in new_sales if sale.date_of_sale is not None and sale.date_of_sale.year in years]
+    if archived:
+        session.info['archived_sales'] = archived
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def move_archived_sales(session, flush_context):
+    """
+    Move the new sales of an archived year out of the sale table into their partition, and out of the session.
+    They are moved after the flush, so their foreign keys are filled in from the objects they were given (e.g. agent=Agent(...)),
+    and the rollup and the cache have seen them as new sales of their month.
+    """
+    for sale in session.info.pop('archived_sales', []):
+        in_sale = Sale.__table__.c.id == sale.id
+        session.execute(insert(partition_table(sale.date_of_sale.year)).from_select(
+            [column.name for column in Sale.__table__.columns], select(Sale.__table__).where(in_sale)))
+        session.execute(delete(Sale.__table__).where(in_sale))
+        session.expunge(sale)
+
+
+def archive_year(year, url=DATABASE_URL, directory=SALE_PARTITIONS or PARTITION_DIRECTORY):
+    """
+    Move the sales of a year out of the sale table into the database of the year, in one transaction.
+    The rollup only finds the sales inserted in bulk in the sale table, so the months of the year are refreshed from the
+    partition in the same transaction. Running it again for the same year moves the sales of that year inserted in the
+    sale table since.
+    The engines that read the sales must attach the same directory (make_engine's partitions, SALE_PARTITIONS by default).
+
+    params year: the year to archive: int
+           url: the database URL: str
+           directory: the partitions directory: str
+    return: the number of sales moved: int
+    """
+    os.makedirs(directory, exist_ok=True)
+    # the file must exist for the engine to attach it
+    sqlite3.connect(partition_path(directory, year)).close()
+
+    engine = make_engine(url, partitions=directory)
+    try:
+        with engine.begin() as connection:
+            in_year = (Sale.date_of_sale >= datetime.date(year, 1, 1)) & (Sale.date_of_sale < datetime.date(year + 1, 1, 1))
+            last_in_year, last_outside = connection.execute(select(func.max(case((in_year, Sale.id))), func.max(case((~in_year, Sale.id))))).one()
+            if last_in_year is None:
+                return 0
+            if last_outside is None or last_in_year > last_outside:
+                raise ValueError(f"{year} holds the sale with the largest id, which would be given again to the next sale, so it can't be archived.")
+
+            table = partition_table(year)
+            table.create(connection, checkfirst=True)
+            connection.execute(insert(table).from_select([column.name for column in Sale.__table__.columns],
+                                                         select(Sale.__table__).where(in_year)))
+            moved = connection.execute(delete(Sale.__table__).where(in_year)).rowcount
+
+            # rollup.py imports this module
+            from rollup import refresh_months
+            refresh_months(connection, {(year, month) for month in range(1, 13)})
+            return moved
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move the sales of past years out of the sale table into a database per year.')
+    parser.add_argument('years', type=int, nargs='+', help='the years to archive, e.g. 2021 2022')
+    parser.add_argument('--directory', default=SALE_PARTITIONS or PARTITION_DIRECTORY, help='the partitions directory')
+    parser.add_argument('--database', default=DATABASE_URL)
+    args = parser.parse_args()
+
+    for year in args.years:
+        print(f"Moved {archive_year(year, args.database, args.directory)} sales of {year} to {partition_path(args.directory, year)}.")
+    print(f"Set SALE_PARTITIONS={args.directory} for the reports to read them.")
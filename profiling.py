@@ -0,0 +1,186 @@
+import atexit
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Opt-in profiling of the statements the reports send to the database.
+#
+# When it is enabled, every statement executed by any engine is timed with the before/after_cursor_execute events, and
+# its latency, the number of times it ran, and its rows (fetched or changed) are added up per statement and per report function
+# (the innermost function decorated with profiled_report that is running). Statements slower than the threshold are
+# logged to the 'profiling' logger. When it is disabled, no event listener is registered, so the statements cost nothing
+# extra, and a decorated report only checks a flag.
+#
+# It is configured with environment variables:
+#   QUERY_PROFILE: set it to 1 to enable the profiler and print a summary to stderr when the program exits
+#   QUERY_PROFILE_SLOW_MS: the latency in milliseconds above which a statement is logged as slow (default 100)
+
+logger = logging.getLogger('profiling')
+
+
+class QueryProfiler:
+    """
+    Collects the latency, call count, and row count of the statements, per statement and per report function.
+    """
+
+    def __init__(self, slow_ms=100):
+        """
+        params slow_ms: the latency in milliseconds above which a statement is logged as slow: float
+        """
+        self.slow_seconds = slow_ms / 1000
+        self.enabled = False
+        self.current_report = contextvars.ContextVar('current_report', default=None)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything that was collected.
+        """
+        self.statements = {}
+        self.reports = {}
+        self.slow_queries = 0
+
+    def enable(self):
+        """
+        Start timing the statements of every engine.
+        """
+        if not self.enabled:
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+            self.enabled = True
+
+    def disable(self):
+        """
+        Stop timing the statements. What was collected is kept.
+        """
+        if self.enabled:
+            event.remove(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.remove(Engine, 'after_cursor_execute', self.after_cursor_execute)
+            self.enabled = False
+
+    def stats_of(self, statement, report):
+        """
+        Get the counters of a statement and of the report that sends it, creating them the first time.
+        """
+        with self.lock:
+            stats = self.statements.setdefault(statement, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows': 0})
+            report_stats = self.reports.get(report)
+        return stats, report_stats
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        if hasattr(cursor, 'row_factory'):
+            # the sqlite3 driver doesn't count the rows of a SELECT, so they are counted as they are fetched
+            stats, report_stats = self.stats_of(statement, self.current_report.get())
+
+            def count_row(cursor, row):
+                # the counters are shared by the statements of every thread
+                with self.lock:
+                    stats['rows'] += 1
+                    if report_stats is not None:
+                        report_stats['rows'] += 1
+                return row
+
+            cursor.row_factory = count_row
+        connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        started = connection.info.get('query_started')
+        if not started:
+            return  # the profiler was enabled while the statement ran
+        elapsed = time.perf_counter() - started.pop()
+        # the rows changed by an INSERT, UPDATE, or DELETE. a SELECT has a rowcount of -1, and its rows are counted by count_row
+        rows = max(cursor.rowcount, 0)
+        report = self.current_report.get()
+        stats, report_stats = self.stats_of(statement, report)
+
+        with self.lock:
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            stats['rows'] += rows
+            if report_stats is not None:
+                report_stats['statements'] += 1
+                report_stats['statement_seconds'] += elapsed
+                report_stats['rows'] += rows
+            if elapsed >= self.slow_seconds:
+                self.slow_queries += 1
+
+        if elapsed >= self.slow_seconds:
+            logger.warning("slow query (%.1f ms) in %s: %s %r", elapsed * 1000, report or 'no report', ' '.join(statement.split()),
+                           parameters)
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        """
+        Count a call of a report, and attribute the statements it sends to it.
+
+        params name: the name of the report: str
+        """
+        with self.lock:
+            self.reports.setdefault(name, {'calls': 0, 'seconds': 0.0, 'statements': 0, 'statement_seconds': 0.0, 'rows': 0})
+        token = self.current_report.set(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.current_report.reset(token)
+            with self.lock:
+                self.reports[name]['calls'] += 1
+                self.reports[name]['seconds'] += elapsed
+
+    def summary(self, top=10):
+        """
+        Get a summary of what was collected: every report, and the statements that took the most time in total.
+
+        params top: the number of statements to show: int
+        return: str
+        """
+        with self.lock:
+            reports = sorted(self.reports.items(), key=lambda item: item[1]['seconds'], reverse=True)
+            statements = sorted(self.statements.items(), key=lambda item: item[1]['seconds'], reverse=True)[:top]
+            slow_queries = self.slow_queries
+
+        lines = [f"{'report':<34} {'calls':>7} {'total ms':>10} {'statements':>11} {'per call':>9} {'query ms':>10} {'rows':>9}"]
+        for name, stats in reports:
+            lines.append(f"{name:<34} {stats['calls']:>7} {stats['seconds'] * 1000:>10.1f} {stats['statements']:>11} "
+                         f"{stats['statements'] / max(stats['calls'], 1):>9.1f} {stats['statement_seconds'] * 1000:>10.1f} {stats['rows']:>9}")
+        lines.append('')
+        lines.append(f"{'calls':>7} {'total ms':>10} {'max ms':>9} {'rows':>9}  statement")
+        for statement, stats in statements:
+            lines.append(f"{stats['calls']:>7} {stats['seconds'] * 1000:>10.1f} {stats['max_seconds'] * 1000:>9.1f} {stats['rows']:>9}  "
+                         f"{' '.join(statement.split())[:120]}")
+        lines.append('')
+        lines.append(f"{slow_queries} statement(s) took more than {self.slow_seconds * 1000:.0f} ms.")
+        return '\n'.join(lines)
+
+
+profiler = QueryProfiler(slow_ms=float(os.environ.get('QUERY_PROFILE_SLOW_MS', 100)))
+
+if os.environ.get('QUERY_PROFILE', '0') not in ('', '0'):
+    logging.basicConfig()
+    profiler.enable()
+    atexit.register(lambda: print(profiler.summary(), file=sys.stderr))
+
+
+def profiled_report(report):
+    """
+    Attribute the statements of a report function to it in the profiler, and count its calls and time.
+    When the profiler is disabled, the report is called directly.
+    """
+    @functools.wraps(report)
+    def wrapper(*args, **kwargs):
+        if not profiler.enabled:
+            return report(*args, **kwargs)
+        with profiler.profile(report.__name__):
+            return report(*args, **kwargs)
+
+    return wrapper
@@ -1,150 +1,659 @@
-from create import Sale, House, Agent, Office, MonthlyCommission
-from sqlalchemy import create_engine, desc, func
-from sqlalchemy.orm import sessionmaker
-from collections import defaultdict
+from create import Sale, House, Agent, Office, MonthlyCommission, MonthlySalesRollup, PRICE_PLACES, COMMISSION_PLACES, engine, money_units, \
+    to_money
+from rollup import refresh_rollup
+from cache import cached_report
+from profiling import profiled_report
+from snapshot import snapshot_router
+from partitions import sales_between
+from sqlalchemy import desc, func, and_, case, select, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import scoped_session, sessionmaker
+import datetime
+from dataclasses import dataclass, field
+from decimal import Decimal
 
-engine = create_engine('sqlite:///real_estate.db')
-Session = sessionmaker(bind=engine)
-session = Session()
+# Each thread gets its own session (and connection) when it calls a report, instead of the whole process sharing one.
+# Whoever handles a request should call Session.remove() when it is done, to close the session and give its connection back to the pool.
+Session = scoped_session(sessionmaker(bind=engine))
 
 
-def get_top_five_offices(month, year):
+def report_session():
+    """
+    Get the session the reports should read from: the latest read-only snapshot of the database when the reports are routed
+    to the snapshots (see snapshot.py) and it isn't too stale, so they don't compete with the writers, and Session otherwise.
+
+    return: a scoped session
+    """
+    return snapshot_router.session() or Session
+
+
+@dataclass
+class OfficeSales:
+    """
+    The number of houses an office sold in a month and the revenue they generated.
+    """
+    office_id: int
+    email: str
+    address: str
+    num_sales: int
+    total_revenue: Decimal
+
+
+@dataclass
+class AgentSales:
+    """
+    The number of houses an agent sold in a month and the revenue they generated.
+    """
+    agent_id: int
+    name: str
+    email: str
+    num_sales: int
+    total_revenue: Decimal
+
+
+@dataclass
+class DaysOnMarket:
+    """
+    The days on the market for the houses sold in a month.
+    average is None when no houses were sold. percentiles maps each requested percentile (e.g. 0.9) to its number of days.
+    """
+    average: float
+    num_sales: int
+    percentiles: dict = field(default_factory=dict)
+
+
+@dataclass
+class MonthlyReport:
+    """
+    Every report of one month: the top offices and agents, the average selling price, the average days on the market,
+    and the commission of each agent. The averages are None when no houses were sold.
+    """
+    month: str
+    year: str
+    top_offices: list = field(default_factory=list)
+    top_agents: list = field(default_factory=list)
+    average_price: Decimal = None
+    average_days_on_market: float = None
+    commissions: dict = field(default_factory=dict)
+
+
+MONTHS = ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']
+
+
+def month_window(month, year):
+    """
+    Turn a month number and a year into a half-open date range [first day of the month, first day of the next month).
+
+    params month: The month number: str
+           year: The year: str
+    return: (start_date, end_date): a tuple of date objects
+    """
+    if month not in MONTHS:
+        raise ValueError("The month number must be a string of two digits between '01' and '12'.")
+
+    start_date = datetime.date(int(year), int(month), 1)
+    if start_date.month == 12:
+        end_date = datetime.date(start_date.year + 1, 1, 1)
+    else:
+        end_date = datetime.date(start_date.year, start_date.month + 1, 1)
+
+    return start_date, end_date
+
+
+def rollup_in_month(month, year):
+    """
+    Get the filter that keeps only the rollup rows of the given month and year.
+
+    params month: The month number: str
+           year: The year: str
+    return: a SQLAlchemy filter expression
+    """
+    month_window(month, year)  # make sure the month is valid
+    return and_(MonthlySalesRollup.year == int(year), MonthlySalesRollup.month == int(month))
+
+
+# The sums of money of the rollup rows are added up as integers (see create.PRICE_PLACES), so the reports are exact:
+# every total of the rollup is a whole number of cents (or units of the commission), which money_units recovers.
+
+def average_money(units, count, places=PRICE_PLACES):
+    """
+    Get the average of count values whose sum is units units of money, or None if none of them has a price or count is 0.
+
+    params units: the sum, in units of 10 ** -places: int
+           count: the number of values: int
+    return: a Decimal, or None
+    """
+    return None if units is None or not count else to_money(units, places) / count
+
+
+def report_month(arguments):
+    """
+    Get the month a single month report covers, for the report cache.
+    """
+    return [(arguments['month'], arguments['year'])]
+
+
+def report_months(arguments):
+    """
+    Get the months a report over a range of months covers, for the report cache.
+    """
+    return months_in_range(arguments['start'], arguments['end'])
+
+
+def explain_query_plan(session, statement):
+    """
+    Get the plan SQLite picks for a statement, one line per step (e.g. "SEARCH sale USING INDEX sale_report_index ...").
+
+    params session: the database session
+           statement: a Query or a select() statement
+    return: a list of str
+    """
+    statement = getattr(statement, 'statement', statement)
+    compiled = statement.compile(dialect=session.get_bind().dialect)
+    params = tuple(compiled.params[name].isoformat() if isinstance(compiled.params[name], datetime.date)
+                   else compiled.params[name] for name in compiled.positiontup)
+    rows = session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).all()
+    return [row[-1] for row in rows]
+
+
+@profiled_report
+@cached_report(report_month)
+def compute_top_five_offices(session, month, year):
+    """
+    Compute the top five offices with the most sales for the month, ordered by the number of sales and then by id.
+    The counts come from the monthly rollup, and the office details are joined into the grouped query, so it takes a single query.
+    The results are cached in report_cache.
+
+    params session: the database session
+           month: The month number to get the top five offices for: str
+           year: The year to get the top five offices for: str
+    return: a list of OfficeSales objects
+    """
+    refresh_rollup(session)
+
+    # take the month and year into account
+    sales = session.query(MonthlySalesRollup.office_id, func.sum(MonthlySalesRollup.num_sales).label('total_num_sales'), func.sum(
+        money_units(MonthlySalesRollup.total_revenue, PRICE_PLACES)).label('total_revenue')).filter(rollup_in_month(month, year)).group_by(
+        MonthlySalesRollup.office_id).order_by(desc('total_num_sales'), MonthlySalesRollup.office_id).limit(5).subquery()
+    result = session.query(sales, Office.email, Office.address).join(Office, Office.id == sales.c.office_id).order_by(
+        desc(sales.c.total_num_sales), sales.c.office_id).all()
+
+    return [OfficeSales(office_id=res.office_id, email=res.email, address=res.address, num_sales=res.total_num_sales,
+                        total_revenue=to_money(res.total_revenue, PRICE_PLACES)) for res in result]
+
+
+@profiled_report
+def get_top_five_offices(month, year, session=Session):
     """
     Get the top five offices with the most sales for the month number.
     It orders it by the number of sales, not by the revenue generated. But the revenue is also printed for the top five offices.
+    Offices with the same number of sales are ordered by id.
 
     params month: The month number to get the top five offices for: str
            year: The year to get the top five offices for: str
-    return: None
+           session: the database session
+    return: a list of OfficeSales objects
     """
-    if month not in ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']:
-        raise ValueError("The month number must be a string of two digits between '01' and '12'.")
-    
-    # take the month and year into account
-    result = session.query(Sale.office_id, func.count(Sale.id).label('total_num_sales'), func.sum(Sale.sale_price).label(
-        'total_revenue')).filter(func.strftime("%m", Sale.date_of_sale) == month).filter(
-        func.strftime("%Y", Sale.date_of_sale) == year).group_by(
-        Sale.office_id).order_by(desc('total_num_sales')).limit(5).all()
-    
-    for i, res in enumerate(result):
-        # get the office object
-        office = session.query(Office).filter(Office.id == res.office_id).first()
+    offices = compute_top_five_offices(session, month, year)
+
+    for i, office in enumerate(offices):
         # print the office id, number of houses sold, and revenue generated
-        print(f"{i+1}. Office {office.id} has sold {res.total_num_sales} houses in {month}, {year} and generated ${round(res.total_revenue, 2)} in revenue.")
+        print(f"{i+1}. Office {office.office_id} has sold {office.num_sales} houses in {month}, {year} and generated ${round(office.total_revenue, 2)} in revenue.")
+
+    return offices
 
-    
 
-def get_top_five_agents(month, year):
+@profiled_report
+@cached_report(report_month)
+def compute_top_five_agents(session, month, year):
+    """
+    Compute the top five agents with the most sales for the month, ordered by the number of sales and then by id.
+    The counts come from the monthly rollup, and the agent's name and email are joined into the grouped query, so it takes a single query.
+    The results are cached in report_cache.
+
+    params session: the database session
+           month: The month number to get the top five agents for: str
+           year: The year to get the top five agents for: str
+    return: a list of AgentSales objects
+    """
+    refresh_rollup(session)
+
+    # get top five agents for the given month number and year
+    sales = session.query(MonthlySalesRollup.agent_id, func.sum(MonthlySalesRollup.num_sales).label('total_num_sales'), func.sum(
+        money_units(MonthlySalesRollup.total_revenue, PRICE_PLACES)).label('total_revenue')).filter(rollup_in_month(month, year)).group_by(
+        MonthlySalesRollup.agent_id).order_by(desc('total_num_sales'), MonthlySalesRollup.agent_id).limit(5).subquery()
+    result = session.query(sales, Agent.name, Agent.email).join(Agent, Agent.id == sales.c.agent_id).order_by(
+        desc(sales.c.total_num_sales), sales.c.agent_id).all()
+
+    return [AgentSales(agent_id=res.agent_id, name=res.name, email=res.email, num_sales=res.total_num_sales,
+                       total_revenue=to_money(res.total_revenue, PRICE_PLACES)) for res in result]
+
+
+@profiled_report
+def get_top_five_agents(month, year, session=Session):
     """
     Get the top five agents with the most sales for the month number.
     It orders it by the number of sales, not by the revenue generated. But the revenue is also printed for the top five agents.
+    Agents with the same number of sales are ordered by id.
 
     params month: The month number to get the top five agents for: str
            year: The year to get the top five agents for: str
+           session: the database session
+    return: a list of AgentSales objects
+    """
+    agents = compute_top_five_agents(session, month, year)
+
+    for i, agent in enumerate(agents):
+        # print the agent name, number of houses sold, and revenue generated
+        print(f"{i+1}. {agent.name} ({agent.email}), Houses sold: {agent.num_sales}, Revenue generated: ${round(agent.total_revenue, 2)} in {month}, {year}.")
+
+    return agents
+
+
+@profiled_report
+def compute_commissions(session, month, year):
+    """
+    Compute the total commission of each agent for the month in a single grouped query over the monthly rollup.
+
+    params session: the database session
+           month: The month number to compute the commissions for: str
+           year: The year to compute the commissions for: str
+    return: a dictionary of agent_id -> total commission
+    """
+    refresh_rollup(session)
+
+    result = session.query(MonthlySalesRollup.agent_id, func.sum(money_units(MonthlySalesRollup.total_commission, COMMISSION_PLACES)).label(
+        'total_commission')).filter(rollup_in_month(month, year)).group_by(MonthlySalesRollup.agent_id).order_by(MonthlySalesRollup.agent_id).all()
+
+    return {res.agent_id: to_money(res.total_commission, COMMISSION_PLACES) for res in result}
+
+
+def store_commissions(session, month, year, commissions):
+    """
+    Store the commissions of a month in the MonthlyCommission table in one transaction.
+
+    params session: the database session
+           month: The month number of the commissions: str
+           year: The year of the commissions: str
+           commissions: a dictionary of agent_id -> total commission
     return: None
     """
-    if month not in ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']:
-        raise ValueError("The month number must be a string of two digits between '01' and '12'.")
-    
-    # get top five agents for the given month number and year
-    result = session.query(Sale.agent_id, func.count(Sale.id).label('total_num_sales'), func.sum(Sale.sale_price).label(
-        'total_revenue')).filter(func.strftime("%m", Sale.date_of_sale) == month).filter(
-        func.strftime("%Y", Sale.date_of_sale) == year).group_by(
-        Sale.agent_id).order_by(desc('total_num_sales')).limit(5).all()
-
-    
-    for i, res in enumerate(result):
-        # get the agent object
-        agent = session.query(Agent).filter(Agent.id == res.agent_id).first()
-        # print the agent id, number of houses sold, and revenue generated
-        print(f"{i+1}. {agent.name} ({agent.email}), Houses sold: {res.total_num_sales}, Revenue generated: ${round(res.total_revenue, 2)} in {month}, {year}.")
-        
+    store_commissions_by_month(session, {(month, year): commissions})
+
+
+def store_commissions_by_month(session, commissions_by_month):
+    """
+    Store the commissions of several months in the MonthlyCommission table in one transaction.
+    They are written with a single INSERT ... ON CONFLICT DO UPDATE on the (agent, year, month) key, so running a month again
+    updates its rows instead of duplicating them. Agents that no longer have a commission for their month are removed.
+    The commission of the sales without an agent (the None key) is not stored, since no agent receives it.
+
+    params session: the database session
+           commissions_by_month: a dictionary of (month, year) -> a dictionary of agent_id -> total commission
+    return: None
+    """
+    rows = []
+    for (month, year), commissions in commissions_by_month.items():
+        # a NULL in NOT IN would make it NULL for every row, and a NULL agent_id isn't unique in the key
+        commissions = {agent_id: total_commission for agent_id, total_commission in commissions.items() if agent_id is not None}
+        session.query(MonthlyCommission).filter(MonthlyCommission.month == int(month), MonthlyCommission.year == int(year),
+                                                MonthlyCommission.agent_id.notin_(list(commissions)) | MonthlyCommission.agent_id.is_(None)).delete(
+            synchronize_session=False)
+        rows.extend({'agent_id': agent_id, 'month': int(month), 'year': int(year), 'total_commission': total_commission}
+                    for agent_id, total_commission in commissions.items())
+    if rows:
+        statement = sqlite_insert(MonthlyCommission)
+        statement = statement.on_conflict_do_update(index_elements=['agent_id', 'year', 'month'],
+                                                    set_={'total_commission': statement.excluded.total_commission})
+        session.execute(statement, rows)
+    session.commit()
+
 
 # Calculate the commission that each estate agent must receive and store the results in a separate table.
-def get_commision_for_each_agent(month, year):
+@profiled_report
+def get_commision_for_each_agent(month, year, session=Session):
     """
     Get the commission for each agent for the month number.
 
     params month: The month number to get the commission for each agent for: str
            year: The year to get the commission for each agent for: str
-    return: None
+           session: the database session
+    return: a dictionary of agent_id -> total commission
     """
-    if month not in ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']:
-        raise ValueError("The month number must be a string of two digits between '01' and '12'.")
-    
-    # get the sales for the given month number and year
-    result = session.query(Sale).filter(func.strftime("%m", Sale.date_of_sale) == month).filter(
-        func.strftime("%Y", Sale.date_of_sale) == year).all()
-    
-    agents = defaultdict(int)
-    for sale in result:
-        agents[sale.agent_id] += sale.agent_commission
-
-    # print and store the results in a separate table
-    for agent_id, total_commission in agents.items():
-        monthly_commission = MonthlyCommission(agent_id=agent_id, month=int(month), year=int(year), total_commission=total_commission)
-        session.add(monthly_commission)
-        session.commit()
+    commissions = compute_commissions(session, month, year)
 
+    # store the results in a separate table and print them
+    store_commissions(session, month, year, commissions)
+    for agent_id, total_commission in commissions.items():
         print(f"Agent {agent_id} has earned ${round(total_commission, 2)} in commission for {month}, {year}.")
 
+    return commissions
+
+@profiled_report
+@cached_report(report_month)
+def compute_days_on_market(session, month, year, percentiles=()):
+    """
+    Compute the days on the market for all houses that were sold that month.
+    The average comes from the monthly rollup. The percentiles need every sale, so the sales are joined with their houses
+    and the database computes everything in a single query. The results are cached in report_cache.
+
+    params session: the database session
+           month: The month number to get the days on the market for: str
+           year: The year to get the days on the market for: str
+           percentiles: The percentiles of days on the market to compute as well, e.g. (0.5, 0.9) for the median and p90: tuple of float
+    return: a DaysOnMarket object
+    """
+    if percentiles:
+        # the number of days on the market is the difference between the date of sale and the date of listing.
+        # the sales of the month come from the sale table, and from the archived year of the month if there is one
+        sales = sales_between(session, *month_window(month, year))
+        days = (func.julianday(sales.c.date_of_sale) - func.julianday(House.date_of_listing)).label('days')
+
+        # rank the sales by their days on the market; the nearest-rank percentile p is the first rank that reaches p * the number of sales
+        ranked = select(days, func.row_number().over(order_by=days).label('rank'), func.count().over().label('num_sales')).select_from(
+            sales).join(House, House.id == sales.c.house_id).subquery()
+        result = session.query(func.avg(ranked.c.days), func.count(), *[
+            func.min(case((ranked.c.rank >= percentile * ranked.c.num_sales, ranked.c.days))) for percentile in percentiles]).one()
+    else:
+        refresh_rollup(session)
+        result = session.query(func.sum(MonthlySalesRollup.total_days_on_market) / func.sum(MonthlySalesRollup.num_sales_with_listing),
+                               func.coalesce(func.sum(MonthlySalesRollup.num_sales_with_listing), 0)).filter(rollup_in_month(month, year)).one()
+
+    return DaysOnMarket(average=result[0], num_sales=result[1], percentiles=dict(zip(percentiles, result[2:])))
+
+
 # For all houses that were sold that month, calculate the average number of days on the market.
-def average_number_of_days(month, year):
+@profiled_report
+def average_number_of_days(month, year, percentiles=(), session=Session):
     """
     Get the average number of days on the market for all houses that were sold that month.
 
     params month: The month number to get the average number of days on the market for: str
            year: The year to get the average number of days on the market for: str
-    return: None
+           percentiles: The percentiles of days on the market to compute as well, e.g. (0.5, 0.9) for the median and p90: tuple of float
+           session: the database session
+    return: a DaysOnMarket object
     """
-    if month not in ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']:
-        raise ValueError("The month number must be a string of two digits between '01' and '12'.")
-    
-    # get the sales for the given month number and year
-    result = session.query(Sale).filter(func.strftime("%m", Sale.date_of_sale) == month).filter(
-        func.strftime("%Y", Sale.date_of_sale) == year).all()
-    
-    total_days = 0
-    for sale in result:
-        # get the house object
-        house = session.query(House).filter(House.id == sale.house_id).first()
-        # get the number of days on the market by taking the difference between the date of listing and the date of sale
-        number_of_days_on_market = sale.date_of_sale - house.date_of_listing
-        total_days += number_of_days_on_market.days
-    
+    days_on_market = compute_days_on_market(session, month, year, percentiles)
+
     # print the average number of days on the market
-    print(f"Average number of days on the market for {month}, {year} is {round(total_days / len(result), 2)} days.")
+    if not days_on_market.num_sales:
+        print(f"No houses were sold in {month}, {year}.")
+        return days_on_market
+
+    print(f"Average number of days on the market for {month}, {year} is {round(days_on_market.average, 2)} days.")
+    for percentile, percentile_days in days_on_market.percentiles.items():
+        print(f"{round(percentile * 100)}th percentile of days on the market for {month}, {year} is {round(percentile_days, 2)} days.")
+
+    return days_on_market
+
+
+@profiled_report
+@cached_report(report_month)
+def compute_average_selling_price(session, month, year):
+    """
+    Compute the average selling price for all houses that were sold that month, from the monthly rollup.
+    The results are cached in report_cache.
+
+    params session: the database session
+           month: The month number to get the average selling price for: str
+           year: The year to get the average selling price for: str
+    return: the average selling price, or None if no houses were sold
+    """
+    refresh_rollup(session)
+
+    revenue, num_sales = session.query(func.sum(money_units(MonthlySalesRollup.total_revenue, PRICE_PLACES)),
+                                       func.sum(MonthlySalesRollup.num_sales)).filter(rollup_in_month(month, year)).one()
+    return average_money(revenue, num_sales)
+
 
 # For all houses that were sold that month, calculate the average selling price
-def average_selling_price(month, year):
+@profiled_report
+def average_selling_price(month, year, session=Session):
     """
     Get the average selling price for all houses that were sold that month.
 
     params month: The month number to get the average selling price for: str
            year: The year to get the average selling price for: str
-    return: None
+           session: the database session
+    return: the average selling price, or None if no houses were sold
     """
-    if month not in ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']:
-        raise ValueError("The month number must be a string of two digits between '01' and '12'.")
-    
-    query = session.query(func.avg(Sale.sale_price)).filter(func.strftime("%m", Sale.date_of_sale) == month).filter(
-        func.strftime("%Y", Sale.date_of_sale) == year).all()
-    
-    # get the average selling price from the query
-    average_price = query[0][0]
-
-    
+    average_price = compute_average_selling_price(session, month, year)
+
     # print the average selling price
-    print(f"Average selling price for {month}, {year} is ${round(average_price, 2)}.")
+    if average_price is None:
+        print(f"No houses were sold in {month}, {year}.")
+    else:
+        print(f"Average selling price for {month}, {year} is ${round(average_price, 2)}.")
+
+    return average_price
+
+
+# Reports over a range of months
+# Each of these runs one grouped query over the monthly rollup for the whole range, instead of one query per month,
+# and their results are cached in report_cache.
+# The periods are (month, year) tuples like ('01', '2023'), and the results are keyed by them.
+
+def months_in_range(start, end):
+    """
+    Get every month from start to end, both included.
+
+    params start: The first month: (str, str)
+           end: The last month: (str, str)
+    return: a list of (month, year) tuples of str
+    """
+    start_date, _ = month_window(*start)
+    end_date, _ = month_window(*end)
+    if start_date > end_date:
+        raise ValueError("The start of the range must not be after its end.")
+
+    months = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append((f"{month:02d}", str(year)))
+        year, month = year + month // 12, month % 12 + 1
+    return months
+
+
+def rollup_in_range(start, end):
+    """
+    Get the filter that keeps only the rollup rows from the start month to the end month.
+    The (year, month) row values are compared directly, so SQLite can use the rollup's index.
+
+    params start: The first month: (str, str)
+           end: The last month: (str, str)
+    return: a SQLAlchemy filter expression
+    """
+    months = months_in_range(start, end)
+    (first_month, first_year), (last_month, last_year) = months[0], months[-1]
+    period = tuple_(MonthlySalesRollup.year, MonthlySalesRollup.month)
+    return and_(period >= (int(first_year), int(first_month)), period <= (int(last_year), int(last_month)))
+
+
+def top_n_by_month(session, column, start, end, n):
+    """
+    Get a query of the n rollup groups of column (office_id or agent_id) with the most sales in every month of the range.
+    The groups are ranked with ROW_NUMBER over each month, so every month is ranked in the same query. Ties are ordered by id,
+    like in the single month reports.
+
+    params session: the database session
+           column: MonthlySalesRollup.office_id or MonthlySalesRollup.agent_id
+           start: The first month: (str, str)
+           end: The last month: (str, str)
+           n: The number of groups to keep per month: int
+    return: a subquery with the year, month, id, total_num_sales, total_revenue (in cents), and rank columns
+    """
+    grouped = select(MonthlySalesRollup.year, MonthlySalesRollup.month, column.label('id'),
+                     func.sum(MonthlySalesRollup.num_sales).label('total_num_sales'),
+                     func.sum(money_units(MonthlySalesRollup.total_revenue, PRICE_PLACES)).label('total_revenue')).where(rollup_in_range(start, end)).group_by(
+        MonthlySalesRollup.year, MonthlySalesRollup.month, column).subquery()
+    ranked = select(grouped, func.row_number().over(partition_by=(grouped.c.year, grouped.c.month),
+                                                    order_by=(desc(grouped.c.total_num_sales), grouped.c.id)).label('rank')).subquery()
+    return select(ranked).where(ranked.c.rank <= n).subquery()
+
+
+@profiled_report
+@cached_report(report_months)
+def get_top_offices_by_month(start, end, n=5, session=Session):
+    """
+    Get the top n offices with the most sales for every month from start to end.
+
+    params start: The first month: (str, str)
+           end: The last month: (str, str)
+           n: The number of offices per month: int
+           session: the database session
+    return: a dictionary of (month, year) -> list of OfficeSales objects
+    """
+    refresh_rollup(session)
+
+    top = top_n_by_month(session, MonthlySalesRollup.office_id, start, end, n)
+    result = session.query(top, Office.email, Office.address).join(Office, Office.id == top.c.id).order_by(
+        top.c.year, top.c.month, top.c.rank).all()
+
+    offices = {period: [] for period in months_in_range(start, end)}
+    for res in result:
+        offices[(f"{res.month:02d}", str(res.year))].append(OfficeSales(
+            office_id=res.id, email=res.email, address=res.address, num_sales=res.total_num_sales,
+            total_revenue=to_money(res.total_revenue, PRICE_PLACES)))
+    return offices
+
+
+@profiled_report
+@cached_report(report_months)
+def get_top_agents_by_month(start, end, n=5, session=Session):
+    """
+    Get the top n agents with the most sales for every month from start to end.
+
+    params start: The first month: (str, str)
+           end: The last month: (str, str)
+           n: The number of agents per month: int
+           session: the database session
+    return: a dictionary of (month, year) -> list of AgentSales objects
+    """
+    refresh_rollup(session)
+
+    top = top_n_by_month(session, MonthlySalesRollup.agent_id, start, end, n)
+    result = session.query(top, Agent.name, Agent.email).join(Agent, Agent.id == top.c.id).order_by(
+        top.c.year, top.c.month, top.c.rank).all()
+
+    agents = {period: [] for period in months_in_range(start, end)}
+    for res in result:
+        agents[(f"{res.month:02d}", str(res.year))].append(AgentSales(
+            agent_id=res.id, name=res.name, email=res.email, num_sales=res.total_num_sales,
+            total_revenue=to_money(res.total_revenue, PRICE_PLACES)))
+    return agents
+
+
+def monthly_totals(session, start, end, *columns):
+    """
+    Run one query that groups the rollup by month and computes the given columns for every month from start to end.
+
+    params session: the database session
+           start: The first month: (str, str)
+           end: The last month: (str, str)
+           columns: the aggregates to compute
+    return: a dictionary of (month, year) -> row of the aggregates
+    """
+    result = session.query(MonthlySalesRollup.year, MonthlySalesRollup.month, *columns).filter(rollup_in_range(start, end)).group_by(
+        MonthlySalesRollup.year, MonthlySalesRollup.month).all()
+    return {(f"{res[1]:02d}", str(res[0])): res[2:] for res in result}
+
+
+@profiled_report
+@cached_report(report_months)
+def average_selling_price_by_month(start, end, session=Session):
+    """
+    Get the average selling price of every month from start to end.
+
+    params start: The first month: (str, str)
+           end: The last month: (str, str)
+           session: the database session
+    return: a dictionary of (month, year) -> average selling price, or None if no houses were sold
+    """
+    refresh_rollup(session)
+
+    totals = monthly_totals(session, start, end, func.sum(money_units(MonthlySalesRollup.total_revenue, PRICE_PLACES)),
+                            func.sum(MonthlySalesRollup.num_sales))
+    return {period: average_money(*totals[period]) if period in totals else None for period in months_in_range(start, end)}
+
+
+@profiled_report
+@cached_report(report_months)
+def average_number_of_days_by_month(start, end, session=Session):
+    """
+    Get the average number of days on the market of the houses sold in every month from start to end.
+
+    params start: The first month: (str, str)
+           end: The last month: (str, str)
+           session: the database session
+    return: a dictionary of (month, year) -> average number of days, or None if no houses were sold
+    """
+    refresh_rollup(session)
+
+    totals = monthly_totals(session, start, end, func.sum(MonthlySalesRollup.total_days_on_market) / func.sum(
+        MonthlySalesRollup.num_sales_with_listing))
+    return {period: totals[period][0] if period in totals else None for period in months_in_range(start, end)}
+
+
+@profiled_report
+@cached_report(report_months)
+def commissions_by_month(start, end, session=Session):
+    """
+    Get the total commission of each agent for every month from start to end.
+
+    params start: The first month: (str, str)
+           end: The last month: (str, str)
+           session: the database session
+    return: a dictionary of (month, year) -> dictionary of agent_id -> total commission
+    """
+    refresh_rollup(session)
+
+    result = session.query(MonthlySalesRollup.year, MonthlySalesRollup.month, MonthlySalesRollup.agent_id,
+                           func.sum(money_units(MonthlySalesRollup.total_commission, COMMISSION_PLACES))).filter(rollup_in_range(start, end)).group_by(
+        MonthlySalesRollup.year, MonthlySalesRollup.month, MonthlySalesRollup.agent_id).order_by(
+        MonthlySalesRollup.year, MonthlySalesRollup.month, MonthlySalesRollup.agent_id).all()
+
+    commissions = {period: {} for period in months_in_range(start, end)}
+    for year, month, agent_id, total_commission in result:
+        commissions[(f"{month:02d}", str(year))][agent_id] = to_money(total_commission, COMMISSION_PLACES)
+    return commissions
+
+
+@profiled_report
+def get_monthly_reports(start, end, n=5, session=Session):
+    """
+    Get every report for every month from start to end, e.g. for a trend over the last 12 or 24 months.
+    It takes one query per report, however many months there are.
+
+    params start: The first month: (str, str)
+           end: The last month: (str, str)
+           n: The number of top offices and agents per month: int
+           session: the database session
+    return: a list of MonthlyReport objects, one per month in order
+    """
+    top_offices = get_top_offices_by_month(start, end, n, session=session)
+    top_agents = get_top_agents_by_month(start, end, n, session=session)
+    average_prices = average_selling_price_by_month(start, end, session=session)
+    average_days = average_number_of_days_by_month(start, end, session=session)
+    commissions = commissions_by_month(start, end, session=session)
+
+    return [MonthlyReport(month=month, year=year, top_offices=top_offices[(month, year)], top_agents=top_agents[(month, year)],
+                          average_price=average_prices[(month, year)], average_days_on_market=average_days[(month, year)],
+                          commissions=commissions[(month, year)]) for month, year in months_in_range(start, end)]
+
 
 if __name__ == '__main__':
-    # The queries run for January 2023
-    get_top_five_offices('01', '2023')
+    # The queries run for January 2023, on the latest snapshot when REPORT_SNAPSHOTS is set.
+    # The commissions are stored, so they are always computed on the database itself.
+    session = report_session()
+    get_top_five_offices('01', '2023', session=session)
     print('\n')
-    get_top_five_agents('01', '2023')
+    get_top_five_agents('01', '2023', session=session)
     print('\n')
     get_commision_for_each_agent('01', '2023')
     print('\n')
-    average_number_of_days('01', '2023')
+    average_number_of_days('01', '2023', session=session)
     print('\n')
-    average_selling_price('01', '2023')
\ No newline at end of file
+    average_selling_price('01', '2023', session=session)
+    session.remove()
+    Session.remove()
\ No newline at end of file
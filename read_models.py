@@ -0,0 +1,147 @@
+import argparse
+import datetime
+import gc
+import time
+import tracemalloc
+from dataclasses import dataclass
+from create import Sale, House, DATABASE_URL, commission_expression, make_engine
+from partitions import sales_between
+from query import month_window
+from sqlalchemy import Float, cast, func, select
+from sqlalchemy.orm import sessionmaker
+
+# Read-only models of the rows that the per-sale readers need, e.g. the sales behind an agent's commission or a month's
+# days on the market. They are built from a Core select of the few columns they need, so reading a month of sales doesn't
+# load Sale and House objects into the identity map, with their change tracking and every other column.
+# The ORM models are for writing.
+#
+# The money columns are floats, computed by the database like in export.py, and the commission and the days on the market
+# are computed by the database as well.
+
+
+@dataclass(frozen=True, slots=True)
+class SaleRow:
+    """
+    A sale, with its commission and the days its house was on the market (None if its house is unknown).
+    """
+    sale_id: int
+    date_of_sale: datetime.date
+    sale_price: float
+    agent_commission: float
+    days_on_market: float
+    agent_id: int
+    office_id: int
+    house_id: int
+
+
+def sale_rows_statement(connection, start_date, end_date, agent_id=None, office_id=None):
+    """
+    Get the query of the sales from start_date (included) to end_date (excluded), with the columns of SaleRow in order.
+
+    params connection: a connection or session, to find the archived years of the range
+           start_date: the first date: date object
+           end_date: the date after the last one: date object
+           agent_id: only the sales of this agent, or None for every agent: int
+           office_id: only the sales of this office, or None for every office: int
+    return: a SQLAlchemy select statement
+    """
+    sales = sales_between(connection, start_date, end_date)
+    statement = select(sales.c.id, sales.c.date_of_sale, cast(sales.c.sale_price, Float), cast(commission_expression(sales.c.sale_price), Float),
+                       func.julianday(sales.c.date_of_sale) - func.julianday(House.date_of_listing), sales.c.agent_id, sales.c.office_id,
+                       sales.c.house_id).select_from(sales).outerjoin(House, House.id == sales.c.house_id).order_by(sales.c.date_of_sale, sales.c.id)
+    if agent_id is not None:
+        statement = statement.where(sales.c.agent_id == agent_id)
+    if office_id is not None:
+        statement = statement.where(sales.c.office_id == office_id)
+    return statement
+
+
+def get_sales_of_month(session, month, year, agent_id=None, office_id=None):
+    """
+    Get the sales of a month, in order of date, as SaleRow objects.
+
+    params session: the database session
+           month: The month number: str
+           year: The year: str
+           agent_id: only the sales of this agent, or None for every agent: int
+           office_id: only the sales of this office, or None for every office: int
+    return: a list of SaleRow objects
+    """
+    statement = sale_rows_statement(session, *month_window(month, year), agent_id=agent_id, office_id=office_id)
+    return [SaleRow(*row) for row in session.execute(statement)]
+
+
+def iter_sales(session, start, end, chunk_size=10000):
+    """
+    Get the sales from the start month to the end month as tuples with the fields of SaleRow, fetched chunk_size at a time,
+    so the memory they take doesn't depend on the number of sales.
+
+    params session: the database session
+           start: The first month: (str, str)
+           end: The last month: (str, str)
+           chunk_size: the number of rows fetched at a time: int
+    yields: tuples of (sale_id, date_of_sale, sale_price, agent_commission, days_on_market, agent_id, office_id, house_id)
+    """
+    statement = sale_rows_statement(session, month_window(*start)[0], month_window(*end)[1])
+    for rows in session.execute(statement, execution_options={'yield_per': chunk_size}).partitions():
+        yield from map(tuple, rows)
+
+
+def load_orm_sales(session, start_date, end_date):
+    """
+    Load the sales of a range as Sale and House objects, and compute what SaleRow holds from them. This is what the
+    read models replace, and it is only here to measure the difference.
+    """
+    result = session.query(Sale, House).outerjoin(House, House.id == Sale.house_id).filter(
+        Sale.date_of_sale >= start_date, Sale.date_of_sale < end_date).order_by(Sale.date_of_sale, Sale.id).all()
+    return [(sale.id, sale.date_of_sale, sale.sale_price, sale.agent_commission,
+             (sale.date_of_sale - house.date_of_listing).days if house is not None else None, sale.agent_id, sale.office_id, sale.house_id)
+            for sale, house in result]
+
+
+def measure(session, start, end):
+    """
+    Load the sales from the start month to the end month as ORM objects and as read models, and measure the time and the
+    peak memory of each. The time is measured without tracemalloc, which slows the allocations down.
+
+    params session: the database session
+           start: The first month: (str, str)
+           end: The last month: (str, str)
+    return: a dictionary with the number of sales, and the seconds and peak bytes of 'orm' and 'read_models'
+    """
+    start_date, end_date = month_window(*start)[0], month_window(*end)[1]
+    loaders = {'orm': lambda: load_orm_sales(session, start_date, end_date),
+               'read_models': lambda: [SaleRow(*row) for row in session.execute(sale_rows_statement(session, start_date, end_date))]}
+
+    results = {}
+    for name, load in loaders.items():
+        session.expunge_all()
+        gc.collect()
+        started = time.perf_counter()
+        num_sales = len(load())
+        seconds = time.perf_counter() - started
+
+        session.expunge_all()
+        gc.collect()
+        tracemalloc.start()
+        load()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        session.expunge_all()
+        results[name] = {'seconds': seconds, 'peak_bytes': peak_bytes}
+    return {'sales': num_sales, **results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure loading a range of sales as ORM objects and as read models.')
+    parser.add_argument('--start', nargs=2, required=True, metavar=('MONTH', 'YEAR'), help='the first month, e.g. 01 2023')
+    parser.add_argument('--end', nargs=2, required=True, metavar=('MONTH', 'YEAR'), help='the last month, e.g. 12 2023')
+    parser.add_argument('--database', default=DATABASE_URL)
+    args = parser.parse_args()
+
+    session = sessionmaker(bind=make_engine(args.database))()
+    result = measure(session, tuple(args.start), tuple(args.end))
+    session.close()
+    print(f"{result['sales']} sales:")
+    for name in ('orm', 'read_models'):
+        print(f"  {name:<12} {result[name]['seconds']:>8.2f}s {result[name]['peak_bytes'] / 2 ** 20:>10.1f} MB peak")
@@ -0,0 +1,140 @@
+import datetime
+from create import Sale, House, MonthlySalesRollup, RollupState, PRICE_PLACES, COMMISSION_PLACES, commission_units_expression, money_units
+from partitions import archived_years, sales_between
+from sqlalchemy import event, delete, func, insert, inspect, literal, select
+from sqlalchemy.orm import Session
+
+# The rollup keeps one MonthlySalesRollup row per (year, month, office, agent) with the number of sales, the revenue,
+# the commission, and the days on the market, so the reports are answered from a handful of rows instead of every sale.
+#
+# It is refreshed one month at a time, only for the months that changed:
+#   - sales inserted, updated, or deleted through the ORM are tracked with session events, and their months are
+#     refreshed in the same transaction when the session commits;
+#   - sales inserted without the ORM (e.g. by insert.bulk_insert_data) are found with a high-water mark on the sale id,
+#     when refresh_rollup is called before reading.
+# Sales updated or deleted without the ORM are not tracked; call rebuild_rollup after doing that.
+
+
+def refresh_months(session, months):
+    """
+    Recompute the rollup rows of the given months from the sale table.
+
+    params session: the database session
+           months: (year, month) tuples: iterable of (int, int)
+    return: None
+    """
+    for year, month in sorted(months):
+        start_date = datetime.date(year, month, 1)
+        end_date = datetime.date(year + month // 12, month % 12 + 1, 1)
+
+        # the sales of the month, from the sale table and from the archived year of the month if there is one
+        sales = sales_between(session, start_date, end_date)
+        days = func.julianday(sales.c.date_of_sale) - func.julianday(House.date_of_listing)
+        # the money is added up exactly, in cents and in units of the commission, and stored in dollars
+        aggregate = select(literal(year), literal(month), sales.c.office_id, sales.c.agent_id, func.count(sales.c.id),
+                           func.sum(money_units(sales.c.sale_price, PRICE_PLACES)) / 10.0 ** PRICE_PLACES,
+                           func.sum(commission_units_expression(sales.c.sale_price)) / 10.0 ** COMMISSION_PLACES,
+                           func.coalesce(func.sum(days), 0), func.count(House.id)).select_from(sales).outerjoin(
+            House, House.id == sales.c.house_id).group_by(sales.c.office_id, sales.c.agent_id)
+
+        session.execute(delete(MonthlySalesRollup).where(MonthlySalesRollup.year == year, MonthlySalesRollup.month == month))
+        session.execute(insert(MonthlySalesRollup).from_select(
+            ['year', 'month', 'office_id', 'agent_id', 'num_sales', 'total_revenue', 'total_commission', 'total_days_on_market',
+             'num_sales_with_listing'], aggregate))
+
+
+def refresh_rollup(session):
+    """
+    Bring the rollup up to date with the sales inserted since it was last refreshed.
+    When nothing was inserted, this costs a single query.
+
+    The refresh is done in a savepoint, so a report never commits (or rolls back) what the caller has pending on the session:
+    it is committed with the session's transaction. The sqlite3 driver only begins a transaction at the first write, so
+    when the session hasn't written anything, the savepoint is the whole transaction and the refresh is stored when it ends.
+
+    params session: the database session
+    return: the number of months that were refreshed: int
+    """
+    last_sale_id = select(RollupState.last_sale_id).where(RollupState.id == 1).scalar_subquery()
+    max_sale_id, last_sale_id = session.execute(select(func.max(Sale.id), last_sale_id)).one()
+    max_sale_id, last_sale_id = max_sale_id or 0, last_sale_id or 0
+    if max_sale_id <= last_sale_id:
+        return 0
+
+    # the months of the new sales. the id range is a search on the primary key
+    months = {(int(year), int(month)) for year, month in session.query(
+        func.strftime('%Y', Sale.date_of_sale), func.strftime('%m', Sale.date_of_sale)).filter(
+        Sale.id > last_sale_id, Sale.id <= max_sale_id, Sale.date_of_sale.isnot(None)).distinct()}
+
+    with session.begin_nested():
+        refresh_months(session, months)
+        session.merge(RollupState(id=1, last_sale_id=max_sale_id))
+
+    return len(months)
+
+
+def rebuild_rollup(session):
+    """
+    Recompute the whole rollup from the sale table and the archived years, and commit.
+
+    params session: the database session
+    return: None
+    """
+    session.execute(delete(MonthlySalesRollup))
+    session.execute(delete(RollupState))
+    # the months of the sale table are found by refresh_rollup, and the ones of the archived years are refreshed here
+    refresh_months(session, {(year, month) for year in archived_years(session) for month in range(1, 13)})
+    refresh_rollup(session)
+    session.commit()
+
+
+def changed_sale_months(session):
+    """
+    Get the months of the sales that are inserted, updated, or deleted in the current flush, including the month a sale
+    was moved out of and the months of the sales of a house whose listing date changed. Meant to be called from an after_flush event.
+
+    params session: the database session
+    return: a set of (year, month) tuples of int
+    """
+    months = set()
+    # session.dirty builds a new set every time it is read, so it is read once
+    dirty = session.dirty
+    for obj in list(session.new) + list(dirty) + list(session.deleted):
+        if isinstance(obj, Sale):
+            dates = [obj.date_of_sale] + list(inspect(obj).attrs.date_of_sale.history.deleted or [])
+        elif isinstance(obj, House) and obj in dirty and inspect(obj).attrs.date_of_listing.history.has_changes():
+            sales = sales_between(session.connection())
+            dates = session.connection().execute(select(sales.c.date_of_sale).where(sales.c.house_id == obj.id)).scalars().all()
+        else:
+            continue
+        months.update((date.year, date.month) for date in dates if date is not None)
+    return months
+
+
+@event.listens_for(Session, 'after_flush')
+def track_changed_months(session, flush_context):
+    """
+    Remember the months of the sales changed in this flush, to refresh them when the session commits.
+    """
+    months = changed_sale_months(session)
+    if months:
+        session.info.setdefault('rollup_months', set()).update(months)
+
+
+@event.listens_for(Session, 'before_commit')
+def refresh_changed_months(session):
+    """
+    Refresh the months remembered by track_changed_months as part of the transaction that changed them.
+    """
+    session.flush()
+    months = session.info.pop('rollup_months', None)
+    if months:
+        refresh_months(session, months)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changed_months(session):
+    """
+    Forget the months of changes that were rolled back.
+    """
+    session.info.pop('rollup_months', None)
@@ -0,0 +1,253 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from create import SQLITE_PRAGMAS, DATABASE_URL, SALE_PARTITIONS, attach_sale_partitions, make_engine
+from partitions import archived_years, max_sale_id, sales_between
+from rollup import refresh_months, refresh_rollup
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+# Point-in-time, read-only copies of the database, so the reports can read a snapshot while the writers keep the primary
+# database to themselves.
+#
+# A snapshot is made with SQLite's online backup API in a single step, which reads the primary database in one read
+# transaction: the copy is consistent, and since the primary is in WAL mode, the writers are not blocked while it is made
+# (only the checkpoints wait for it). The rollup of the copy is then brought up to date, so the reports never have to write
+# to it, and the copy is published in the snapshot directory along with latest.json, which holds its metadata:
+#   - path: the file of the snapshot, in the directory;
+#   - partitions: the directory of the copies of the archived years (see partitions.py), in the directory, or None;
+#   - taken_at: when it was taken, in seconds since the epoch;
+#   - last_sale_id: the id of the last sale it holds, to tell how many sales it is behind the primary.
+# The archived years are copied one at a time, after the primary, so a sale written into one of them meanwhile may be in
+# the copy of its year only. The rollup of their months is computed again from the copies, so the reports agree with each other.
+# The previous snapshots are deleted, except for the keep most recent ones. At least two are kept: the routers may still have
+# the previous snapshot open until they pick up the new one.
+#
+# The reports are routed to the latest snapshot with snapshot_router, which is configured with environment variables:
+#   REPORT_SNAPSHOTS: the snapshot directory; the reports read the primary database when it isn't set
+#   REPORT_SNAPSHOT_MAX_AGE: the age in seconds above which a snapshot is too stale and the reports read the primary (default: no limit)
+
+SNAPSHOT_DIRECTORY = 'snapshots'
+
+# the pragmas of the primary database that apply to a read-only copy as well
+SNAPSHOT_PRAGMAS = {name: value for name, value in SQLITE_PRAGMAS.items() if name in ('cache_size', 'mmap_size')}
+
+
+def database_path(url):
+    """
+    Get the path of the file of a SQLite database URL.
+    """
+    path = make_url(url).database
+    if path in (None, '', ':memory:'):
+        raise ValueError("Only a database in a file can be copied to a snapshot.")
+    return path
+
+
+def read_latest(directory=SNAPSHOT_DIRECTORY):
+    """
+    Get the metadata of the latest snapshot in directory, or None if there is none.
+    """
+    try:
+        with open(os.path.join(directory, 'latest.json')) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def copy_database(source_path, target_path):
+    """
+    Copy a SQLite database with the online backup API, in a single read transaction of the source.
+    """
+    source = sqlite3.connect(source_path, timeout=SQLITE_PRAGMAS['busy_timeout'] / 1000)
+    target = sqlite3.connect(target_path)
+    try:
+        # all the pages are copied in one step
+        source.backup(target)
+        # the copy is in the journal mode of the source. a copy in WAL mode couldn't be opened read-only without its -shm file
+        target.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        target.close()
+        source.close()
+
+
+def take_snapshot(url=DATABASE_URL, directory=SNAPSHOT_DIRECTORY, keep=2, partitions=SALE_PARTITIONS):
+    """
+    Copy the database and its archived years to a new read-only snapshot in directory and make it the latest one.
+
+    params url: the URL of the primary database: str
+           directory: the snapshot directory: str
+           keep: the number of snapshots kept, the new one included, at least 2: int
+           partitions: the directory of the archived years of sales, or None: str
+    return: the metadata of the new snapshot: dict
+    """
+    if keep < 2:
+        raise ValueError("At least 2 snapshots must be kept: the previous one may still be open.")
+    source_path = database_path(url)
+    os.makedirs(directory, exist_ok=True)
+    taken_at = time.time()
+    name = f"snapshot-{datetime.datetime.fromtimestamp(taken_at, datetime.timezone.utc):%Y%m%dT%H%M%S%f}.db"
+    path = os.path.join(directory, name)
+    copy_database(source_path, path + '.tmp')
+
+    # the archived years are copied to a directory of the snapshot, which the routers attach read-only
+    years = [file for file in sorted(os.listdir(partitions)) if re.fullmatch(r'sale_\d{4}\.db', file)] \
+        if partitions and os.path.isdir(partitions) else []
+    partitions_name = name[:-len('.db')] + '-partitions' if years else None
+    if years:
+        partitions_path = os.path.join(directory, partitions_name)
+        os.makedirs(partitions_path + '.tmp')
+        for file in years:
+            copy_database(os.path.join(partitions, file), os.path.join(partitions_path + '.tmp', file))
+
+    # the reports refresh the rollup before reading it, which must not need a write on a read-only snapshot
+    engine = create_engine(f"sqlite:///{path}.tmp")
+    if years:
+        event.listen(engine, 'connect', attach_sale_partitions(partitions_path + '.tmp'))
+    try:
+        with sessionmaker(bind=engine)() as session:
+            refresh_rollup(session)
+            refresh_months(session, {(year, month) for year in archived_years(session) for month in range(1, 13)})
+            session.commit()
+            last_sale_id = max_sale_id(session)
+    finally:
+        engine.dispose()
+
+    if years:
+        os.replace(partitions_path + '.tmp', partitions_path)
+    os.replace(path + '.tmp', path)
+    metadata = {'path': name, 'partitions': partitions_name, 'source': os.path.abspath(source_path), 'taken_at': taken_at,
+                'last_sale_id': last_sale_id, 'seconds': time.time() - taken_at}
+    with open(os.path.join(directory, 'latest.json.tmp'), 'w') as file:
+        json.dump(metadata, file)
+    os.replace(os.path.join(directory, 'latest.json.tmp'), os.path.join(directory, 'latest.json'))
+
+    # the names sort in the order the snapshots were taken
+    snapshots = sorted(file for file in os.listdir(directory) if file.startswith('snapshot-') and file.endswith('.db'))
+    for old in snapshots[:max(len(snapshots) - keep, 0)]:
+        os.remove(os.path.join(directory, old))
+        shutil.rmtree(os.path.join(directory, old[:-len('.db')] + '-partitions'), ignore_errors=True)
+
+    return metadata
+
+
+def staleness(metadata, session=None):
+    """
+    Get how far behind the primary database a snapshot is.
+
+    params metadata: the metadata of the snapshot
+           session: a session on the primary database, to count the sales the snapshot doesn't have, or None
+    return: a dictionary with the age of the snapshot in seconds, and the number of sales inserted since (None without a session)
+    """
+    sales_behind = None
+    if session is not None:
+        sales = sales_between(session)
+        sales_behind = session.execute(select(func.count(sales.c.id)).where(sales.c.id > metadata['last_sale_id'])).scalar()
+    return {'age_seconds': time.time() - metadata['taken_at'], 'sales_behind': sales_behind}
+
+
+def set_snapshot_pragmas(dbapi_connection, connection_record):
+    """
+    Apply SNAPSHOT_PRAGMAS to a new connection to a snapshot. It is registered as a 'connect' event listener on the snapshot engines.
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in SNAPSHOT_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+class SnapshotRouter:
+    """
+    Hands out sessions on the latest snapshot of a snapshot directory, opened read-only.
+    """
+
+    def __init__(self, directory=None, max_staleness=None):
+        """
+        params directory: the snapshot directory, or None to always read the primary database: str
+               max_staleness: the age in seconds above which a snapshot is not used, or None for no limit: float
+        """
+        self.directory = directory
+        self.max_staleness = max_staleness
+        self.lock = threading.Lock()
+        self.current = None  # (metadata, engine, scoped session) of the snapshot in use
+
+    def latest(self):
+        """
+        Get the metadata of the latest snapshot, or None if there is none or it is too stale.
+        """
+        if self.directory is None:
+            return None
+        metadata = read_latest(self.directory)
+        if metadata is None or (self.max_staleness is not None and time.time() - metadata['taken_at'] > self.max_staleness):
+            return None
+        return metadata
+
+    def session(self):
+        """
+        Get a session on the latest snapshot, or None if the reports should read the primary database.
+        Like query.Session, it is a scoped session: each thread gets its own, and should call remove() when it is done.
+        A newer snapshot is picked up the next time this is called.
+        """
+        metadata = self.latest()
+        if metadata is None:
+            return None
+
+        with self.lock:
+            if self.current is None or self.current[0]['path'] != metadata['path']:
+                path = os.path.abspath(os.path.join(self.directory, metadata['path']))
+                engine = create_engine(f"sqlite:///file:{path}?mode=ro&uri=true")
+                event.listen(engine, 'connect', set_snapshot_pragmas)
+                if metadata.get('partitions'):
+                    event.listen(engine, 'connect', attach_sale_partitions(os.path.join(self.directory, metadata['partitions']), read_only=True))
+                if self.current is not None:
+                    # the sessions that are still open on the previous snapshot keep their connection until they are removed
+                    self.current[1].dispose()
+                self.current = (metadata, engine, scoped_session(sessionmaker(bind=engine)))
+            return self.current[2]
+
+    def staleness(self, session=None):
+        """
+        Get how far behind the primary database the snapshot the reports read is, or None if they read the primary.
+
+        params session: a session on the primary database, to count the sales the snapshot doesn't have, or None
+        """
+        metadata = self.latest()
+        return None if metadata is None else staleness(metadata, session)
+
+
+snapshot_router = SnapshotRouter(os.environ.get('REPORT_SNAPSHOTS'), max_staleness=float(os.environ['REPORT_SNAPSHOT_MAX_AGE'])
+                                 if os.environ.get('REPORT_SNAPSHOT_MAX_AGE') else None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Take read-only snapshots of the database for the reports, once or on a schedule.')
+    parser.add_argument('--directory', default=os.environ.get('REPORT_SNAPSHOTS') or SNAPSHOT_DIRECTORY, help='the snapshot directory')
+    parser.add_argument('--every', type=float, help='take a snapshot every this many seconds, until interrupted')
+    parser.add_argument('--keep', type=int, default=2, help='the number of snapshots kept, at least 2')
+    parser.add_argument('--status', action='store_true', help='print how stale the latest snapshot is instead of taking one')
+    parser.add_argument('--partitions', default=SALE_PARTITIONS, help='the directory of the archived years of sales')
+    parser.add_argument('--database', default=DATABASE_URL)
+    args = parser.parse_args()
+
+    if args.status:
+        metadata = read_latest(args.directory)
+        if metadata is None:
+            print(f"There is no snapshot in {args.directory}.")
+        else:
+            with sessionmaker(bind=make_engine(args.database, partitions=args.partitions))() as session:
+                behind = staleness(metadata, session)
+            print(f"The latest snapshot is {metadata['path']}, taken {behind['age_seconds']:.0f}s ago, "
+                  f"{behind['sales_behind']} sale(s) behind the database.")
+    else:
+        while True:
+            metadata = take_snapshot(args.database, args.directory, keep=args.keep, partitions=args.partitions)
+            print(f"Took {metadata['path']} (up to sale {metadata['last_sale_id']}) in {metadata['seconds']:.2f}s.", flush=True)
+            if args.every is None:
+                break
+            time.sleep(max(args.every - metadata['seconds'], 0))
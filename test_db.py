@@ -1,9 +1,39 @@
+import asyncio
+import contextlib
+import csv
 import datetime
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import time
 import unittest
+import warnings
+from decimal import Decimal
+from unittest import mock
 from faker import Faker
-from create import Base, MonthlyCommission, Office, Sale, House, Agent, Buyer, Seller
-from insert import generate_date, generate_email, generate_name, generate_agents, generate_offices, generate_houses, generate_buyers, generate_sellers, generate_sales, populate_agent_office_association
-from sqlalchemy import create_engine
+from create import make_engine, create_indexes, drop_obsolete_indexes, agent_office_association, Base, MonthlyCommission, MonthlySalesRollup, Office, Sale, House, Agent, Buyer, Seller
+from insert import generate_date, generate_email, generate_name, generate_agents, generate_offices, generate_houses, generate_buyers, generate_sellers, generate_sales, populate_agent_office_association, bulk_insert_data, append_activity
+from rollup import refresh_rollup, rebuild_rollup
+from cache import ReportCache, report_cache, uncached
+import async_query
+import export
+from analytics import SaleAnalytics
+from snapshot import SnapshotRouter, take_snapshot, read_latest
+from partitions import archive_year, sales_between
+from read_models import SaleRow, get_sales_of_month, iter_sales, measure
+from profiling import profiler
+from benchmark import benchmark_database, compare, scale_counts
+from index_advisor import REPORTS, capture_statements, explain, plan_warnings
+from commissions import recompute_commissions, split_months, set_query_only, compute_commissions_from_sales
+from query import month_window, explain_query_plan, compute_commissions, get_commision_for_each_agent, average_number_of_days, \
+    get_top_five_offices, get_top_five_agents, average_selling_price, OfficeSales, AgentSales, months_in_range, get_monthly_reports, \
+    compute_top_five_offices, compute_top_five_agents, compute_days_on_market, compute_average_selling_price, report_session
+from sqlalchemy import create_engine, event, func, insert, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError, SAWarning
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 
 class TestModels(unittest.TestCase):
@@ -82,6 +112,962 @@ class TestModels(unittest.TestCase):
         self.assertEqual(result.agent_id, 1)
         self.assertEqual(result.total_commission, 10000)
 
+        # an agent can't have two commissions for the same month
+        self.session.add(MonthlyCommission(month=1, year=2022, agent_id=1, total_commission=20000))
+        with self.assertRaises(IntegrityError):
+            self.session.commit()
+
+class TestAgentCommission(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite:///:memory:')
+        Session = sessionmaker(bind=engine)
+        self.session = Session()
+        Base.metadata.create_all(engine)
+
+        # prices just below, at, and just above every tier boundary
+        self.prices = [Decimal('0'), Decimal('1')]
+        for boundary in [100000, 200000, 500000, 1000000]:
+            self.prices += [Decimal(boundary) - Decimal('0.01'), Decimal(boundary), Decimal(boundary) + Decimal('0.01')]
+        for i, price in enumerate(self.prices):
+            self.session.add(Sale(house_id=i, seller_id=1, buyer_id=1, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 1, 1), sale_price=price))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.rollback()
+
+    def test_tier_rates(self):
+        """
+        Tests that each side of a tier boundary gets the right rate.
+        """
+        sale = Sale(sale_price=Decimal('99999.99'))
+        self.assertEqual(sale.agent_commission, Decimal('9999.999'))
+        sale = Sale(sale_price=100000)
+        self.assertEqual(sale.agent_commission, Decimal('7500'))
+        sale = Sale(sale_price=1000000)
+        self.assertEqual(sale.agent_commission, Decimal('40000'))
+
+    def test_python_and_sql_agree(self):
+        """
+        Tests that the commission computed by the database matches the Python side for every sale.
+        """
+        result = self.session.query(Sale, Sale.agent_commission).all()
+        self.assertEqual(len(result), len(self.prices))
+        for sale, sql_commission in result:
+            self.assertIsInstance(sql_commission, Decimal)
+            self.assertEqual(sql_commission.quantize(Decimal('0.000001')), sale.agent_commission.quantize(Decimal('0.000001')), sale.sale_price)
+
+    def test_sql_aggregate_filter_and_order(self):
+        """
+        Tests that the commission can be summed, filtered, and ordered inside the database.
+        """
+        sales = self.session.query(Sale).all()
+
+        total = self.session.query(func.sum(Sale.agent_commission)).scalar()
+        self.assertAlmostEqual(total, sum(sale.agent_commission for sale in sales), places=4)
+
+        above = self.session.query(Sale.id).filter(Sale.agent_commission > 20000).order_by(Sale.agent_commission.desc()).all()
+        expected = sorted((sale for sale in sales if sale.agent_commission > 20000), key=lambda sale: sale.agent_commission, reverse=True)
+        self.assertEqual([row.id for row in above], [sale.id for sale in expected])
+
+
+class TestRollup(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite:///:memory:')
+        Session = sessionmaker(bind=engine)
+        self.session = Session()
+        Base.metadata.create_all(engine)
+
+        self.session.add(House(id=1, date_of_listing=datetime.date(2022, 12, 1)))
+        self.session.add(Sale(id=1, house_id=1, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 1, 10), sale_price=100000))
+        self.session.add(Sale(id=2, house_id=1, agent_id=2, office_id=1, date_of_sale=datetime.date(2023, 1, 20), sale_price=300000))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.rollback()
+
+    def rollup(self, year, month):
+        """
+        Get the rollup rows of a month as (office_id, agent_id, num_sales, total_revenue) tuples.
+        """
+        result = self.session.query(MonthlySalesRollup).filter_by(year=year, month=month).order_by(
+            MonthlySalesRollup.office_id, MonthlySalesRollup.agent_id).all()
+        return [(row.office_id, row.agent_id, row.num_sales, row.total_revenue) for row in result]
+
+    def test_orm_changes_refresh_their_months(self):
+        """
+        Tests that inserting, moving, and deleting sales through the ORM refreshes the months they touch when committing.
+        """
+        self.assertEqual(self.rollup(2023, 1), [(1, 1, 1, 100000), (1, 2, 1, 300000)])
+        row = self.session.query(MonthlySalesRollup).filter_by(year=2023, month=1, agent_id=1).one()
+        self.assertEqual((row.total_commission, row.total_days_on_market, row.num_sales_with_listing), (7500, 40, 1))
+
+        # move a sale to February
+        self.session.get(Sale, 2).date_of_sale = datetime.date(2023, 2, 1)
+        self.session.commit()
+        self.assertEqual(self.rollup(2023, 1), [(1, 1, 1, 100000)])
+        self.assertEqual(self.rollup(2023, 2), [(1, 2, 1, 300000)])
+
+        # delete it
+        self.session.delete(self.session.get(Sale, 2))
+        self.session.commit()
+        self.assertEqual(self.rollup(2023, 2), [])
+
+        # a rolled back change is not kept
+        self.session.add(Sale(house_id=1, agent_id=3, office_id=2, date_of_sale=datetime.date(2023, 3, 1), sale_price=1))
+        self.session.flush()
+        self.session.rollback()
+        self.session.commit()
+        self.assertEqual(self.rollup(2023, 3), [])
+
+    def test_bulk_inserts_are_picked_up(self):
+        """
+        Tests that sales inserted without the ORM are added to the rollup when it is refreshed, and only their months are refreshed.
+        """
+        self.assertEqual(refresh_rollup(self.session), 1)
+        self.assertEqual(refresh_rollup(self.session), 0)
+
+        self.session.execute(insert(Sale), [{'house_id': 1, 'agent_id': 1, 'office_id': 1, 'date_of_sale': datetime.date(2023, 1, 15), 'sale_price': 200000},
+                                            {'house_id': 1, 'agent_id': 1, 'office_id': 2, 'date_of_sale': datetime.date(2023, 4, 15), 'sale_price': 50000}])
+        self.session.commit()
+        self.assertEqual(refresh_rollup(self.session), 2)
+        self.assertEqual(self.rollup(2023, 1), [(1, 1, 2, 300000), (1, 2, 1, 300000)])
+        self.assertEqual(self.rollup(2023, 4), [(2, 1, 1, 50000)])
+
+        rebuild_rollup(self.session)
+        self.assertEqual(self.rollup(2023, 1), [(1, 1, 2, 300000), (1, 2, 1, 300000)])
+
+    def test_reports_do_not_commit_pending_changes(self):
+        """
+        Tests that a report refreshing the rollup doesn't commit what the caller has pending on the session,
+        and that the refresh is rolled back with it.
+        """
+        self.session.execute(insert(Sale), [{'house_id': 1, 'agent_id': 3, 'office_id': 1, 'date_of_sale': datetime.date(2023, 2, 15), 'sale_price': 50000}])
+        self.session.commit()
+
+        self.session.add(Buyer(name='Jane Doe', phone='555-555-5555', email='jane@example.com'))
+        self.assertEqual(compute_commissions(self.session, '02', '2023'), {3: 5000})
+        self.assertEqual(self.session.query(Buyer).count(), 1)
+        self.session.rollback()
+
+        self.assertEqual(self.session.query(Buyer).count(), 0)
+        self.assertEqual(self.rollup(2023, 2), [])
+        self.assertEqual(refresh_rollup(self.session), 2)
+
+    def test_reports_read_the_rollup(self):
+        """
+        Tests that the reports answer from the rollup and match the sales.
+        """
+        self.assertEqual(average_selling_price('01', '2023', session=self.session), 200000)
+        self.assertEqual(average_number_of_days('01', '2023', session=self.session).average, 45)
+        self.assertEqual(compute_commissions(self.session, '01', '2023'), {1: 7500, 2: 18000})
+
+        # the rollup is what the reports read
+        self.session.query(MonthlySalesRollup).filter_by(agent_id=2).update({'total_revenue': 0, 'total_commission': 0})
+        self.session.commit()
+        report_cache.clear()
+        self.assertEqual(average_selling_price('01', '2023', session=self.session), 50000)
+
+
+class TestReportCache(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite:///:memory:')
+        Session = sessionmaker(bind=engine)
+        self.session = Session()
+        Base.metadata.create_all(engine)
+        report_cache.clear()
+        report_cache.reset_stats()
+
+        self.session.add(Sale(house_id=1, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 1, 10), sale_price=100000))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.rollback()
+
+    def test_lru_and_ttl(self):
+        """
+        Tests that the least recently used entry is evicted first and that entries expire.
+        """
+        cache = ReportCache(max_entries=2, ttl=60)
+        cache.set('a', [('01', '2023')], 1)
+        cache.set('b', [('02', '2023')], 2)
+        self.assertEqual(cache.get('a'), (True, 1))
+        cache.set('c', [('03', '2023')], 3)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.stats(), {'hits': 2, 'disk_hits': 0, 'misses': 1, 'evictions': 1, 'invalidations': 0, 'entries': 2})
+
+        cache = ReportCache(ttl=0.01)
+        cache.set('a', [('01', '2023')], 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), (False, None))
+
+    def test_disk_tier(self):
+        """
+        Tests that a new cache with the same path finds the entries on disk, and that invalidating a month removes them there too.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'reports')
+            ReportCache(path=path).set('a', [('01', '2023'), ('02', '2023')], 1)
+
+            cache = ReportCache(path=path)
+            self.assertEqual(cache.get('a'), (True, 1))
+            self.assertEqual(cache.disk_hits, 1)
+
+            cache.invalidate([('02', '2023')])
+            self.assertEqual(ReportCache(path=path).get('a'), (False, None))
+
+    def test_databases_and_callers_do_not_share_entries(self):
+        """
+        Tests that the reports of two databases in memory are cached apart, and that changing a cached report's result
+        doesn't change what the next caller gets.
+        """
+        other = sessionmaker(bind=create_engine('sqlite:///:memory:'))()
+        Base.metadata.create_all(other.get_bind())
+        other.add(Sale(house_id=1, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 1, 10), sale_price=500000))
+        other.commit()
+
+        self.assertEqual(average_selling_price('01', '2023', session=self.session), 100000)
+        self.assertEqual(average_selling_price('01', '2023', session=other), 500000)
+
+        reports = get_monthly_reports(('01', '2023'), ('01', '2023'), session=self.session)
+        reports[0].commissions.clear()
+        reports.clear()
+        reports = get_monthly_reports(('01', '2023'), ('01', '2023'), session=self.session)
+        self.assertEqual(reports[0].commissions, {1: 7500})
+
+    def test_reports_are_cached_until_their_month_changes(self):
+        """
+        Tests that a report is computed once, and computed again only after a sale of its month is committed.
+        """
+        self.assertEqual(average_selling_price('01', '2023', session=self.session), 100000)
+        self.assertEqual(average_selling_price('01', '2023', session=self.session), 100000)
+        self.assertEqual((report_cache.hits, report_cache.misses), (1, 1))
+
+        # a sale in another month keeps the entry, a sale in January drops it
+        self.session.add(Sale(house_id=2, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 2, 10), sale_price=500000))
+        self.session.commit()
+        self.assertEqual(average_selling_price('01', '2023', session=self.session), 100000)
+        self.assertEqual(report_cache.hits, 2)
+
+        self.session.add(Sale(house_id=3, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 1, 20), sale_price=300000))
+        self.session.commit()
+        self.assertEqual(average_selling_price('01', '2023', session=self.session), 200000)
+        self.assertEqual((report_cache.hits, report_cache.misses, report_cache.invalidations), (2, 2, 1))
+
+        # reports over a range are dropped when any of their months changes
+        reports = get_monthly_reports(('01', '2023'), ('03', '2023'), session=self.session)
+        self.assertEqual(reports[1].average_price, 500000)
+        self.session.delete(self.session.query(Sale).filter_by(house_id=2).one())
+        self.session.commit()
+        reports = get_monthly_reports(('01', '2023'), ('03', '2023'), session=self.session)
+        self.assertIsNone(reports[1].average_price)
+
+
+class TestAsyncQueries(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{os.path.join(self.directory.name, 'test.db')}"
+        self.engine = make_engine(url)
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        report_cache.clear()
+
+        for i in range(1, 7):
+            self.session.add(Agent(id=i, name=f'Agent {i}', phone='555-555-5555', email=f'agent{i}@example.com'))
+            self.session.add(Office(id=i, phone='555-555-5555', email=f'office{i}@company.com', address=f'{i} Main St'))
+        for i in range(30):
+            self.session.add(House(id=i + 1, date_of_listing=datetime.date(2022, 12, i % 28 + 1)))
+            self.session.add(Sale(house_id=i + 1, seller_id=1, buyer_id=1, agent_id=i % 6 + 1, office_id=i % 4 + 1,
+                                  date_of_sale=datetime.date(2023, 1, i % 28 + 1), sale_price=50000 * (i + 1)))
+        self.session.commit()
+
+        self.async_engine = async_query.make_async_engine(url)
+        self.session_factory = async_sessionmaker(bind=self.async_engine, expire_on_commit=False)
+
+    async def asyncTearDown(self):
+        await self.async_engine.dispose()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    async def test_get_all_reports(self):
+        """
+        Tests that the five reports run concurrently on their own sessions and match the synchronous reports.
+        """
+        report = await async_query.get_all_reports('01', '2023', session_factory=self.session_factory)
+        report_cache.clear()
+
+        self.assertEqual(report.top_offices, get_top_five_offices('01', '2023', session=self.session))
+        self.assertEqual(report.top_agents, get_top_five_agents('01', '2023', session=self.session))
+        self.assertEqual(report.commissions, compute_commissions(self.session, '01', '2023'))
+        self.assertAlmostEqual(report.average_days_on_market, average_number_of_days('01', '2023', session=self.session).average)
+        self.assertAlmostEqual(report.average_price, average_selling_price('01', '2023', session=self.session))
+
+    async def test_reports_on_a_given_session(self):
+        """
+        Tests that a report can run on a session that the caller opened, and that the range reports work too.
+        """
+        async with self.session_factory() as session:
+            days = await async_query.average_number_of_days('01', '2023', percentiles=(0.5,), session=session)
+            reports = await async_query.get_monthly_reports(('12', '2022'), ('01', '2023'), session=session)
+
+        self.assertEqual(days.num_sales, 30)
+        self.assertEqual([len(report.top_offices) for report in reports], [0, 4])
+
+
+class TestCommissionBatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = f"sqlite:///{os.path.join(self.directory.name, 'test.db')}"
+        self.engine = make_engine(self.url)
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        for i in range(1, 4):
+            self.session.add(Agent(id=i, name=f'Agent {i}', phone='555-555-5555', email=f'agent{i}@example.com'))
+        for i in range(45):
+            self.session.add(Sale(agent_id=i % 3 + 1, office_id=1, date_of_sale=datetime.date(2023, i // 3 % 3 + 1, i % 28 + 1),
+                                  sale_price=40000 * (i + 1)))
+        # a commission of a month that the batch recomputes, for an agent that has no sales in it any more
+        self.session.add(MonthlyCommission(agent_id=3, month=4, year=2023, total_commission=100))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_split_months(self):
+        """
+        Tests that the months are split into contiguous chunks of about the same size, with no empty chunk.
+        """
+        months = months_in_range(('01', '2023'), ('05', '2023'))
+        self.assertEqual(split_months(months, 2), [months[:2], months[2:]])
+        self.assertEqual(split_months(months, 10), [[month] for month in months])
+
+    def test_recompute_commissions(self):
+        """
+        Tests that a pool of processes or threads computes the same commissions as the serial path and stores all of them.
+        """
+        expected = {(month, year): compute_commissions(self.session, month, year) for month, year in
+                    months_in_range(('01', '2023'), ('04', '2023'))}
+
+        for workers, use_threads in [(1, False), (2, True), (3, False)]:
+            result = recompute_commissions(('01', '2023'), ('04', '2023'), workers=workers, url=self.url, use_threads=use_threads)
+            self.assertEqual(result.keys(), expected.keys())
+            for period, commissions in expected.items():
+                self.assertEqual(result[period].keys(), commissions.keys())
+                self.assertEqual(result[period], commissions)
+
+            self.session.expire_all()
+            stored = {(f"{row.month:02d}", str(row.year), row.agent_id): row.total_commission
+                      for row in self.session.query(MonthlyCommission)}
+            self.assertEqual(len(stored), 9)
+            self.assertNotIn(('04', '2023', 3), stored)
+
+    def test_workers_are_read_only(self):
+        """
+        Tests that a connection set up for the workers can't write to the database.
+        """
+        engine = make_engine(self.url)
+        event.listen(engine, 'connect', set_query_only)
+        with engine.connect() as connection:
+            with self.assertRaises(OperationalError):
+                connection.exec_driver_sql("DELETE FROM sale")
+        engine.dispose()
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.directory = tempfile.TemporaryDirectory()
+
+        for i in range(25):
+            self.session.add(House(id=i + 1, listing_price=100000, date_of_listing=datetime.date(2023, 1, 1)))
+            self.session.add(Sale(id=i + 1, house_id=i + 1, agent_id=i % 2 + 1, office_id=1,
+                                  date_of_sale=datetime.date(2023, i % 2 + 1, i + 1), sale_price=150000))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.directory.cleanup()
+
+    def test_stream_rows_in_chunks(self):
+        """
+        Tests that the rows of an export are fetched chunk_size at a time, in order.
+        """
+        chunks = list(export.stream_rows(self.session, export.sales_statement(), chunk_size=10))
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEqual([row.sale_id for chunk in chunks for row in chunk], list(range(1, 26)))
+
+    def test_export_sales(self):
+        """
+        Tests that the sales are exported to CSV with their house and commission, and to JSON Lines for a range of months.
+        """
+        path = os.path.join(self.directory.name, 'sales.csv')
+        self.assertEqual(export.export(self.session, 'sales', path, chunk_size=10), 25)
+        with open(path, newline='') as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[1], {'sale_id': '2', 'date_of_sale': '2023-02-02', 'sale_price': '150000.0', 'agent_commission': '11250.0',
+                                   'agent_id': '2', 'office_id': '1', 'buyer_id': '', 'seller_id': '', 'house_id': '2',
+                                   'listing_price': '100000.0', 'date_of_listing': '2023-01-01', 'zip_code': '', 'num_bedrooms': '',
+                                   'num_bathrooms': '', 'days_on_market': '32.0'})
+
+        # a range of months is exported in order of the date of sale
+        path = os.path.join(self.directory.name, 'sales.jsonl')
+        self.assertEqual(export.export(self.session, 'sales', path, format='jsonl', start=('02', '2023'), end=('02', '2023')), 12)
+        with open(path) as file:
+            rows = [json.loads(line) for line in file]
+        self.assertEqual([row['sale_id'] for row in rows], list(range(2, 25, 2)))
+        self.assertEqual(rows[0]['date_of_sale'], '2023-02-02')
+
+    def test_export_monthly(self):
+        """
+        Tests that the monthly export has one row per month with the totals of the rollup.
+        """
+        path = os.path.join(self.directory.name, 'monthly.jsonl')
+        self.assertEqual(export.export(self.session, 'monthly', path, format='jsonl'), 2)
+        with open(path) as file:
+            rows = [json.loads(line) for line in file]
+        self.assertEqual([(row['year'], row['month'], row['num_sales']) for row in rows], [(2023, 1, 13), (2023, 2, 12)])
+        self.assertAlmostEqual(rows[0]['average_price'], 150000)
+        self.assertAlmostEqual(rows[1]['total_commission'], 12 * 11250)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow is not installed")
+    def test_export_parquet(self):
+        """
+        Tests that the sales are exported to Parquet with one row group per chunk and the types of their columns.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = os.path.join(self.directory.name, 'sales.parquet')
+        self.assertEqual(export.export(self.session, 'sales', path, format='parquet', chunk_size=10), 25)
+        file = pq.ParquetFile(path)
+        self.assertEqual((file.metadata.num_rows, file.num_row_groups), (25, 3))
+
+        table = file.read()
+        self.assertEqual((table.schema.field('sale_id').type, table.schema.field('date_of_sale').type, table.schema.field('sale_price').type),
+                         (pa.int64(), pa.date32(), pa.float64()))
+        row = table.slice(1, 1).to_pylist()[0]
+        self.assertEqual((row['sale_id'], row['date_of_sale'], row['agent_commission'], row['buyer_id'], row['days_on_market']),
+                         (2, datetime.date(2023, 2, 2), 11250.0, None, 32.0))
+
+    def test_unknown_export(self):
+        """
+        Tests that an unknown export or format is refused.
+        """
+        path = os.path.join(self.directory.name, 'sales.xml')
+        self.assertRaises(ValueError, export.export, self.session, 'houses', path)
+        self.assertRaises(ValueError, export.export, self.session, 'sales', path, format='xml')
+
+
+class TestAnalytics(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(self.engine)
+        bulk_insert_data(self.engine, num_houses=600, num_sales=500, num_buyers=50, num_sellers=30, num_agents=8, num_offices=7, seed=3)
+        self.session = sessionmaker(bind=self.engine)()
+        self.directory = tempfile.TemporaryDirectory()
+        self.analytics = SaleAnalytics(self.directory.name)
+
+    def tearDown(self):
+        self.session.close()
+        self.directory.cleanup()
+
+    def assertMatchesReports(self, month, year):
+        # the reports from the snapshot are the ones of query.py, to the last digit of the sums of money
+        for report, from_snapshot in [(compute_top_five_offices, self.analytics.compute_top_five_offices(self.session, month, year)),
+                                      (compute_top_five_agents, self.analytics.compute_top_five_agents(self.session, month, year))]:
+            self.assertEqual(from_snapshot, uncached(report)(self.session, month, year))
+
+        self.assertEqual(self.analytics.compute_commissions(month, year), compute_commissions(self.session, month, year))
+        self.assertEqual(self.analytics.compute_days_on_market(month, year, percentiles=(0, 0.5, 0.9, 1)),
+                         uncached(compute_days_on_market)(self.session, month, year, percentiles=(0, 0.5, 0.9, 1)))
+        self.assertEqual(self.analytics.compute_days_on_market(month, year), uncached(compute_days_on_market)(self.session, month, year))
+        self.assertEqual(self.analytics.compute_average_selling_price(month, year),
+                         uncached(compute_average_selling_price)(self.session, month, year))
+
+    def test_reports_match_the_database(self):
+        """
+        Tests that the reports answered from the snapshot are the ones of query.py, for a single month and for a range of months.
+        """
+        self.assertEqual(self.analytics.refresh(self.session), 500)
+        for month, year in [('01', '2024'), ('06', '2025'), ('01', '1990')]:
+            self.assertMatchesReports(month, year)
+
+        start, end = ('01', '2023'), ('12', '2024')
+        expected = uncached(get_monthly_reports)(start, end, n=3, session=self.session)
+        self.assertEqual(self.analytics.get_monthly_reports(self.session, start, end, n=3), expected)
+
+    def test_sums_of_money_are_exact(self):
+        """
+        Tests that the sums of money are added up exactly, both from the snapshot and in the database, for prices whose sum
+        as floats is off in the last digits.
+        """
+        prices = [Decimal('100000.10'), Decimal('199999.99'), Decimal('0.07'), Decimal('312345.67'), Decimal('1000000.01')] * 7
+        for sale_id, price in enumerate(prices, start=1000):
+            self.session.add(Sale(id=sale_id, agent_id=99, office_id=99, date_of_sale=datetime.date(1990, 1, 15), sale_price=price))
+        self.session.commit()
+        self.analytics.refresh(self.session)
+
+        commission = sum(Sale(sale_price=price).agent_commission for price in prices)
+        self.assertEqual(self.analytics.compute_commissions('01', '1990'), {99: commission})
+        self.assertEqual(compute_commissions(self.session, '01', '1990'), {99: commission})
+        self.assertEqual(self.analytics.compute_average_selling_price('01', '1990'), sum(prices) / len(prices))
+        self.assertEqual(uncached(compute_average_selling_price)(self.session, '01', '1990'), sum(prices) / len(prices))
+
+    def test_missing_values(self):
+        """
+        Tests that sales without an agent or a house, and sales whose office doesn't exist, are reported like in query.py.
+        """
+        # a sale without an agent or a house, and a sale whose office doesn't exist
+        self.session.add(Sale(id=1000, office_id=99, date_of_sale=datetime.date(2024, 1, 15), sale_price=120000))
+        self.session.add(Sale(id=1001, agent_id=1, office_id=99, date_of_sale=datetime.date(2024, 1, 16), sale_price=220000))
+        self.session.commit()
+        self.analytics.refresh(self.session)
+        self.assertMatchesReports('01', '2024')
+        self.assertIn(None, self.analytics.compute_commissions('01', '2024'))
+
+    def test_incremental_refresh(self):
+        """
+        Tests that a refresh appends only the new sales, that a snapshot opened again reads them from its files, and that
+        the snapshot is rebuilt when the sale table has fewer sales than it.
+        """
+        self.assertEqual(self.analytics.refresh(self.session), 500)
+        self.assertEqual(self.analytics.refresh(self.session), 0)
+
+        append_activity(self.engine, num_houses=20, num_sales=30, day=datetime.date(2024, 3, 10), seed=4)
+        self.session.expire_all()
+        self.assertEqual(self.analytics.refresh(self.session), 30)
+        self.assertMatchesReports('03', '2024')
+
+        # a snapshot opened again reads the same sales from its files
+        reopened = SaleAnalytics(self.directory.name)
+        self.assertEqual(reopened.metadata['num_sales'], 530)
+        self.assertEqual(reopened.compute_days_on_market('03', '2024'), self.analytics.compute_days_on_market('03', '2024'))
+
+        # when the sale table has fewer sales than the snapshot (e.g. it was recreated), the snapshot is rebuilt
+        self.session.query(Sale).filter(Sale.id > 100).delete()
+        self.session.commit()
+        self.assertEqual(self.analytics.refresh(self.session), 100)
+        self.assertEqual(len(self.analytics.columns['sale_id']), 100)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = f"sqlite:///{os.path.join(self.directory.name, 'primary.db')}"
+        self.snapshots = os.path.join(self.directory.name, 'snapshots')
+        self.engine = make_engine(self.url)
+        Base.metadata.create_all(self.engine)
+        bulk_insert_data(self.engine, num_houses=300, num_sales=200, num_buyers=20, num_sellers=20, num_agents=5, num_offices=3, seed=5)
+        self.session = sessionmaker(bind=self.engine)()
+        self.router = SnapshotRouter(self.snapshots)
+
+    def tearDown(self):
+        self.session.close()
+        if self.router.current is not None:
+            self.router.current[2].remove()
+            self.router.current[1].dispose()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_reports_read_the_snapshot(self):
+        """
+        Tests that the router hands out read-only sessions on the latest snapshot, which answer the reports like the primary.
+        """
+        self.assertIsNone(self.router.session())
+        metadata = take_snapshot(self.url, self.snapshots)
+        self.assertEqual(metadata['last_sale_id'], 200)
+
+        month, year = '03', '2024'
+        snapshot_session = self.router.session()
+        self.assertEqual(uncached(compute_top_five_agents)(snapshot_session(), month, year),
+                         uncached(compute_top_five_agents)(self.session, month, year))
+        self.assertEqual(uncached(compute_days_on_market)(snapshot_session(), month, year, percentiles=(0.5,)),
+                         uncached(compute_days_on_market)(self.session, month, year, percentiles=(0.5,)))
+
+        # the snapshot is read-only, and the sales written to the primary meanwhile are counted in its staleness
+        self.assertRaises(OperationalError, snapshot_session().execute, insert(Sale).values(id=1000))
+        snapshot_session.rollback()
+        append_activity(self.engine, num_houses=10, num_sales=10, day=datetime.date(2024, 3, 20), seed=6)
+        self.assertEqual(self.router.staleness(self.session)['sales_behind'], 10)
+        self.assertEqual(snapshot_session().query(Sale).count(), 200)
+
+        # a new snapshot replaces it, and only the last two are kept
+        take_snapshot(self.url, self.snapshots)
+        take_snapshot(self.url, self.snapshots)
+        self.assertEqual(len([file for file in os.listdir(self.snapshots) if file.endswith('.db')]), 2)
+        self.assertIsNot(self.router.session(), snapshot_session)
+        self.assertEqual(self.router.session()().query(Sale).count(), 210)
+        self.assertEqual(self.router.staleness(self.session)['sales_behind'], 0)
+
+    def test_number_of_snapshots_kept(self):
+        """
+        Tests that the keep most recent snapshots are kept, and that keeping fewer than two is refused.
+        """
+        for _ in range(4):
+            take_snapshot(self.url, self.snapshots, keep=3)
+        snapshots = sorted(file for file in os.listdir(self.snapshots) if file.endswith('.db'))
+        self.assertEqual(len(snapshots), 3)
+        self.assertEqual(snapshots[-1], read_latest(self.snapshots)['path'])
+
+        for keep in (0, 1):
+            self.assertRaises(ValueError, take_snapshot, self.url, self.snapshots, keep=keep)
+        self.assertEqual(sorted(file for file in os.listdir(self.snapshots) if file.endswith('.db')), snapshots)
+
+    def test_stale_snapshot(self):
+        """
+        Tests that a snapshot older than max_staleness is not used, and that a router without a directory reads the primary.
+        """
+        take_snapshot(self.url, self.snapshots)
+        self.assertIsNotNone(SnapshotRouter(self.snapshots, max_staleness=60).session())
+        self.assertIsNone(SnapshotRouter(self.snapshots, max_staleness=0).session())
+        self.assertIsNone(SnapshotRouter(None).session())
+        self.assertGreaterEqual(SnapshotRouter(self.snapshots).staleness()['age_seconds'], 0)
+        self.assertIn('taken_at', read_latest(self.snapshots))
+
+
+class TestPartitions(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = f"sqlite:///{os.path.join(self.directory.name, 'primary.db')}"
+        self.partitions = os.path.join(self.directory.name, 'partitions')
+        self.engine = make_engine(self.url, partitions=self.partitions)
+        Base.metadata.create_all(self.engine)
+        bulk_insert_data(self.engine, num_houses=400, num_sales=300, num_buyers=20, num_sellers=20, num_agents=5, num_offices=3, seed=7)
+        self.session = sessionmaker(bind=self.engine)()
+
+        # the year with the most sales, unless it holds the last sale
+        last_year = self.session.query(Sale.date_of_sale).filter(Sale.id == 300).scalar().year
+        year = func.strftime('%Y', Sale.date_of_sale)
+        self.year = int(self.session.query(year).filter(year != str(last_year)).group_by(year).order_by(func.count().desc()).limit(1).scalar())
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def reports(self, session, month):
+        return (uncached(compute_top_five_agents)(session, month, str(self.year)),
+                uncached(compute_days_on_market)(session, month, str(self.year), percentiles=(0.5, 0.9)),
+                compute_commissions(session, month, str(self.year)),
+                compute_commissions_from_sales(session, months_in_range(('01', str(self.year)), ('12', str(self.year)))))
+
+    def test_archived_year_is_read_from_its_partition(self):
+        """
+        Tests that the reports of an archived year are the same once its sales are moved, and that a month only reads its year.
+        """
+        before = [self.reports(self.session, month) for month in ('03', '09')]
+        self.session.close()
+
+        moved = archive_year(self.year, self.url, self.partitions)
+        self.assertGreater(moved, 0)
+        self.engine.dispose()
+        session = sessionmaker(bind=self.engine)()
+        self.assertEqual(session.query(Sale).filter(func.strftime('%Y', Sale.date_of_sale) == str(self.year)).count(), 0)
+        self.assertEqual(session.query(sales_between(session)).count(), 300)
+
+        # the reports are the same, also once the rollup is rebuilt from the partitions
+        self.assertEqual([self.reports(session, month) for month in ('03', '09')], before)
+        rebuild_rollup(session)
+        self.assertEqual([self.reports(session, month) for month in ('03', '09')], before)
+
+        # a month only reads the partition of its year
+        statements = capture_statements(session, lambda session: uncached(compute_days_on_market)(session, '03', str(self.year), (0.5,)))
+        self.assertTrue(any(f"archive_{self.year}.sale" in statement for statement, _ in statements))
+        statements = capture_statements(session, lambda session: uncached(compute_days_on_market)(session, '03', str(self.year + 1), (0.5,)))
+        self.assertFalse(any('archive_' in statement for statement, _ in statements))
+        session.close()
+
+    def test_inserts_are_routed_to_partitions(self):
+        """
+        Tests that the sales inserted in bulk go into the partition of their year, with unique ids, and into its rollup.
+        """
+        archive_year(self.year, self.url, self.partitions)
+        self.engine.dispose()
+
+        bulk_insert_data(self.engine, num_houses=400, num_sales=300, num_buyers=5, num_sellers=5, num_agents=2, num_offices=1, seed=8)
+        session = sessionmaker(bind=self.engine)()
+        sales = sales_between(session)
+        self.assertEqual(session.query(func.count(sales.c.id), func.count(func.distinct(sales.c.id))).one(), (600, 600))
+        self.assertEqual(session.query(Sale).filter(func.strftime('%Y', Sale.date_of_sale) == str(self.year)).count(), 0)
+
+        # the rollup of the archived year has its new sales
+        in_year = session.query(sales).filter(func.strftime('%Y', sales.c.date_of_sale) == str(self.year)).count()
+        refresh_rollup(session)
+        self.assertEqual(session.query(func.sum(MonthlySalesRollup.num_sales)).filter(MonthlySalesRollup.year == self.year).scalar(), in_year)
+        session.close()
+
+    def test_new_sales_of_a_session_are_placed(self):
+        """
+        Tests that the sales added to a session after sales were routed to an archived year take ids after the ones of every
+        partition, and that a new sale of an archived year goes to its partition and into the rollup when the session commits.
+        """
+        self.session.close()
+        archive_year(self.year, self.url, self.partitions)
+        self.engine.dispose()
+        # the sales of the archived year take ids after the largest one of the sale table
+        append_activity(self.engine, num_houses=5, num_sales=5, day=datetime.date(self.year, 5, 5), seed=9)
+
+        session = sessionmaker(bind=self.engine)()
+        refresh_rollup(session)
+        session.commit()
+        session.add(Sale(agent_id=1, date_of_sale=datetime.date(self.year + 1, 5, 6), sale_price=100000))
+        archived = Sale(agent_id=1, date_of_sale=datetime.date(self.year, 5, 6), sale_price=100000)
+        session.add(archived)
+        session.add_all(generate_sales(session, num_sales=20))
+        session.commit()
+
+        sales = sales_between(session)
+        self.assertEqual(session.query(func.count(sales.c.id), func.count(func.distinct(sales.c.id))).one(), (327, 327))
+        self.assertEqual(session.query(Sale).filter(func.strftime('%Y', Sale.date_of_sale) == str(self.year)).count(), 0)
+        self.assertEqual(session.query(sales).filter(sales.c.id == archived.id).one().date_of_sale, datetime.date(self.year, 5, 6))
+        in_may = session.query(sales).filter(sales.c.date_of_sale >= datetime.date(self.year, 5, 1),
+                                             sales.c.date_of_sale < datetime.date(self.year, 6, 1)).count()
+        self.assertEqual(session.query(func.sum(MonthlySalesRollup.num_sales)).filter(MonthlySalesRollup.year == self.year,
+                                                                                      MonthlySalesRollup.month == 5).scalar(), in_may)
+        session.close()
+
+    def test_new_sale_built_through_relationships(self):
+        """
+        Tests that a new sale of an archived year given its agent and buyer as new objects gets their ids in its partition.
+        """
+        self.session.close()
+        archive_year(self.year, self.url, self.partitions)
+        self.engine.dispose()
+
+        session = sessionmaker(bind=self.engine)()
+        agent = Agent(name='New Agent', phone='555-555-5555', email='new.agent@example.com')
+        buyer = Buyer(name='New Buyer', phone='555-555-5555', email='new.buyer@example.com')
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', SAWarning)
+            session.add(Sale(agent=agent, buyer=buyer, office_id=1, date_of_sale=datetime.date(self.year, 5, 6), sale_price=100000))
+            session.commit()
+
+        sales = sales_between(session)
+        sale = session.query(sales).filter(sales.c.agent_id == agent.id).one()
+        self.assertEqual((sale.buyer_id, sale.date_of_sale), (buyer.id, datetime.date(self.year, 5, 6)))
+        self.assertEqual(session.query(Sale).filter(func.strftime('%Y', Sale.date_of_sale) == str(self.year)).count(), 0)
+        self.assertEqual(compute_commissions(session, '05', str(self.year))[agent.id], Decimal('7500.00000'))
+        session.close()
+
+    def test_snapshots_and_async_reports_read_the_partitions(self):
+        """
+        Tests that the reports of an archived month read the archived year on the latest snapshot and on the async engine.
+        """
+        self.session.close()
+        archive_year(self.year, self.url, self.partitions)
+        self.engine.dispose()
+        session = sessionmaker(bind=self.engine)()
+        expected = uncached(compute_days_on_market)(session, '03', str(self.year), percentiles=(0.5,))
+        self.assertGreater(expected.num_sales, 0)
+
+        snapshots = os.path.join(self.directory.name, 'snapshots')
+        take_snapshot(self.url, snapshots, partitions=self.partitions)
+        router = SnapshotRouter(snapshots)
+        with mock.patch('query.snapshot_router', router):
+            snapshot_session = report_session()
+            self.assertIsNot(snapshot_session, None)
+            self.assertEqual(uncached(compute_days_on_market)(snapshot_session(), '03', str(self.year), percentiles=(0.5,)), expected)
+            self.assertEqual(router.staleness(session)['sales_behind'], 0)
+            snapshot_session.remove()
+        router.current[1].dispose()
+
+        async def days_on_market():
+            async_engine = async_query.make_async_engine(self.url, partitions=self.partitions)
+            try:
+                return await async_query.run_report(uncached(compute_days_on_market), '03', str(self.year), (0.5,),
+                                                    session_factory=async_sessionmaker(bind=async_engine))
+            finally:
+                await async_engine.dispose()
+
+        self.assertEqual(asyncio.run(days_on_market()), expected)
+        session.close()
+
+    def test_exports_and_analytics_read_the_partitions(self):
+        """
+        Tests that the sales export and the analytics snapshot have the sales of the archived years.
+        """
+        directory = tempfile.TemporaryDirectory()
+        analytics = SaleAnalytics(directory.name)
+        self.assertEqual(analytics.refresh(self.session), 300)
+        self.session.close()
+        archive_year(self.year, self.url, self.partitions)
+        self.engine.dispose()
+
+        session = sessionmaker(bind=self.engine)()
+        sales = sales_between(session)
+        path = os.path.join(directory.name, 'sales.csv')
+        self.assertEqual(export.export(session, 'sales', path), 300)
+        self.assertEqual(export.export(session, 'sales', path, start=('01', str(self.year)), end=('12', str(self.year))),
+                         session.query(sales).filter(func.strftime('%Y', sales.c.date_of_sale) == str(self.year)).count())
+
+        # archiving doesn't change the ids, so the snapshot is up to date, and one loaded again has the same sales
+        self.assertEqual(analytics.refresh(session), 0)
+        self.assertEqual(SaleAnalytics(os.path.join(directory.name, 'rebuilt')).refresh(session), 300)
+        self.assertEqual(analytics.compute_commissions('03', str(self.year)), compute_commissions(session, '03', str(self.year)))
+        session.close()
+        directory.cleanup()
+
+    def test_year_with_the_last_sale(self):
+        """
+        Tests that the year of the sale with the largest id can't be archived, and that a year without sales moves nothing.
+        """
+        last_year = self.session.query(Sale.date_of_sale).filter(Sale.id == 300).scalar().year
+        self.assertRaises(ValueError, archive_year, last_year, self.url, self.partitions)
+        self.assertEqual(archive_year(1990, self.url, self.partitions), 0)
+
+
+class TestReadModels(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(engine)
+        bulk_insert_data(engine, num_houses=300, num_sales=250, num_buyers=20, num_sellers=20, num_agents=4, num_offices=2, seed=9)
+        self.session = sessionmaker(bind=engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_sales_of_month(self):
+        """
+        Tests that the read models of a month hold what the ORM objects give, without loading them into the session.
+        """
+        sales = get_sales_of_month(self.session, '06', '2025')
+        self.assertTrue(sales)
+        self.assertTrue(all(isinstance(sale, SaleRow) for sale in sales))
+        self.assertFalse(hasattr(sales[0], '__dict__'))
+        # nothing is loaded into the identity map
+        self.assertEqual(len(self.session.identity_map), 0)
+
+        # the rows hold what the ORM objects would give
+        start_date, end_date = month_window('06', '2025')
+        expected = self.session.query(Sale).filter(Sale.date_of_sale >= start_date, Sale.date_of_sale < end_date).order_by(
+            Sale.date_of_sale, Sale.id).all()
+        self.assertEqual([sale.sale_id for sale in sales], [sale.id for sale in expected])
+        for row, sale in zip(sales, expected):
+            self.assertEqual(row.date_of_sale, sale.date_of_sale)
+            self.assertAlmostEqual(row.sale_price, float(sale.sale_price))
+            self.assertAlmostEqual(row.agent_commission, float(sale.agent_commission), places=4)
+            self.assertEqual(row.days_on_market, (sale.date_of_sale - self.session.get(House, sale.house_id).date_of_listing).days)
+
+        agent_id = sales[0].agent_id
+        self.assertEqual(get_sales_of_month(self.session, '06', '2025', agent_id=agent_id),
+                         [sale for sale in sales if sale.agent_id == agent_id])
+
+    def test_iter_sales(self):
+        """
+        Tests that iter_sales streams every sale of a range as plain tuples with the fields of SaleRow.
+        """
+        rows = list(iter_sales(self.session, ('01', '2022'), ('12', '2030'), chunk_size=40))
+        self.assertEqual(len(rows), 250)
+        self.assertEqual(len(rows[0]), len(SaleRow.__slots__))
+        self.assertEqual(rows[:3], [tuple(getattr(sale, name) for name in SaleRow.__slots__)
+                                    for sale in get_sales_of_month(self.session, f"{rows[0][1].month:02d}", str(rows[0][1].year))[:3]])
+
+    def test_measure(self):
+        """
+        Tests that measure reads every sale of the range, and that the read models take less memory than the ORM objects.
+        """
+        result = measure(self.session, ('01', '2022'), ('12', '2030'))
+        self.assertEqual(result['sales'], 250)
+        self.assertLess(result['read_models']['peak_bytes'], result['orm']['peak_bytes'])
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        for i in range(1, 4):
+            self.session.add(Agent(id=i, name=f'Agent {i}', phone='555-555-5555', email=f'agent{i}@example.com'))
+            self.session.add(Office(id=i, phone='555-555-5555', email=f'office{i}@company.com', address=f'{i} Main St'))
+        for i in range(10):
+            self.session.add(Sale(agent_id=i % 3 + 1, office_id=i % 2 + 1, date_of_sale=datetime.date(2023, 1, i + 1), sale_price=100000))
+        self.session.commit()
+        profiler.reset()
+        profiler.enable()
+
+    def tearDown(self):
+        profiler.disable()
+        profiler.reset()
+        self.session.close()
+
+    def test_statements_are_counted_per_report(self):
+        """
+        Tests that the statements, their rows, and the calls are counted per report, including the calls answered by the cache.
+        """
+        with contextlib.redirect_stdout(io.StringIO()):
+            get_top_five_offices('01', '2023', session=self.session)
+            get_top_five_offices('01', '2023', session=self.session)
+
+        self.assertEqual(profiler.reports['get_top_five_offices']['calls'], 2)
+        self.assertEqual(profiler.reports['get_top_five_offices']['statements'], 0)
+        stats = profiler.reports['compute_top_five_offices']
+        self.assertEqual(stats['calls'], 2)
+        # the first call refreshes the rollup, the second one is answered by the cache
+        self.assertGreater(stats['statements'], 1)
+        top_five = [statement for statement, statement_stats in profiler.statements.items() if 'office.id' in statement]
+        self.assertEqual(len(top_five), 1)
+        self.assertEqual(profiler.statements[top_five[0]]['rows'], 2)
+        self.assertIn('compute_top_five_offices', profiler.summary())
+
+    def test_slow_query_log(self):
+        """
+        Tests that a statement slower than the threshold is logged with the report that sent it and counted.
+        """
+        slow_seconds = profiler.slow_seconds
+        profiler.slow_seconds = 0
+        try:
+            with self.assertLogs('profiling', level='WARNING') as logs:
+                average_selling_price('01', '2023', session=self.session)
+        finally:
+            profiler.slow_seconds = slow_seconds
+        self.assertTrue(any('in compute_average_selling_price' in line for line in logs.output), logs.output)
+        self.assertGreater(profiler.slow_queries, 0)
+
+    def test_disabled(self):
+        """
+        Tests that no listener is left on the engines when the profiler is disabled, and that nothing is collected.
+        """
+        profiler.disable()
+        self.assertFalse(event.contains(Engine, 'before_cursor_execute', profiler.before_cursor_execute))
+        self.assertFalse(event.contains(Engine, 'after_cursor_execute', profiler.after_cursor_execute))
+        with contextlib.redirect_stdout(io.StringIO()):
+            get_top_five_agents('01', '2023', session=self.session)
+        self.assertEqual((profiler.statements, profiler.reports), ({}, {}))
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark_database(self):
+        """
+        Tests that a small database is built and every report is timed, with and without the indexes.
+        """
+        for indexes in [True, False]:
+            result = benchmark_database(400, indexes=indexes, repeat=1)
+            self.assertGreater(result['rows'], sum(scale_counts(400).values()))  # with the agent office associations
+            self.assertEqual(set(result['report_seconds']), set(REPORTS))
+            self.assertTrue(all(seconds >= 0 for seconds in result['report_seconds'].values()))
+            self.assertGreater(result['rows_per_second'], 0)
+
+    def test_compare(self):
+        """
+        Tests that only the timings that got more than the threshold slower are reported, leaving out the ones too short to compare.
+        """
+        old = {'databases': [{'sales': 1000, 'indexes': True, 'insert_seconds': 1.0, 'rollup_build_seconds': 0.5,
+                              'report_seconds': {'top five offices': 0.010, 'commissions': 0.0001}}]}
+        new = {'databases': [{'sales': 1000, 'indexes': True, 'insert_seconds': 1.1, 'rollup_build_seconds': 0.5,
+                              'report_seconds': {'top five offices': 0.020, 'commissions': 0.0005}}]}
+        self.assertEqual(compare(old, new), [('1000 sales with indexes: top five offices', 0.010, 0.020)])
+        self.assertEqual(compare(new, old), [])
+
+
 class TestDataGenerator(unittest.TestCase):
     def setUp(self):
         self.fake = Faker('en_US')
@@ -149,6 +1135,67 @@ class TestDataGenerator(unittest.TestCase):
         for agent in agents:
             self.assertGreater(len(agent.offices), 0)
 
+    def test_append_activity(self):
+        """
+        Tests that a day of listings and sales is appended to the existing rows in batches, and that only houses on the market are sold.
+        """
+        self.assertRaises(ValueError, append_activity, self.engine, num_houses=1, num_sales=0)
+
+        self.session.add_all(generate_agents() + generate_offices() + generate_buyers() + generate_sellers())
+        self.session.commit()
+        calls = []
+        day = datetime.date(2024, 5, 1)
+        counts = append_activity(self.engine, num_houses=25, num_sales=10, day=day, batch_size=10, seed=1,
+                                 progress=lambda table, done, total: calls.append((table, done, total)))
+
+        self.assertEqual(counts, {'house': 25, 'sale': 10})
+        self.assertEqual(calls, [('house', 10, 25), ('house', 20, 25), ('house', 25, 25), ('sale', 10, 10)])
+        sales = self.session.query(Sale).all()
+        self.assertEqual(len(sales), 10)
+        for sale in sales:
+            house = self.session.get(House, sale.house_id)
+            self.assertEqual((house.status, house.buyer_id, sale.date_of_sale), ('Sold', sale.buyer_id, day))
+            self.assertLessEqual(sale.sale_price, house.listing_price)
+
+        # only 15 houses are left on the market, and the houses listed after the day can't be sold on it
+        append_activity(self.engine, num_houses=5, num_sales=0, day=datetime.date(2024, 6, 1))
+        statements = []
+        event.listen(self.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        counts = append_activity(self.engine, num_houses=0, num_sales=40, day=day, batch_size=10)
+        self.assertEqual(counts['sale'], 15)
+        # the market is read once, not once per batch
+        self.assertEqual(len([statement for statement in statements if 'house.date_of_listing <=' in statement]), 1)
+        self.assertEqual(self.session.query(House).filter(House.status == 'Not Sold').count(), 5)
+
+    def test_populate_agent_office_association_in_bulk(self):
+        """
+        Tests that the pairs are inserted with a single statement, that running it again skips the existing pairs,
+        and that a pair can't be inserted twice.
+        """
+        self.session.add_all(generate_agents() + generate_offices())
+        self.session.commit()
+
+        inserts = []
+        def count_inserts(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT'):
+                inserts.append(executemany)
+        event.listen(self.engine, 'before_cursor_execute', count_inserts)
+        populate_agent_office_association(self.session, seed=1)
+        event.remove(self.engine, 'before_cursor_execute', count_inserts)
+        self.assertEqual(inserts, [True])
+
+        num_pairs = self.session.query(agent_office_association).count()
+        populate_agent_office_association(self.session, seed=2)
+        self.assertGreaterEqual(self.session.query(agent_office_association).count(), num_pairs)
+
+        agent_id, office_id = self.session.query(agent_office_association).first()
+        with self.assertRaises(IntegrityError):
+            self.session.execute(insert(agent_office_association), [{'agent_id': agent_id, 'office_id': office_id}])
+        self.session.rollback()
+
+        query = self.session.query(agent_office_association.c.agent_id).filter(agent_office_association.c.office_id == office_id)
+        self.assertTrue(any('COVERING INDEX agent_office_association_office_index' in step for step in explain_query_plan(self.session, query)))
+
     def test_generate_buyers(self):
         """
         Tests that the generate_buyers function returns a list of buyers.
@@ -186,6 +1233,376 @@ class TestDataGenerator(unittest.TestCase):
             self.assertIn(house.office_id, [office.id for office in offices])
             self.assertIn(house.seller_id, [seller.id for seller in sellers])
 
+    def test_generate_sales(self):
+        """
+        Tests that the generate_sales function sells every house at most once and marks it as sold.
+        """
+        self.session.add_all(generate_agents() + generate_offices() + generate_buyers() + generate_sellers())
+        self.session.commit()
+        self.session.add_all(generate_houses(self.session))
+        self.session.commit()
+
+        sales = generate_sales(self.session, 30)
+        self.session.add_all(sales)
+        self.session.commit()
+        self.assertEqual(len(sales), 30)
+        self.assertEqual(len({sale.house_id for sale in sales}), 30)
+        self.assertEqual(self.session.query(House).filter_by(status='Sold').count(), 30)
+
+        # only the houses that are still unsold can be sold, so asking for more sells the remaining 70
+        sales = generate_sales(self.session, 1000)
+        self.assertEqual(len(sales), 70)
+        self.assertFalse({sale.house_id for sale in sales} & {house_id for house_id, in self.session.query(Sale.house_id)})
+
+    def test_generate_sales_queries(self):
+        """
+        Tests that generate_sales sends the same two queries however many sales it generates, and that the buyer of every
+        sold house is set.
+        """
+        self.session.add_all(generate_agents() + generate_offices() + generate_buyers() + generate_sellers())
+        self.session.commit()
+        self.session.add_all(generate_houses(self.session))
+        self.session.commit()
+
+        statements = []
+        event.listen(self.session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        counts = []
+        for num_sales in (5, 60):
+            del statements[:]
+            sales = generate_sales(self.session, num_sales)
+            counts.append(len(statements))
+            self.session.add_all(sales)
+            self.session.commit()
+        self.assertEqual(counts, [2, 2])
+
+        for sale in self.session.query(Sale):
+            self.assertEqual(self.session.get(House, sale.house_id).buyer_id, sale.buyer_id)
+            self.assertIn(self.session.get(House, sale.house_id), self.session.get(Buyer, sale.buyer_id).houses)
+
+    def test_bulk_insert_data(self):
+        """
+        Tests that the bulk generator inserts consistent data: every sale is of a different house, which is marked as sold,
+        and takes its seller, agent, and office from that house.
+        """
+        counts = bulk_insert_data(self.engine, num_houses=500, num_sales=400, num_buyers=50, num_sellers=30, num_agents=10,
+                                  num_offices=4, chunk_size=120, seed=1)
+        self.assertEqual(self.session.query(House).count(), 500)
+        self.assertEqual(self.session.query(Sale).count(), 400)
+        self.assertEqual(self.session.query(Agent).count(), 10)
+        self.assertEqual(counts['sale'], 400)
+
+        sales = self.session.query(Sale).all()
+        self.assertEqual(len({sale.house_id for sale in sales}), 400)
+        self.assertEqual(self.session.query(House).filter_by(status='Sold').count(), 400)
+        for sale in sales:
+            house = self.session.get(House, sale.house_id)
+            self.assertEqual((sale.seller_id, sale.agent_id, sale.office_id, sale.buyer_id), (house.seller_id, house.agent_id, house.office_id, house.buyer_id))
+            self.assertGreaterEqual(sale.date_of_sale, house.date_of_listing)
+            self.assertLessEqual(sale.sale_price, house.listing_price)
+        for agent in self.session.query(Agent).all():
+            self.assertGreater(len(agent.offices), 0)
+
+        # a second run adds rows after the existing ones
+        bulk_insert_data(self.engine, num_houses=10, num_sales=5, num_buyers=1, num_sellers=1, num_agents=1, num_offices=1, seed=2)
+        self.assertEqual(self.session.query(Sale).count(), 405)
+
+    def test_bulk_insert_data_defers_indexes(self):
+        """
+        Tests that the indexes of the house and sale tables are dropped during a load into empty tables and created again
+        after it, and are kept up to date row by row when the load is small next to the tables.
+        """
+        statements = []
+        event.listen(self.engine, 'before_cursor_execute', lambda *args: statements.append(args[2].split()[0]))
+        indexes = {(table.name, index.name) for table in (House.__table__, Sale.__table__) for index in table.indexes}
+
+        bulk_insert_data(self.engine, num_houses=50, num_sales=40, num_buyers=5, num_sellers=5, num_agents=3, num_offices=2, seed=1)
+        self.assertEqual((statements.count('DROP'), statements.count('CREATE')), (len(indexes), len(indexes)))
+        self.assertTrue(all(inspect(self.engine).has_index(table, index) for table, index in indexes))
+
+        statements.clear()
+        bulk_insert_data(self.engine, num_houses=10, num_sales=5, num_buyers=1, num_sellers=1, num_agents=1, num_offices=1, seed=2)
+        self.assertEqual((statements.count('DROP'), statements.count('CREATE')), (0, 0))
+
+class TestEngine(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = make_engine(f"sqlite:///{os.path.join(self.directory.name, 'test.db')}")
+        Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_sqlite_pragmas(self):
+        """
+        Tests that every connection of the engine is set up with WAL and the tuned settings.
+        """
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 1)  # NORMAL
+            self.assertEqual(connection.exec_driver_sql('PRAGMA busy_timeout').scalar(), 10000)
+
+    def test_readers_are_not_blocked_by_a_writer(self):
+        """
+        Tests that a reader can read the committed data while another connection is in the middle of writing.
+        """
+        with self.engine.begin() as connection:
+            connection.execute(insert(Sale), [{'house_id': 1, 'date_of_sale': datetime.date(2023, 1, 1), 'sale_price': 100000}])
+
+        with self.engine.connect() as writer, self.engine.connect() as reader:
+            writer.exec_driver_sql('BEGIN EXCLUSIVE')
+            writer.execute(insert(Sale), [{'house_id': 2, 'date_of_sale': datetime.date(2023, 1, 2), 'sale_price': 200000}])
+            started = time.perf_counter()
+            self.assertEqual(reader.execute(func.count(Sale.id).select()).scalar(), 1)
+            self.assertLess(time.perf_counter() - started, 1)
+            writer.rollback()
+
+    def test_create_indexes(self):
+        """
+        Tests that the indexes missing from an older database are created, and only those.
+        """
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql('DROP INDEX sale_report_index')
+            connection.exec_driver_sql('DROP INDEX house_agent_index')
+
+        self.assertEqual(create_indexes(self.engine), ['house_agent_index', 'sale_report_index'])
+        self.assertEqual(create_indexes(self.engine), [])
+
+    def test_drop_obsolete_indexes(self):
+        """
+        Tests that the indexes an older database has and the models no longer use are dropped, and only those.
+        """
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql('CREATE INDEX date_of_sale_index ON sale (date_of_sale)')
+            connection.exec_driver_sql('CREATE INDEX sale_price_index ON sale (sale_price)')
+
+        self.assertEqual(drop_obsolete_indexes(self.engine), ['date_of_sale_index', 'sale_price_index'])
+        self.assertEqual(drop_obsolete_indexes(self.engine), [])
+        self.assertTrue(inspect(self.engine).has_index('sale', 'sale_report_index'))
+
+
+class TestQueries(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite:///:memory:')
+        Session = sessionmaker(bind=engine)
+        self.session = Session()
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        self.session.rollback()
+
+    def test_month_window(self):
+        """
+        Tests that the month window is the half-open range from the first day of the month to the first day of the next month.
+        """
+        self.assertEqual(month_window('01', '2023'), (datetime.date(2023, 1, 1), datetime.date(2023, 2, 1)))
+        self.assertEqual(month_window('12', '2022'), (datetime.date(2022, 12, 1), datetime.date(2023, 1, 1)))
+        with self.assertRaises(ValueError):
+            month_window('1', '2023')
+
+    def test_sales_of_a_month(self):
+        """
+        Tests that the sales of a month the reports read are the ones on its first and last day and nothing outside it.
+        """
+        for day in [datetime.date(2022, 12, 31), datetime.date(2023, 1, 1), datetime.date(2023, 1, 31), datetime.date(2023, 2, 1)]:
+            self.session.add(Sale(house_id=1, seller_id=1, buyer_id=1, agent_id=1, office_id=1, date_of_sale=day, sale_price=100000))
+        self.session.commit()
+
+        sales = sales_between(self.session, *month_window('01', '2023'))
+        result = self.session.query(sales.c.date_of_sale).order_by(sales.c.date_of_sale).all()
+        self.assertEqual([row.date_of_sale for row in result], [datetime.date(2023, 1, 1), datetime.date(2023, 1, 31)])
+        self.assertEqual(uncached(compute_average_selling_price)(self.session, '01', '2023'), 100000)
+
+    def test_month_reports_search_the_index(self):
+        """
+        Tests that the statements the reports send for a month of sales (the rollup refresh and the percentiles of the days
+        on the market) search an index on date_of_sale instead of scanning the sale table.
+        """
+        for report in ['rollup refresh', 'days on the market']:
+            statements = capture_statements(self.session, REPORTS[report], '01', '2023')
+            plan = [step for statement, parameters in statements for step in explain(self.session, statement, parameters)]
+            self.assertTrue(any(step.startswith('SEARCH sale USING') and '(date_of_sale>? AND date_of_sale<?)' in step for step in plan),
+                            (report, plan))
+            self.assertFalse(any(step.startswith('SCAN sale') for step in plan), (report, plan))
+
+    def test_sale_queries_are_covered_by_an_index(self):
+        """
+        Tests that the queries over a month of sales read sale_report_index without looking up the sales in the table.
+        """
+        for report in ['rollup refresh', 'days on the market', 'commission batch']:
+            statements = capture_statements(self.session, REPORTS[report], '01', '2023')
+            sale_steps = [step for statement, parameters in statements for step in explain(self.session, statement, parameters)
+                          if step.startswith(('SEARCH sale ', 'SCAN sale'))]
+            self.assertTrue(sale_steps, report)
+            for step in sale_steps:
+                self.assertIn('USING COVERING INDEX sale_report_index', step, report)
+
+    def test_plan_warnings(self):
+        """
+        Tests that only the steps that scan a table or look up each row found in an index are flagged.
+        """
+        plan = ['SCAN sale', 'SEARCH house USING INDEX house_agent_index (agent_id=?)', 'SEARCH sale USING COVERING INDEX sale_report_index',
+                'SCAN anon_1', 'SCAN (subquery-3)', 'SEARCH house USING INTEGER PRIMARY KEY (rowid=?)']
+        self.assertEqual([step for step, warning in plan_warnings(plan)], plan[:2])
+
+    def test_compute_commissions(self):
+        """
+        Tests that the grouped commission query gives the same totals as summing the agent_commission property of each sale.
+        """
+        for i, price in enumerate([50000, 150000, 300000, 700000, 2000000, 99999]):
+            self.session.add(Sale(house_id=i, seller_id=1, buyer_id=1, agent_id=i % 2 + 1, office_id=1, date_of_sale=datetime.date(2023, 1, 15), sale_price=price))
+        self.session.add(Sale(house_id=9, seller_id=1, buyer_id=1, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 2, 1), sale_price=100000))
+        self.session.commit()
+
+        start_date, end_date = month_window('01', '2023')
+        sales = self.session.query(Sale).filter(Sale.date_of_sale >= start_date, Sale.date_of_sale < end_date).all()
+        commissions = compute_commissions(self.session, '01', '2023')
+        self.assertEqual(set(commissions), {1, 2})
+        for agent_id, total_commission in commissions.items():
+            expected = sum(sale.agent_commission for sale in sales if sale.agent_id == agent_id)
+            self.assertAlmostEqual(total_commission, expected, places=2)
+
+    def test_get_commision_for_each_agent_is_idempotent(self):
+        """
+        Tests that running the commission report again for a month updates its rows in place instead of duplicating them.
+        """
+        self.session.add(Sale(house_id=1, seller_id=1, buyer_id=1, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 1, 15), sale_price=200000))
+        self.session.add(Sale(house_id=2, seller_id=1, buyer_id=1, agent_id=2, office_id=1, date_of_sale=datetime.date(2023, 1, 15), sale_price=50000))
+        self.session.commit()
+
+        get_commision_for_each_agent('01', '2023', session=self.session)
+        row_id = self.session.query(MonthlyCommission).filter_by(agent_id=1, year=2023, month=1).one().id
+        get_commision_for_each_agent('01', '2023', session=self.session)
+        self.assertEqual(self.session.query(MonthlyCommission).count(), 2)
+
+        # a new sale for agent 1 and agent 2's sale moving to February
+        self.session.add(Sale(house_id=3, seller_id=1, buyer_id=1, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 1, 20), sale_price=50000))
+        self.session.query(Sale).filter_by(agent_id=2).one().date_of_sale = datetime.date(2023, 2, 1)
+        self.session.commit()
+        get_commision_for_each_agent('01', '2023', session=self.session)
+
+        result = self.session.query(MonthlyCommission).all()
+        self.assertEqual(len(result), 1)
+        self.assertEqual((result[0].id, result[0].agent_id, result[0].month, result[0].year), (row_id, 1, 1, 2023))
+        self.assertEqual(result[0].total_commission, 17000)
+
+        query = self.session.query(MonthlyCommission).filter_by(agent_id=1, year=2023, month=1)
+        self.assertTrue(any('USING INDEX monthly_commission_index' in step for step in explain_query_plan(self.session, query)))
+
+    def test_commissions_of_sales_without_an_agent(self):
+        """
+        Tests that the commission of the sales without an agent is not stored, and doesn't keep the rows of the agents
+        who no longer have a commission for the month from being removed.
+        """
+        self.session.add(Sale(house_id=1, seller_id=1, buyer_id=1, agent_id=None, office_id=1, date_of_sale=datetime.date(2023, 1, 15), sale_price=200000))
+        self.session.add(Sale(house_id=2, seller_id=1, buyer_id=1, agent_id=2, office_id=1, date_of_sale=datetime.date(2023, 1, 15), sale_price=50000))
+        self.session.commit()
+
+        get_commision_for_each_agent('01', '2023', session=self.session)
+        get_commision_for_each_agent('01', '2023', session=self.session)
+        self.assertEqual([row.agent_id for row in self.session.query(MonthlyCommission)], [2])
+
+        self.session.query(Sale).filter_by(agent_id=2).one().date_of_sale = datetime.date(2023, 2, 1)
+        self.session.commit()
+        get_commision_for_each_agent('01', '2023', session=self.session)
+        self.assertEqual(self.session.query(MonthlyCommission).count(), 0)
+
+    def test_average_number_of_days(self):
+        """
+        Tests that the days on the market and their percentiles are computed in a single query.
+        """
+        for i, days in enumerate([10, 20, 30, 40, 100]):
+            self.session.add(House(id=i + 1, date_of_listing=datetime.date(2023, 1, 31) - datetime.timedelta(days=days)))
+            self.session.add(Sale(house_id=i + 1, seller_id=1, buyer_id=1, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 1, 31), sale_price=100000))
+        self.session.commit()
+
+        statements = []
+        event.listen(self.session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        result = average_number_of_days('01', '2023', percentiles=(0.5, 0.9), session=self.session)
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(result.num_sales, 5)
+        self.assertEqual(result.average, 40)
+        self.assertEqual(result.percentiles, {0.5: 30, 0.9: 100})
+
+        result = average_number_of_days('02', '2023', session=self.session)
+        self.assertEqual((result.average, result.num_sales), (None, 0))
+
+    def test_top_five_reports(self):
+        """
+        Tests that the top five reports return structured rows, ordered by the number of sales, from a single query each
+        once the rollup is up to date (plus the query that checks that it is).
+        """
+        for i in range(1, 7):
+            self.session.add(Agent(id=i, name=f'Agent {i}', phone='555-555-5555', email=f'agent{i}@example.com'))
+            self.session.add(Office(id=i, phone='555-555-5555', email=f'office{i}@company.com', address=f'{i} Main St'))
+            for _ in range(i):
+                self.session.add(Sale(house_id=1, seller_id=1, buyer_id=1, agent_id=i, office_id=i, date_of_sale=datetime.date(2023, 1, 10), sale_price=100000))
+        self.session.commit()
+        refresh_rollup(self.session)
+
+        statements = []
+        event.listen(self.session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        offices = get_top_five_offices('01', '2023', session=self.session)
+        agents = get_top_five_agents('01', '2023', session=self.session)
+
+        self.assertEqual(len(statements), 4)
+        self.assertEqual(offices[0], OfficeSales(office_id=6, email='office6@company.com', address='6 Main St', num_sales=6, total_revenue=600000))
+        self.assertEqual([office.office_id for office in offices], [6, 5, 4, 3, 2])
+        self.assertEqual(agents[0], AgentSales(agent_id=6, name='Agent 6', email='agent6@example.com', num_sales=6, total_revenue=600000))
+        self.assertEqual([agent.agent_id for agent in agents], [6, 5, 4, 3, 2])
+
+    def test_average_selling_price(self):
+        """
+        Tests that the average selling price is returned, and that a month without sales returns None.
+        """
+        for price in [100000, 300000]:
+            self.session.add(Sale(house_id=1, seller_id=1, buyer_id=1, agent_id=1, office_id=1, date_of_sale=datetime.date(2023, 1, 10), sale_price=price))
+        self.session.commit()
+
+        self.assertEqual(average_selling_price('01', '2023', session=self.session), 200000)
+        self.assertIsNone(average_selling_price('02', '2023', session=self.session))
+
+    def test_months_in_range(self):
+        """
+        Tests that a range of months includes both ends and crosses years.
+        """
+        self.assertEqual(months_in_range(('11', '2022'), ('02', '2023')), [('11', '2022'), ('12', '2022'), ('01', '2023'), ('02', '2023')])
+        with self.assertRaises(ValueError):
+            months_in_range(('02', '2023'), ('01', '2023'))
+
+    def test_get_monthly_reports(self):
+        """
+        Tests that the range reports give the same answers as running the single month reports for every month,
+        with one query per report.
+        """
+        for i in range(1, 8):
+            self.session.add(Agent(id=i, name=f'Agent {i}', phone='555-555-5555', email=f'agent{i}@example.com'))
+            self.session.add(Office(id=i, phone='555-555-5555', email=f'office{i}@company.com', address=f'{i} Main St'))
+        for i in range(60):
+            self.session.add(House(id=i + 1, date_of_listing=datetime.date(2022, 10, 1)))
+            self.session.add(Sale(house_id=i + 1, seller_id=1, buyer_id=1, agent_id=i * i % 7 + 1, office_id=i % 6 + 1,
+                                  date_of_sale=datetime.date(2022, 11 + i % 3, 1) if i % 3 < 2 else datetime.date(2023, 1, i % 28 + 1),
+                                  sale_price=10000 * (i + 1)))
+        self.session.commit()
+        refresh_rollup(self.session)
+
+        statements = []
+        event.listen(self.session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        reports = get_monthly_reports(('10', '2022'), ('01', '2023'), session=self.session)
+        self.assertEqual(len(statements), 10)  # 5 reports, and checking that the rollup is up to date before each
+
+        self.assertEqual([(report.month, report.year) for report in reports], [('10', '2022'), ('11', '2022'), ('12', '2022'), ('01', '2023')])
+        self.assertEqual((reports[0].top_offices, reports[0].top_agents, reports[0].average_price, reports[0].commissions), ([], [], None, {}))
+        for report in reports[1:]:
+            self.assertEqual([(office.office_id, office.num_sales) for office in report.top_offices],
+                             [(office.office_id, office.num_sales) for office in get_top_five_offices(report.month, report.year, session=self.session)])
+            self.assertEqual([(agent.agent_id, agent.num_sales) for agent in report.top_agents],
+                             [(agent.agent_id, agent.num_sales) for agent in get_top_five_agents(report.month, report.year, session=self.session)])
+            self.assertAlmostEqual(report.average_price, average_selling_price(report.month, report.year, session=self.session))
+            self.assertAlmostEqual(report.average_days_on_market, average_number_of_days(report.month, report.year, session=self.session).average)
+            self.assertEqual(report.commissions, compute_commissions(self.session, report.month, report.year))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file